@@ -0,0 +1,105 @@
+from collections import deque
+
+
+class TreeAdjacency:
+    # In-memory child/parent lists for every node of a version, keyed by node
+    # id. Built from plain id tuples so it holds no model instances.
+
+    def __init__(self, node_ids, edges):
+        # edges is an iterable of (edge_version_id, source_node_id, target_node_id)
+        # dict keeps the load order, so roots come back in a stable order
+        self.node_ids = dict.fromkeys(node_ids)
+        self.children = {}
+        self.parents = {}
+        self.edge_ids = {}
+        for edge_version_id, source_id, target_id in edges:
+            # Edges pointing at nodes outside the version are not traversable,
+            # just like get_child_nodes/get_parent_nodes ignore them
+            if source_id not in self.node_ids or target_id not in self.node_ids:
+                continue
+            self.children.setdefault(source_id, []).append(target_id)
+            self.parents.setdefault(target_id, []).append(source_id)
+            # Of parallel edges, paths use the one with the lowest id
+            key = (source_id, target_id)
+            self.edge_ids[key] = min(self.edge_ids.get(key, edge_version_id), edge_version_id)
+
+    def __contains__(self, node_id):
+        return node_id in self.node_ids
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def get_children(self, node_id):
+        return self.children.get(node_id, [])
+
+    def get_parents(self, node_id):
+        return self.parents.get(node_id, [])
+
+    def get_roots(self):
+        return [node_id for node_id in self.node_ids if node_id not in self.parents]
+
+    def preorder(self, start_node_id, visited=None):
+        # Depth-first pre-order without recursion, so deep trees do not hit
+        # the interpreter's recursion limit. Nodes already in `visited` are
+        # skipped and the set is updated in place.
+        if visited is None:
+            visited = set()
+        stack = [start_node_id]
+        order = []
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            order.append(node_id)
+            stack.extend(
+                child_id for child_id in reversed(self.get_children(node_id))
+                if child_id not in visited
+            )
+        return order
+
+    def nodes_at_depth(self, depth):
+        # Nodes reachable from a root by a path of exactly `depth` edges, each
+        # listed once and ordered by id, like TreeVersion.get_nodes_at_depth
+        frontier = set(self.get_roots())
+        for _ in range(depth):
+            frontier = {child_id for node_id in frontier for child_id in self.get_children(node_id)}
+        return sorted(frontier)
+
+    def find_path(self, start_node_id, end_node_id):
+        # Shortest path as [(node_id, edge_version_id), ...] with None as the
+        # edge of the final node. Of several shortest paths, the one taking
+        # the lowest node id at each step is returned, as in the database.
+        if start_node_id == end_node_id:
+            return [(start_node_id, None)]
+        if end_node_id not in self.node_ids:
+            return None
+        # Breadth-first search back from the end node for the distance of
+        # each ancestor, until the start node is reached
+        distances = {end_node_id: 0}
+        queue = deque([end_node_id])
+        while queue and start_node_id not in distances:
+            node_id = queue.popleft()
+            for parent_id in self.get_parents(node_id):
+                if parent_id not in distances:
+                    distances[parent_id] = distances[node_id] + 1
+                    queue.append(parent_id)
+        if start_node_id not in distances:
+            return None
+        return walk_shortest_path(start_node_id, end_node_id, distances, self.get_children, self.edge_ids)
+
+
+def walk_shortest_path(start_node_id, end_node_id, distances, get_children, edge_ids):
+    # Follow a shortest path from the start node given every node's distance
+    # to the end node, taking the lowest child id one step closer each time
+    path = []
+    node_id = start_node_id
+    while node_id != end_node_id:
+        child_id = min(
+            child_id for child_id in get_children(node_id)
+            if distances.get(child_id) == distances[node_id] - 1
+        )
+        path.append((node_id, edge_ids[(node_id, child_id)]))
+        node_id = child_id
+    path.append((end_node_id, None))
+    return path
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Tree, TreeNode, TreeEdge, Tag, TreeVersion, TreeNodeVersion, TreeEdgeVersion
+from .models import Tree, TreeNode, TreeEdge, Tag, TreeVersion, TreeNodeVersion, TreeEdgeVersion, TreeClosure, PayloadBlob
 
 admin.site.register(Tree)
 admin.site.register(TreeNode)
@@ -8,3 +8,5 @@ admin.site.register(Tag)
 admin.site.register(TreeVersion)
 admin.site.register(TreeNodeVersion)
 admin.site.register(TreeEdgeVersion)
+admin.site.register(TreeClosure)
+admin.site.register(PayloadBlob)
@@ -0,0 +1,196 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .cache import MaterializedVersion
+
+# A version archive is a file of zlib-compressed, length-prefixed blocks of
+# JSON records, followed by an index block and a fixed-size trailer:
+#
+#   MAGIC
+#   block*          4-byte big-endian length + zlib(JSON list of records)
+#   index block     same framing: {"version": {...}, "nodes": [...], "edges": [...]}
+#   trailer         8-byte big-endian offset of the index block + MAGIC
+#
+# Node records [node_id, node_version_id, payload_hash, data, inherited] are
+# sorted by node id and edge records [edge_version_id, edge_id, source_id,
+# target_id, payload_hash, data, inherited] by source node id; `inherited`
+# marks rows a delta version read from its ancestors. The index lists
+# [first key, last key, offset] of every block, so a node or the edges
+# leaving it are found by decompressing one block of the memory-mapped file.
+#
+# Settings, optional:
+#
+# TREE_ARCHIVE_DIR = BASE_DIR / 'archives'  # where archive_version writes
+MAGIC = b'TVARCHV1'
+DEFAULT_BLOCK_SIZE = 512
+# Decompressed blocks kept per open archive
+CACHED_BLOCKS = 8
+
+_LENGTH = struct.Struct('>I')
+_TRAILER = struct.Struct(f'>Q{len(MAGIC)}s')
+
+
+def archive_dir():
+    return getattr(settings, 'TREE_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archives'))
+
+
+def _write_block(stream, records):
+    data = zlib.compress(json.dumps(records, separators=(',', ':')).encode())
+    offset = stream.tell()
+    stream.write(_LENGTH.pack(len(data)))
+    stream.write(data)
+    return offset
+
+
+def _write_blocks(stream, rows, key, block_size):
+    # Write `rows` in blocks of `block_size` and return their index entries
+    index = []
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) >= block_size:
+            index.append([key(block[0]), key(block[-1]), _write_block(stream, block)])
+            block = []
+    if block:
+        index.append([key(block[0]), key(block[-1]), _write_block(stream, block)])
+    return index
+
+
+def write_archive(path, header, nodes, edges, block_size=DEFAULT_BLOCK_SIZE):
+    # Write an archive from iterables of node and edge records (sorted as
+    # described above). The file is written next to `path` and renamed into
+    # place, so a partially written archive is never seen.
+    partial = f'{path}.partial'
+    with open(partial, 'wb') as stream:
+        stream.write(MAGIC)
+        index = {
+            'version': header,
+            'nodes': _write_blocks(stream, nodes, lambda record: record[0], block_size),
+            'edges': _write_blocks(stream, edges, lambda record: record[2], block_size),
+        }
+        stream.write(_TRAILER.pack(_write_block(stream, index), MAGIC))
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(partial, path)
+
+
+class ArchivedVersion(MaterializedVersion):
+    # Read access to an archived version straight from the memory-mapped
+    # file. get_node and get_child_nodes decompress only the blocks they
+    # need; the other read methods load the whole version once, like a
+    # MaterializedVersion.
+
+    def __init__(self, path):
+        with open(path, 'rb') as stream:
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(MAGIC) + _TRAILER.size or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a version archive.")
+        index_offset, magic = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a version archive.")
+        self.path = path
+        self._blocks = OrderedDict()
+        index = self._block(index_offset)
+        self.header = index['version']
+        self.version_id = self.header['id']
+        self._node_blocks = index['nodes']
+        self._edge_blocks = index['edges']
+        self._node_keys = [first for first, _, _ in self._node_blocks]
+        self._edge_keys = [first for first, _, _ in self._edge_blocks]
+        self._nodes = None
+        self._edges = None
+        self._index = None
+
+    def close(self):
+        self._map.close()
+
+    def _block(self, offset):
+        block = self._blocks.get(offset)
+        if block is None:
+            (length,) = _LENGTH.unpack_from(self._map, offset)
+            start = offset + _LENGTH.size
+            block = json.loads(zlib.decompress(self._map[start:start + length]))
+            self._blocks[offset] = block
+            if len(self._blocks) > CACHED_BLOCKS:
+                self._blocks.popitem(last=False)
+        else:
+            self._blocks.move_to_end(offset)
+        return block
+
+    def _blocks_for(self, blocks, first_keys, key):
+        # Blocks whose key range contains `key`; edges of one source node
+        # can continue into the following blocks
+        position = max(bisect_right(first_keys, key) - 1, 0)
+        while position < len(blocks) and blocks[position][0] <= key:
+            if blocks[position][1] >= key:
+                yield self._block(blocks[position][2])
+            position += 1
+
+    def iter_node_records(self):
+        for _, _, offset in self._node_blocks:
+            yield from self._block(offset)
+
+    def iter_edge_records(self):
+        for _, _, offset in self._edge_blocks:
+            yield from self._block(offset)
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            self._nodes = {
+                node_id: (node_version_id, data) for node_id, node_version_id, _, data, _ in self.iter_node_records()
+            }
+        return self._nodes
+
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = {
+                edge_version_id: (edge_id, source_id, target_id, data)
+                for edge_version_id, edge_id, source_id, target_id, _, data, _ in self.iter_edge_records()
+            }
+        return self._edges
+
+    def _find_node(self, node_id):
+        for block in self._blocks_for(self._node_blocks, self._node_keys, node_id):
+            for record_id, node_version_id, _, data, _ in block:
+                if record_id == node_id:
+                    return node_version_id, data
+        return None
+
+    def _archived_node(self, node_id, found):
+        from .models import TreeNodeVersion
+
+        node_version_id, data = found
+        return TreeNodeVersion(id=node_version_id, node_id=node_id, version_id=self.version_id, data=data)
+
+    def get_node(self, node_id):
+        if self._nodes is not None:
+            return super().get_node(node_id)
+        found = self._find_node(node_id)
+        if found is None:
+            raise ValueError(f"Node with id {node_id} does not exist in this version.")
+        return self._archived_node(node_id, found)
+
+    def get_child_nodes(self, node_id):
+        if self._nodes is not None:
+            return super().get_child_nodes(node_id)
+        child_ids = [
+            target_id
+            for block in self._blocks_for(self._edge_blocks, self._edge_keys, node_id)
+            for _, _, source_id, target_id, _, _, _ in block
+            if source_id == node_id
+        ]
+        children = []
+        for child_id in child_ids:
+            found = self._find_node(child_id)
+            if found is not None:
+                children.append(self._archived_node(child_id, found))
+        return children
@@ -0,0 +1,165 @@
+import os
+import statistics
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from django.db import connection, transaction
+
+from .models import Tree, TreeEdge, TreeNode, TreeVersion
+
+
+def build_tree(name, size, fan_out=4, depth=None):
+    # Create a tree of `size` nodes, filled level by level with `fan_out`
+    # children per node. With `depth`, levels below it are not created and the
+    # remaining nodes are spread over the deepest level's parents instead.
+    # Returns the tree and its nodes, grouped by level.
+    tree = Tree.objects.create(name=name)
+    widths = [1]
+    remaining = size - 1
+    while remaining > 0 and (depth is None or len(widths) <= depth):
+        width = min(widths[-1] * fan_out, remaining)
+        widths.append(width)
+        remaining -= width
+    if remaining > 0:
+        widths[-1] += remaining
+
+    nodes = TreeNode.objects.bulk_create(
+        (TreeNode(tree=tree, data={"index": i}) for i in range(size)),
+        batch_size=5000,
+    )
+    levels = []
+    start = 0
+    for width in widths:
+        levels.append(nodes[start:start + width])
+        start += width
+
+    edges = []
+    for parents, children in zip(levels, levels[1:]):
+        for i, child in enumerate(children):
+            edges.append(TreeEdge(
+                incoming_node=parents[i % len(parents)], outgoing_node=child, data={"index": child.data["index"]}
+            ))
+    TreeEdge.objects.bulk_create(edges, batch_size=5000)
+    return tree, levels
+
+
+def build_history(tree, versions=1, branches=0, delta=False, changes=10):
+    # Tag the tree, then add `versions - 1` further tagged versions, each a
+    # branch of the previous one with `changes` nodes added under the root,
+    # and `branches` untagged branches of the last tag. Returns the last tag.
+    root_id = tree.nodes.order_by('id').values_list('id', flat=True).first()
+    tag_name = f"{tree.name}-v0"
+    tree.create_tag(name=tag_name)
+    for number in range(1, versions):
+        version = tree.create_new_tree_version_from_tag(tag_name, delta=delta)
+        node_versions = version.add_nodes({"version": number, "change": i} for i in range(changes))
+        version.add_edges((root_id, node_version.node_id, {}) for node_version in node_versions)
+        tag_name = f"{tree.name}-v{number}"
+        tree.create_tag(name=tag_name, version=version)
+    for _ in range(branches):
+        tree.create_new_tree_version_from_tag(tag_name, delta=delta)
+    return tag_name
+
+
+def measure(operation, setup=None, repeat=3):
+    # Run `operation(*setup())` `repeat` times, each in a savepoint that is
+    # rolled back, so mutating operations always start from the same state.
+    # Timing and query counts come from plain runs; peak memory from one more
+    # run under tracemalloc, whose bookkeeping would distort the timings.
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    def run(trace=False):
+        nonlocal queries
+        with transaction.atomic():
+            args = setup() if setup else ()
+            queries = 0
+            with connection.execute_wrapper(count_queries):
+                if trace:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                operation(*args)
+                elapsed = time.perf_counter() - start
+                peak = 0
+                if trace:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+            transaction.set_rollback(True)
+        return elapsed, queries, peak
+
+    timings = [run() for _ in range(repeat)]
+    _, _, peak = run(trace=True)
+    seconds = [elapsed for elapsed, _, _ in timings]
+    return {
+        'seconds': min(seconds),
+        'median_seconds': statistics.median(seconds),
+        'queries': timings[-1][1],
+        'peak_memory_bytes': peak,
+    }
+
+
+def run_suite(size, fan_out=4, depth=None, versions=1, branches=0, delta=False, repeat=3):
+    # Time every public operation on a synthetic tree. Everything runs in a
+    # transaction that is rolled back, so the suite never leaves rows behind.
+    results = []
+    with transaction.atomic():
+        tree, levels = build_tree(f"benchmark-{size}", size, fan_out=fan_out, depth=depth)
+        root_id, deepest_id = levels[0][0].id, levels[-1][-1].id
+
+        def record(name, operation, setup=None):
+            result = measure(operation, setup=setup, repeat=repeat)
+            results.append({'operation': name, 'nodes': size, **result})
+
+        record('create_tag', lambda: tree.create_tag(name=f"benchmark-{size}-tag"))
+        tag_name = build_history(tree, versions=versions, branches=branches, delta=delta)
+        record('create_new_tree_version_from_tag', lambda: tree.create_new_tree_version_from_tag(tag_name))
+        record(
+            'create_new_tree_version_from_tag[delta]',
+            lambda: tree.create_new_tree_version_from_tag(tag_name, delta=True),
+        )
+
+        tagged_id = tree.tags.get(name=tag_name).version_id
+
+        def fresh_version():
+            # A new instance per run, so no per-instance index is reused
+            return (TreeVersion.objects.get(pk=tagged_id),)
+
+        record(
+            'add_edge',
+            lambda version: version.add_edge(root_id, deepest_id, data={}),
+            setup=lambda: (tree.create_new_tree_version_from_tag(tag_name, delta=delta),),
+        )
+        record('get_root_nodes', lambda version: list(version.get_root_nodes()), setup=fresh_version)
+        record(
+            'get_nodes_at_depth',
+            lambda version: version.get_nodes_at_depth(len(levels) // 2),
+            setup=fresh_version,
+        )
+        record('find_path', lambda version: version.find_path(root_id, deepest_id), setup=fresh_version)
+
+        def traverse(version):
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                version.traverse_tree(root_id)
+
+        record('traverse_tree', traverse, setup=fresh_version)
+        transaction.set_rollback(True)
+    return results
+
+
+def compare(results, baseline, threshold=1.25):
+    # Operations that got slower than `threshold` times the baseline, or that
+    # now run more queries. Returns (result, baseline result) pairs.
+    previous = {(result['operation'], result['nodes']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['operation'], result['nodes']))
+        if before is None:
+            continue
+        if result['seconds'] > before['seconds'] * threshold or result['queries'] > before['queries']:
+            regressions.append((result, before))
+    return regressions
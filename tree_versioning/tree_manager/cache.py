@@ -0,0 +1,362 @@
+import pickle
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .adjacency import TreeAdjacency
+
+# Settings, all optional:
+#
+# TREE_VERSION_CACHE = {
+#     'MAX_BYTES': 64 * 1024 * 1024,  # size bound of the process-local LRU
+#     'BACKEND': 'default',           # Django cache alias shared by workers
+#     'TIMEOUT': None,                # expiry of entries in the shared cache
+# }
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+KEY_PREFIX = 'tree_manager'
+
+
+class MaterializedVersion:
+    # Every node and edge of a version, with data, held in plain Python
+    # structures. The read methods mirror TreeVersion's but never touch the
+    # database; the returned instances share data with the cache and must be
+    # treated as read-only.
+
+    def __init__(self, version_id, nodes, edges):
+        self.version_id = version_id
+        # node_id -> (node_version_id, data)
+        self.nodes = nodes
+        # edge_version_id -> (edge_id, source_node_id, target_node_id, data)
+        self.edges = edges
+        self._index = None
+
+    def __getstate__(self):
+        # The adjacency index is cheap to rebuild, so keep it out of pickles
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = TreeAdjacency(
+                self.nodes,
+                ((edge_version_id, source_id, target_id)
+                 for edge_version_id, (_, source_id, target_id, _) in self.edges.items()),
+            )
+        return self._index
+
+    def _node_version(self, node_id):
+        from .models import TreeNodeVersion
+
+        node_version_id, data = self.nodes[node_id]
+        return TreeNodeVersion(id=node_version_id, node_id=node_id, version_id=self.version_id, data=data)
+
+    def _edge_version(self, edge_version_id):
+        from .models import TreeEdgeVersion
+
+        edge_id, source_id, target_id, data = self.edges[edge_version_id]
+        return TreeEdgeVersion(
+            id=edge_version_id,
+            edge_id=edge_id,
+            version_id=self.version_id,
+            source_node_id=source_id,
+            target_node_id=target_id,
+            data=data,
+        )
+
+    def get_node(self, node_id):
+        if node_id not in self.nodes:
+            raise ValueError(f"Node with id {node_id} does not exist in this version.")
+        return self._node_version(node_id)
+
+    def get_root_nodes(self):
+        return [self._node_version(node_id) for node_id in self.index.get_roots()]
+
+    def get_child_nodes(self, node_id):
+        return [self._node_version(child_id) for child_id in self.index.get_children(node_id)]
+
+    def get_parent_nodes(self, node_id):
+        return [self._node_version(parent_id) for parent_id in self.index.get_parents(node_id)]
+
+    def get_node_edges(self, node_id):
+        return [
+            self._edge_version(edge_version_id)
+            for edge_version_id, (_, source_id, target_id, _) in self.edges.items()
+            if node_id in (source_id, target_id)
+        ]
+
+    def get_nodes_at_depth(self, depth):
+        return [self._node_version(node_id) for node_id in self.index.nodes_at_depth(depth)]
+
+    def find_path(self, start_node_id, end_node_id):
+        path = self.index.find_path(start_node_id, end_node_id)
+        if path is None:
+            return None
+        return [
+            (node_id, self._edge_version(edge_version_id) if edge_version_id is not None else None)
+            for node_id, edge_version_id in path
+        ]
+
+
+class VersionCache:
+    # Two-level cache of tag lookups, materialized tagged versions and the
+    # list of indexed paths: a size-bounded LRU in this process, optionally
+    # backed by a Django cache shared between workers.
+    #
+    # Entries are never updated in place. Each one records the revision of
+    # every version/tag it was built from, and invalidation just bumps those
+    # revisions. With a shared backend the revisions live there, so stale
+    # entries are detected on read in every worker. Without one the counters
+    # only see changes made by this process, so version entries also record
+    # the revision and archive_path of their versions' rows and cost one
+    # query to check, and tag lookups and indexed paths are not cached at all.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._revisions = {}
+
+    @property
+    def _options(self):
+        return getattr(settings, 'TREE_VERSION_CACHE', {})
+
+    @property
+    def max_bytes(self):
+        return self._options.get('MAX_BYTES', DEFAULT_MAX_BYTES)
+
+    @property
+    def _shared(self):
+        alias = self._options.get('BACKEND')
+        return caches[alias] if alias else None
+
+    # Revisions
+
+    def _current_revisions(self, keys):
+        shared = self._shared
+        if shared is not None:
+            stored = shared.get_many([f'{KEY_PREFIX}:revision:{key}' for key in keys])
+            return {key: stored.get(f'{KEY_PREFIX}:revision:{key}', 0) for key in keys}
+        with self._lock:
+            current = {key: self._revisions.get(key, 0) for key in keys}
+        version_ids = [int(key.split(':', 1)[1]) for key in keys if key.startswith('version:')]
+        if version_ids:
+            from .models import TreeVersion
+
+            rows = {
+                version_id: (revision, archive_path)
+                for version_id, revision, archive_path in TreeVersion.objects.filter(id__in=version_ids).values_list(
+                    'id', 'revision', 'archive_path'
+                )
+            }
+            for version_id in version_ids:
+                key = f'version:{version_id}'
+                current[key] = (current[key], rows.get(version_id))
+        return current
+
+    def _bump(self, key):
+        shared = self._shared
+        if shared is not None:
+            revision_key = f'{KEY_PREFIX}:revision:{key}'
+            # add() is a no-op if the key exists, so incr() always has a value
+            shared.add(revision_key, 0, timeout=None)
+            shared.incr(revision_key)
+        with self._lock:
+            self._revisions[key] = self._revisions.get(key, 0) + 1
+            self._drop(key)
+
+    def _invalidate(self, key):
+        # Bump now so this process stops serving the entry, and again on
+        # commit so no worker keeps an entry built while the change was not
+        # yet visible to it
+        self._bump(key)
+        transaction.on_commit(lambda: self._bump(key))
+
+    def invalidate_version(self, version_id):
+        self._invalidate(f'version:{version_id}')
+
+    def invalidate_tag(self, tag_name):
+        self._invalidate(f'tag:{tag_name}')
+
+    def invalidate_indexed_paths(self):
+        self._invalidate('indexed-paths')
+
+    # Storage
+
+    def _drop(self, key):
+        # Called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        shared = self._shared
+        if entry is None and shared is not None:
+            stored = shared.get(f'{KEY_PREFIX}:entry:{key}')
+            if stored is not None:
+                entry = (*stored, len(pickle.dumps(stored[1], pickle.HIGHEST_PROTOCOL)))
+                self._store_local(key, entry)
+        if entry is None:
+            return None
+        revisions, value, _ = entry
+        if self._current_revisions(list(revisions)) != revisions:
+            with self._lock:
+                self._drop(key)
+            return None
+        return value
+
+    def _store_local(self, key, entry):
+        size = entry[2]
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _put(self, key, revisions, value):
+        # Rows read inside a transaction may never be committed, so only
+        # cache what was read outside of one
+        if transaction.get_connection().in_atomic_block:
+            return
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._store_local(key, (revisions, value, len(payload)))
+        shared = self._shared
+        if shared is not None:
+            shared.set(f'{KEY_PREFIX}:entry:{key}', (revisions, value), self._options.get('TIMEOUT'))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    # Lookups
+
+    def get_version_by_tag(self, tag_name):
+        # The tagged TreeVersion, with its tag attached, without touching the
+        # database when the lookup is cached. Raises Tag.DoesNotExist.
+        from .models import Tag, TreeVersion
+
+        key = f'tag:{tag_name}'
+        # Without a shared backend, checking a cached lookup against the
+        # database would cost as much as the lookup itself
+        shared = self._shared is not None
+        cached = self._get(key) if shared else None
+        hit = cached is not None
+        if cached is None:
+            revisions = self._current_revisions([key]) if shared else None
+            tag = Tag.objects.select_related('version').get(name=tag_name)
+            cached = (
+                [getattr(tag.version, field.attname) for field in TreeVersion._meta.concrete_fields],
+                [getattr(tag, field.attname) for field in Tag._meta.concrete_fields],
+            )
+            if shared:
+                revisions.update(self._current_revisions([f'version:{tag.version_id}']))
+                self._put(key, revisions, cached)
+        version_values, tag_values = cached
+        version = TreeVersion.from_db(
+            TreeVersion.objects.db, [field.attname for field in TreeVersion._meta.concrete_fields], version_values
+        )
+        version.tag = Tag.from_db(
+            Tag.objects.db, [field.attname for field in Tag._meta.concrete_fields], tag_values
+        )
+        version._archive_path_cached = hit
+        return version
+
+    def indexed_paths(self):
+        # Every path indexed by any tree, which PayloadAttribute.extract reads
+        # for each payload it stores. Only cached with a shared backend, whose
+        # revision sees changes from every process. A list read inside a
+        # transaction is only cached once that commits, as the transaction may
+        # roll back a change to the indexed paths.
+        from .models import IndexedPath
+
+        if self._shared is None:
+            return sorted(set(IndexedPath.objects.values_list('path', flat=True)))
+        key = 'indexed-paths'
+        cached = self._get(key)
+        if cached is None:
+            revisions = self._current_revisions([key])
+            cached = sorted(set(IndexedPath.objects.values_list('path', flat=True)))
+            if transaction.get_connection().in_atomic_block:
+                transaction.on_commit(lambda: self._put(key, revisions, cached))
+            else:
+                self._put(key, revisions, cached)
+        return cached
+
+    def materialize(self, version):
+        key = f'version:{version.id}'
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        if version._current_archive_path():
+            # Archived since its tag lookup was cached
+            return version.materialize()
+        chain = version.version_chain()
+        revisions = self._current_revisions([f'version:{version_id}' for version_id in chain])
+        materialized = MaterializedVersion(
+            version.id,
+            {
+                node_id: (node_version_id, data)
+                for node_version_id, node_id, data in version.effective_node_versions().values_list(
+                    'id', 'node_id', 'payload__data'
+                ).iterator()
+            },
+            {
+                edge_version_id: (edge_id, source_id, target_id, data)
+                for edge_version_id, edge_id, source_id, target_id, data in version.effective_edge_versions().values_list(
+                    'id', 'edge_id', 'source_node_id', 'target_node_id', 'payload__data'
+                ).iterator()
+            },
+        )
+        # Only tagged versions are meant to be stable enough to cache
+        if hasattr(version, 'tag'):
+            self._put(key, revisions, materialized)
+        return materialized
+
+
+version_cache = VersionCache()
+
+
+def _tag_changed(sender, instance, **kwargs):
+    version_cache.invalidate_tag(instance.name)
+    version_cache.invalidate_version(instance.version_id)
+
+
+def _version_changed(sender, instance, **kwargs):
+    version_cache.invalidate_version(instance.id)
+
+
+def _indexed_path_changed(sender, instance, **kwargs):
+    version_cache.invalidate_indexed_paths()
+
+
+post_save.connect(_tag_changed, sender='tree_manager.Tag', dispatch_uid='tree_manager_cache_tag_saved')
+post_delete.connect(_tag_changed, sender='tree_manager.Tag', dispatch_uid='tree_manager_cache_tag_deleted')
+post_save.connect(_version_changed, sender='tree_manager.TreeVersion', dispatch_uid='tree_manager_cache_version_saved')
+post_delete.connect(_version_changed, sender='tree_manager.TreeVersion', dispatch_uid='tree_manager_cache_version_deleted')
+post_save.connect(
+    _indexed_path_changed, sender='tree_manager.IndexedPath', dispatch_uid='tree_manager_cache_indexed_path_saved'
+)
+post_delete.connect(
+    _indexed_path_changed, sender='tree_manager.IndexedPath', dispatch_uid='tree_manager_cache_indexed_path_deleted'
+)
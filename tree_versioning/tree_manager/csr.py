@@ -0,0 +1,167 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CSRGraph:
+    # A version's structure in compressed sparse row form, for analytics
+    # over whole versions. Nodes are numbered 0..n-1 in node id order
+    # (node_ids maps the dense index back to the node id) and the children
+    # of node i are targets[offsets[i]:offsets[i + 1]]. Everything is kept in
+    # typed arrays, 8 bytes per node and per edge, instead of model instances.
+    #
+    # Depths and subtree sizes follow the breadth-first spanning tree from
+    # the roots, like iter_nodes(): a node reachable along several paths is
+    # counted once, below the parent that reaches it first. Nodes that no
+    # root reaches (only possible with cycles) have depth -1.
+
+    def __init__(self, node_ids, offsets, targets):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.targets = targets
+        self._spanning_tree = None
+
+    @classmethod
+    def from_version(cls, version, chunk_size=10000):
+        # Stream the version's node ids and edge endpoints into arrays. Edges
+        # pointing at nodes outside the version are left out, as in the
+        # adjacency index.
+        node_ids = array('q', version.effective_node_versions().order_by('node_id').values_list(
+            'node_id', flat=True
+        ).iterator(chunk_size=chunk_size))
+        sources, targets = array('q'), array('q')
+        for source_id, target_id in version.effective_edge_versions().values_list(
+            'source_node_id', 'target_node_id'
+        ).iterator(chunk_size=chunk_size):
+            source = _index(node_ids, source_id)
+            target = _index(node_ids, target_id)
+            if source >= 0 and target >= 0:
+                sources.append(source)
+                targets.append(target)
+        return cls.from_edges(node_ids, sources, targets)
+
+    @classmethod
+    def from_edges(cls, node_ids, sources, targets):
+        # Counting sort of (source, target) dense index pairs into rows
+        offsets = array('q', bytes(8 * (len(node_ids) + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for i in range(len(node_ids)):
+            offsets[i + 1] += offsets[i]
+        row_targets = array('q', bytes(8 * len(targets)))
+        positions = offsets[:-1]
+        for source, target in zip(sources, targets):
+            row_targets[positions[source]] = target
+            positions[source] += 1
+        return cls(node_ids, offsets, row_targets)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def nbytes(self):
+        return sum(len(values) * values.itemsize for values in (self.node_ids, self.offsets, self.targets))
+
+    def index_of(self, node_id):
+        index = _index(self.node_ids, node_id)
+        if index < 0:
+            raise ValueError(f"Node with id {node_id} does not exist in this version.")
+        return index
+
+    def children(self, node_id):
+        index = self.index_of(node_id)
+        return [self.node_ids[child] for child in self.targets[self.offsets[index]:self.offsets[index + 1]]]
+
+    def out_degrees(self):
+        offsets = self.offsets
+        return array('q', (offsets[i + 1] - offsets[i] for i in range(len(self.node_ids))))
+
+    def in_degrees(self):
+        degrees = array('q', bytes(8 * len(self.node_ids)))
+        for target in self.targets:
+            degrees[target] += 1
+        return degrees
+
+    def roots(self):
+        return [self.node_ids[i] for i, degree in enumerate(self.in_degrees()) if not degree]
+
+    def leaves(self):
+        return [self.node_ids[i] for i, degree in enumerate(self.out_degrees()) if not degree]
+
+    def _spanning(self):
+        # (order, parents, depths): dense indexes in breadth-first order from
+        # the roots, and the spanning tree parent (-1 for roots) and depth of
+        # every node. Walked one level at a time over the arrays.
+        if self._spanning_tree is None:
+            count = len(self.node_ids)
+            depths = array('q', [-1]) * count
+            parents = array('q', [-1]) * count
+            order = array('q')
+            offsets, targets = self.offsets, self.targets
+            frontier = [i for i, degree in enumerate(self.in_degrees()) if not degree]
+            for root in frontier:
+                depths[root] = 0
+            depth = 0
+            while frontier:
+                order.extend(frontier)
+                depth += 1
+                next_frontier = []
+                for node in frontier:
+                    for child in targets[offsets[node]:offsets[node + 1]]:
+                        if depths[child] < 0:
+                            depths[child] = depth
+                            parents[child] = node
+                            next_frontier.append(child)
+                frontier = next_frontier
+            self._spanning_tree = (order, parents, depths)
+        return self._spanning_tree
+
+    def depths(self):
+        # Depth of every node by dense index
+        return self._spanning()[2]
+
+    def subtree_sizes(self):
+        # Nodes in the subtree of every node (itself included) by dense
+        # index, accumulated from the deepest level up
+        order, parents, _ = self._spanning()
+        sizes = array('q', [1]) * len(self.node_ids)
+        for node in reversed(order):
+            parent = parents[node]
+            if parent >= 0:
+                sizes[parent] += sizes[node]
+        return sizes
+
+    def subtree_size(self, node_id):
+        return self.subtree_sizes()[self.index_of(node_id)]
+
+    def depth_histogram(self):
+        # Number of nodes at each depth, starting with the roots
+        counts = Counter(self.depths())
+        counts.pop(-1, None)
+        return [counts[depth] for depth in range(max(counts, default=-1) + 1)]
+
+    def fan_out_histogram(self):
+        # {number of children: number of nodes with that many}
+        return dict(sorted(Counter(self.out_degrees()).items()))
+
+    def as_numpy(self):
+        # Zero-copy NumPy views of the arrays, for vectorized analytics
+        if numpy is None:
+            raise ImportError("NumPy is required for as_numpy().")
+        return {
+            name: numpy.frombuffer(getattr(self, name), dtype=numpy.int64)
+            for name in ('node_ids', 'offsets', 'targets')
+        }
+
+
+def _index(sorted_ids, node_id):
+    # Dense index of node_id in a sorted id array, or -1
+    index = bisect_left(sorted_ids, node_id)
+    if index < len(sorted_ids) and sorted_ids[index] == node_id:
+        return index
+    return -1
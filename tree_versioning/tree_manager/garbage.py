@@ -0,0 +1,142 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils.timezone import now
+
+from . import search
+from .models import (
+    MAX_IN_IDS,
+    PayloadAttribute,
+    PayloadBlob,
+    SearchDocument,
+    TreeClosure,
+    TreeEdge,
+    TreeEdgeVersion,
+    TreeNode,
+    TreeNodeVersion,
+    TreeVersion,
+)
+
+DEFAULT_RETENTION = timedelta(days=7)
+DEFAULT_BATCH_SIZE = 1000
+
+
+def garbage_versions(cutoff):
+    # Ids of versions nothing needs any more: untagged, created before
+    # `cutoff`, and not an ancestor of a version that is kept (delta versions
+    # read through their ancestors, and merges walk parent_version)
+    parents = {}
+    kept = []
+    for version_id, parent_id, tagged, created_at in TreeVersion.objects.values_list(
+        'id', 'parent_version_id', 'tag__id', 'created_at'
+    ).iterator():
+        parents[version_id] = parent_id
+        if tagged is not None or created_at >= cutoff:
+            kept.append(version_id)
+
+    reachable = set()
+    for version_id in kept:
+        while version_id is not None and version_id not in reachable:
+            reachable.add(version_id)
+            version_id = parents.get(version_id)
+    return sorted(parents.keys() - reachable)
+
+
+def _delete_in_batches(queryset, batch_size, dry_run):
+    # Delete the rows of `queryset` a batch at a time, each batch in its own
+    # short transaction. The queryset's conditions are checked again by the
+    # DELETE itself, so rows that stopped being garbage meanwhile are kept.
+    # The models deleted this way have no signal receivers and nothing else
+    # referencing them by then, so the raw delete skips Django's collector.
+    if dry_run:
+        return queryset.count()
+    deleted = 0
+    last_id = None
+    while True:
+        with transaction.atomic(using=queryset.db):
+            remaining = queryset if last_id is None else queryset.filter(pk__gt=last_id)
+            ids = list(remaining.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            last_id = ids[-1]
+            for start in range(0, len(ids), MAX_IN_IDS):
+                batch = queryset.filter(pk__in=ids[start:start + MAX_IN_IDS])
+                deleted += batch._raw_delete(batch.db)
+
+
+def collect_garbage(retention=DEFAULT_RETENTION, batch_size=DEFAULT_BATCH_SIZE, dry_run=False, payloads=False):
+    # Delete unreachable versions with their rows, then nodes and edges that
+    # no version references, and with `payloads` also unreferenced payload
+    # blobs. Only rows older than `retention` are considered, so work in
+    # progress is never collected. Returns the number of rows deleted per
+    # kind. With `dry_run` nothing is deleted, and nodes, edges and payloads
+    # are only counted if they are unreferenced already, not if they would
+    # become so once the garbage versions are gone.
+    cutoff = now() - retention
+    counts = dict.fromkeys(
+        ['versions', 'node_versions', 'edge_versions', 'closure_rows', 'edges', 'nodes', 'payloads'], 0
+    )
+
+    version_ids = garbage_versions(cutoff)
+    for start in range(0, len(version_ids), MAX_IN_IDS):
+        # Skip versions tagged since they were found. A version can still be
+        # tagged while its rows are being deleted, so every row batch checks
+        # the tag and the retention cutoff again inside its transaction.
+        batch = list(TreeVersion.objects.filter(
+            id__in=version_ids[start:start + MAX_IN_IDS], tag__isnull=True, created_at__lt=cutoff
+        ).values_list('id', flat=True))
+        for key, model in (
+            ('closure_rows', TreeClosure),
+            ('node_versions', TreeNodeVersion),
+            ('edge_versions', TreeEdgeVersion),
+        ):
+            rows = model.objects.filter(
+                version_id__in=batch, version__tag__isnull=True, version__created_at__lt=cutoff
+            )
+            counts[key] += _delete_in_batches(rows, batch_size, dry_run)
+        versions = TreeVersion.objects.filter(id__in=batch, tag__isnull=True, created_at__lt=cutoff)
+        if dry_run:
+            counts['versions'] += versions.count()
+        else:
+            # Through the ORM, so the version cache hears about the deletions
+            with transaction.atomic():
+                counts['versions'] += versions.delete()[1].get(TreeVersion._meta.label, 0)
+
+    edges = TreeEdge.objects.filter(created_at__lt=cutoff).exclude(
+        Exists(TreeEdgeVersion.objects.filter(edge_id=OuterRef('pk')))
+    )
+    counts['edges'] = _delete_in_batches(edges, batch_size, dry_run)
+
+    nodes = TreeNode.objects.filter(created_at__lt=cutoff).exclude(
+        Exists(TreeNodeVersion.objects.filter(node_id=OuterRef('pk')))
+    ).exclude(
+        Exists(TreeEdge.objects.filter(incoming_node_id=OuterRef('pk')))
+    ).exclude(
+        Exists(TreeEdge.objects.filter(outgoing_node_id=OuterRef('pk')))
+    )
+    counts['nodes'] = _delete_in_batches(nodes, batch_size, dry_run)
+
+    if payloads:
+        # Each batch checks every referencing table, and a blob could be
+        # deleted just before a concurrent write refers to it again, so this
+        # is opt-in and best run when writes are quiet
+        blobs = PayloadBlob.objects.exclude(hash__in=TreeNode.objects.values('payload_id')).exclude(
+            hash__in=TreeEdge.objects.values('payload_id')
+        ).exclude(
+            hash__in=TreeNodeVersion.objects.values('payload_id')
+        ).exclude(
+            hash__in=TreeEdgeVersion.objects.values('payload_id')
+        )
+        # Attributes and search documents first: the raw deletes skip the
+        # cascade from the blobs
+        _delete_in_batches(PayloadAttribute.objects.filter(payload__in=blobs), batch_size, dry_run)
+        if not dry_run:
+            documents = SearchDocument.objects.filter(payload__in=blobs)
+            while True:
+                with transaction.atomic():
+                    if not search.unindex(documents.order_by('id')[:batch_size]):
+                        break
+        counts['payloads'] = _delete_in_batches(blobs, batch_size, dry_run)
+
+    return counts
@@ -0,0 +1,239 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import Signal
+
+# Sent with `stats` (an OperationStats) after every instrumented call made
+# while instrumentation is active, i.e. inside record_operations() or when
+# this signal has receivers. The sender is the model class, or None for
+# blocks measured with instrument() (ServerTimingMiddleware's 'request').
+operation_finished = Signal()
+
+# Operations in progress in the current thread or task, outermost first
+_active = ContextVar('tree_manager_active_operations', default=())
+# Lists collecting finished operations for record_operations() blocks
+_recorders = ContextVar('tree_manager_operation_recorders', default=())
+
+
+class OperationStats:
+    # What one call cost. SQL figures include the queries of nested
+    # instrumented calls; querysets returned unevaluated are counted where
+    # they are evaluated, not by the call that built them.
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.wall_time = 0.0
+
+    def __repr__(self):
+        return (
+            f"<OperationStats {self.name}: {self.queries} queries, {self.rows} rows, "
+            f"{self.sql_time * 1000:.1f}ms SQL, {self.python_time * 1000:.1f}ms Python>"
+        )
+
+    @property
+    def python_time(self):
+        return max(self.wall_time - self.sql_time, 0.0)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'queries': self.queries,
+            'sql_time': self.sql_time,
+            'rows': self.rows,
+            'python_time': self.python_time,
+            'wall_time': self.wall_time,
+        }
+
+
+class _RowCountingCursor:
+    # Proxy of a DB-API cursor counting the rows fetched through it. Rows
+    # are often produced while they are fetched (SQLite steps the statement
+    # on each fetch), so the fetches are timed as SQL too.
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        rows = iter(self._cursor)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                _add_fetched(0, time.perf_counter() - start)
+                return
+            _add_fetched(1, time.perf_counter() - start)
+            yield row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        _add_fetched(int(row is not None), time.perf_counter() - start)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        _add_fetched(len(rows), time.perf_counter() - start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        _add_fetched(len(rows), time.perf_counter() - start)
+        return rows
+
+
+def _add_fetched(count, elapsed):
+    for stats in _active.get():
+        stats.rows += count
+        stats.sql_time += elapsed
+
+
+def _record_query(execute, sql, params, many, context):
+    # Execute wrapper installed on every connection; a no-op unless an
+    # instrumented operation is running in this thread or task
+    active = _active.get()
+    if not active:
+        return execute(sql, params, many, context)
+    wrapper = context['cursor']
+    if not isinstance(wrapper.cursor, _RowCountingCursor):
+        wrapper.cursor = _RowCountingCursor(wrapper.cursor)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        for stats in active:
+            stats.queries += 1
+            stats.sql_time += elapsed
+
+
+def _install(sender=None, connection=None, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(_install, dispatch_uid='tree_manager_instrumentation')
+for _connection in connections.all(initialized_only=True):
+    _install(connection=_connection)
+
+
+def is_active():
+    return bool(_active.get()) or bool(_recorders.get()) or operation_finished.has_listeners()
+
+
+@contextmanager
+def instrument(name, sender=None):
+    # Measure the enclosed block as one operation. Yields its OperationStats,
+    # which is complete once the block exits.
+    stats = OperationStats(name)
+    token = _active.set((*_active.get(), stats))
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall_time = time.perf_counter() - start
+        _active.reset(token)
+        for recorder in _recorders.get():
+            recorder.append(stats)
+        operation_finished.send(sender=sender, stats=stats)
+
+
+@contextmanager
+def record_operations():
+    # Collect the OperationStats of every instrumented call made inside the
+    # block, in the order they finished (nested calls before their callers)
+    recorded = []
+    token = _recorders.set((*_recorders.get(), recorded))
+    try:
+        yield recorded
+    finally:
+        _recorders.reset(token)
+
+
+def _owner(args):
+    # The model class of a method or classmethod call
+    if args:
+        return args[0] if isinstance(args[0], type) else type(args[0])
+    return None
+
+
+def instrumented(func):
+    # Decorator for model methods. Calls are measured only while
+    # instrumentation is active, so it costs one check otherwise.
+    name = func.__qualname__
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not is_active():
+                return await func(*args, **kwargs)
+            with instrument(name, sender=_owner(args)):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_active():
+            return func(*args, **kwargs)
+        with instrument(name, sender=_owner(args)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class ServerTimingMiddleware:
+    # Adds a Server-Timing header with the request's SQL and Python time and
+    # one entry per instrumented operation, e.g.
+    #
+    #   Server-Timing: db;dur=4.1;desc="12 queries, 230 rows", app;dur=2.3,
+    #                  TreeVersion.get_node;dur=1.2;desc="1 call, 2 queries"
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with record_operations() as recorded, instrument('request') as total:
+            response = self.get_response(request)
+        return self._add_header(response, total, recorded)
+
+    async def __acall__(self, request):
+        with record_operations() as recorded, instrument('request') as total:
+            response = await self.get_response(request)
+        return self._add_header(response, total, recorded)
+
+    def _add_header(self, response, total, recorded):
+        metrics = [
+            f'db;dur={total.sql_time * 1000:.1f};desc="{total.queries} queries, {total.rows} rows"',
+            f'app;dur={total.python_time * 1000:.1f}',
+        ]
+        operations = {}
+        for stats in recorded:
+            if stats is total:
+                continue
+            calls, wall_time, queries = operations.get(stats.name, (0, 0.0, 0))
+            operations[stats.name] = (calls + 1, wall_time + stats.wall_time, queries + stats.queries)
+        for name, (calls, wall_time, queries) in operations.items():
+            metrics.append(
+                f'{name};dur={wall_time * 1000:.1f};desc="{calls} call{"s" if calls != 1 else ""}, {queries} queries"'
+            )
+        response.headers['Server-Timing'] = ', '.join(metrics)
+        return response
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from django.utils.timezone import now
+
+from tree_manager.models import Tag, Tree
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the rows of tagged versions into compressed archive files, leaving stubs that are "
+        "read from the files or rehydrated on demand."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('tags', nargs='*')
+        parser.add_argument(
+            '--older-than-days', type=float,
+            help="Also archive every version whose tag is older than this many days.",
+        )
+        parser.add_argument('--directory', help="Directory for the archive files (defaults to TREE_ARCHIVE_DIR).")
+        parser.add_argument('--rehydrate', action='store_true', help="Bring the given tags back into the database.")
+
+    def handle(self, *args, **options):
+        tag_names = list(options['tags'])
+        if options['older_than_days'] is not None:
+            cutoff = now() - timedelta(days=options['older_than_days'])
+            tag_names.extend(Tag.objects.filter(
+                created_at__lt=cutoff, version__archive_path__isnull=True
+            ).exclude(name__in=tag_names).order_by('created_at').values_list('name', flat=True))
+        if not tag_names:
+            raise CommandError("Give tag names or --older-than-days.")
+
+        # A version that cannot be archived (e.g. one delta versions read
+        # through) is reported and skipped
+        failed = 0
+        for tag_name in tag_names:
+            try:
+                version = Tree.get_by_tag(tag_name)
+                if options['rehydrate']:
+                    version.rehydrate()
+                    self.stdout.write(f"Rehydrated {tag_name}.")
+                else:
+                    path = version.archive(directory=options['directory'])
+                    self.stdout.write(f"Archived {tag_name} to {path}.")
+            except (ValueError, DatabaseError) as e:
+                self.stderr.write(f"{tag_name}: {e}")
+                failed += 1
+        if failed:
+            raise CommandError(f"{failed} version(s) could not be processed.")
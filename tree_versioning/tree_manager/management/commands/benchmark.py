@@ -0,0 +1,82 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.timezone import now
+
+from tree_manager.benchmarks import compare, run_suite
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the public versioning operations on synthetic trees and report wall time, "
+        "query count and peak memory as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000])
+        parser.add_argument('--fan-out', type=int, default=4)
+        parser.add_argument('--depth', type=int, help="Maximum depth of the generated trees.")
+        parser.add_argument('--versions', type=int, default=2, help="Tagged versions created before branching.")
+        parser.add_argument('--branches', type=int, default=0, help="Extra untagged branches of the last tag.")
+        parser.add_argument('--delta', action='store_true', help="Create versions and branches as delta versions.")
+        parser.add_argument('--repeat', type=int, default=3, help="Timed runs per operation (the fastest is kept).")
+        parser.add_argument('--output', help="File to write the JSON report to (defaults to stdout).")
+        parser.add_argument('--baseline', help="Earlier JSON report to compare against.")
+        parser.add_argument(
+            '--threshold', type=float, default=1.25,
+            help="Slowdown factor over the baseline reported as a regression.",
+        )
+
+    def handle(self, *args, **options):
+        parameters = {
+            name: options[name]
+            for name in ('fan_out', 'depth', 'versions', 'branches', 'delta', 'repeat')
+        }
+        results = []
+        for size in options['sizes']:
+            results.extend(run_suite(size, **parameters))
+            self.stderr.write(f"Benchmarked {size} nodes.")
+
+        report = {
+            'environment': {
+                'timestamp': now().isoformat(),
+                'commit': self._commit(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'parameters': {'sizes': options['sizes'], **parameters},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2) + '\n'
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                stream.write(output)
+        else:
+            self.stdout.write(output, ending='')
+
+        if options['baseline']:
+            with open(options['baseline']) as stream:
+                baseline = json.load(stream)['results']
+            regressions = compare(results, baseline, threshold=options['threshold'])
+            for result, before in regressions:
+                self.stderr.write(
+                    f"{result['operation']} ({result['nodes']} nodes): "
+                    f"{before['seconds']:.4f}s -> {result['seconds']:.4f}s, "
+                    f"{before['queries']} -> {result['queries']} queries"
+                )
+            if regressions:
+                raise CommandError(f"{len(regressions)} operation(s) regressed against {options['baseline']}.")
+
+    def _commit(self):
+        # Commit of the working tree, so reports can be matched to code
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
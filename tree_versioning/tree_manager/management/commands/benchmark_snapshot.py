@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tree_manager.benchmarks import build_tree, measure
+
+
+class Command(BaseCommand):
+    help = "Time create_tag and create_new_tree_version_from_tag on synthetic trees."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+        parser.add_argument('--fan-out', type=int, default=4)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'nodes':>8} {'operation':<34} {'seconds':>9} {'queries':>8} {'peak MiB':>9}")
+        for size in options['sizes']:
+            # Everything runs in a transaction that is rolled back afterwards,
+            # so the benchmark never leaves rows behind
+            with transaction.atomic():
+                tree, _ = build_tree(f"benchmark-{size}", size, fan_out=options['fan_out'])
+                self._measure(size, 'create_tag', lambda: tree.create_tag(name=f"bench-{size}"))
+                tree.create_tag(name=f"bench-{size}")
+                self._measure(
+                    size,
+                    'create_new_tree_version_from_tag',
+                    lambda: tree.create_new_tree_version_from_tag(f"bench-{size}"),
+                )
+                transaction.set_rollback(True)
+
+    def _measure(self, size, name, operation):
+        result = measure(operation, repeat=1)
+        self.stdout.write(
+            f"{size:>8} {name:<34} {result['seconds']:>9.3f} {result['queries']:>8} "
+            f"{result['peak_memory_bytes'] / 2 ** 20:>9.1f}"
+        )
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from tree_manager.garbage import DEFAULT_BATCH_SIZE, DEFAULT_RETENTION, collect_garbage
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete untagged versions that nothing depends on, and nodes and edges no version "
+        "references, in small batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention-days', type=float, default=DEFAULT_RETENTION.days,
+            help="Only collect rows older than this many days.",
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--payloads', action='store_true', help="Also delete unreferenced payload blobs.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        counts = collect_garbage(
+            retention=timedelta(days=options['retention_days']),
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            payloads=options['payloads'],
+        )
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        for kind, count in counts.items():
+            self.stdout.write(f"{verb} {count} {kind.replace('_', ' ')}.")
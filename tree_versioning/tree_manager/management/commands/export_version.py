@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tree_manager.models import Tree
+from tree_manager.serialization import DEFAULT_CHUNK_SIZE, export_version
+
+
+class Command(BaseCommand):
+    help = "Stream every node and edge of a tagged version as newline-delimited JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('tag')
+        parser.add_argument('--output', help="File to write to (defaults to stdout).")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            version = Tree.get_by_tag(options['tag'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                export_version(version, stream, chunk_size=options['chunk_size'])
+        else:
+            export_version(version, self.stdout, chunk_size=options['chunk_size'])
@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tree_manager.serialization import DEFAULT_CHUNK_SIZE, import_version
+
+
+class Command(BaseCommand):
+    help = "Rebuild a tree and a tagged version from a newline-delimited JSON export."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Export file, or - for stdin.")
+        parser.add_argument('--tree-name', help="Name of the new tree (defaults to the exported name).")
+        parser.add_argument('--tag', help="Tag for the imported version (defaults to the exported tag).")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        stream = sys.stdin if options['input'] == '-' else open(options['input'])
+        try:
+            tag = import_version(
+                stream,
+                tree_name=options['tree_name'],
+                tag_name=options['tag'],
+                batch_size=options['batch_size'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(f"Imported tree '{tag.tree.name}' as tag '{tag.name}'.")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tree_manager import search
+from tree_manager.models import TreeVersion
+
+
+class Command(BaseCommand):
+    help = (
+        "Add the payloads of every tagged version to the full-text search index, e.g. versions "
+        "tagged before the index existed. Payloads that are indexed already are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('tags', nargs='*', help="Only index these tags.")
+
+    def handle(self, *args, **options):
+        versions = TreeVersion.objects.select_related('tag').filter(tag__isnull=False).order_by('id')
+        if options['tags']:
+            versions = versions.filter(tag__name__in=options['tags'])
+        indexed = skipped = 0
+        for version in versions.iterator():
+            # Reading an archived version would rehydrate it; it is indexed
+            # when it is rehydrated instead
+            if version.archive_path:
+                skipped += 1
+                continue
+            # One transaction per version, like tagging
+            with transaction.atomic():
+                search.index_version(version)
+            indexed += 1
+        self.stdout.write(f"Indexed {indexed} version(s), skipped {skipped} archived version(s).")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from tree_manager.models import TreeVersion
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the nodes, edges, roots and maximum depth of tagged versions that have no stats yet, "
+        "e.g. versions created before stats were kept."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help="Recount every version, tagged or not, including those with stats.",
+        )
+
+    def handle(self, *args, **options):
+        versions = TreeVersion.objects.select_related('tag').order_by('id')
+        if not options['all']:
+            versions = versions.filter(tag__isnull=False, stats__isnull=True)
+        count = 0
+        for version in versions.iterator():
+            version.refresh_stats()
+            count += 1
+        self.stdout.write(f"Refreshed the stats of {count} version(s).")
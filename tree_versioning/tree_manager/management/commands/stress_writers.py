@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections
+
+from tree_manager.benchmarks import build_tree
+from tree_manager.models import Tag, Tree
+
+
+class Command(BaseCommand):
+    help = (
+        "Run parallel writers that branch, edit and tag one shared tree, then report throughput "
+        "and check that every tag got a complete snapshot. Switches an SQLite database to WAL mode."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--operations', type=int, default=20, help="Tagged branches created per writer.")
+        parser.add_argument('--nodes', type=int, default=1000, help="Size of the shared tree.")
+        parser.add_argument('--delta', action='store_true', help="Branch with delta versions.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            # WAL lets readers proceed while a writer holds the lock. The mode
+            # is stored in the database file, so every writer's connection
+            # uses it and it stays on after the run.
+            with connection.cursor() as cursor:
+                journal_mode = cursor.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            self.stdout.write(f"SQLite journal mode: {journal_mode}")
+
+        tree, levels = build_tree(f"stress-{time.time_ns()}", options['nodes'])
+        root_id = levels[0][0].id
+        base_tag = f"{tree.name}-base"
+        tree.create_tag(name=base_tag)
+        errors = []
+
+        def writer(number):
+            try:
+                for operation in range(options['operations']):
+                    try:
+                        branch = tree.create_new_tree_version_from_tag(base_tag, delta=options['delta'])
+                        node_version = branch.add_node(data={"writer": number, "operation": operation})
+                        branch.add_edge(root_id, node_version.node_id, data={})
+                        tree.create_tag(name=f"{tree.name}-{number}-{operation}", version=branch)
+                    except DatabaseError as error:
+                        errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=writer, args=(number,)) for number in range(options['writers'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        try:
+            tagged = options['writers'] * options['operations'] - len(errors)
+            self.stdout.write(
+                f"{options['writers']} writers, {tagged} tagged branches in {elapsed:.2f}s "
+                f"({tagged / elapsed:.1f}/s), {len(errors)} failed"
+            )
+            for error in errors[:5]:
+                self.stderr.write(f"  {type(error).__name__}: {error}")
+
+            # Tagging also snapshots the nodes other writers created so far,
+            # so a complete snapshot has at least the base tree plus the
+            # branch's own node
+            incomplete = []
+            for tag in Tag.objects.filter(tree=tree).exclude(name=base_tag).select_related('version'):
+                number, operation = map(int, tag.name.rsplit('-', 2)[1:])
+                nodes = tag.version.effective_node_versions()
+                if nodes.count() <= options['nodes'] or not nodes.filter(
+                    payload__data__writer=number, payload__data__operation=operation
+                ).exists():
+                    incomplete.append(tag.name)
+            if incomplete:
+                raise CommandError(f"Tags with incomplete snapshots: {', '.join(incomplete)}")
+            if errors:
+                raise CommandError(f"{len(errors)} writes failed.")
+        finally:
+            Tree.objects.filter(pk=tree.pk).delete()
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-17 02:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treeedgeversion',
+            name='is_removed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='treenodeversion',
+            name='is_removed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='treeversion',
+            name='is_delta',
+            field=models.BooleanField(default=False),
+        ),
+    ]
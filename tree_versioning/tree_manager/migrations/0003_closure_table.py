@@ -0,0 +1,38 @@
+# Generated by Django 5.1.3 on 2026-10-17 02:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0002_delta_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tree',
+            name='maintain_closure',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='treeversion',
+            name='has_closure',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='TreeClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='tree_manager.treenode')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='tree_manager.treenode')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_rows', to='tree_manager.treeversion')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['version', 'descendant', 'depth'], name='tree_manage_version_bcded2_idx')],
+                'constraints': [models.UniqueConstraint(fields=('version', 'ancestor', 'descendant'), name='unique_closure_pair')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-17 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0003_closure_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treeversion',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
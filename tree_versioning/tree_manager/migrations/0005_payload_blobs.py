@@ -0,0 +1,153 @@
+import hashlib
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+CHUNK_SIZE = 2000
+MODEL_NAMES = ('TreeNode', 'TreeEdge', 'TreeNodeVersion', 'TreeEdgeVersion')
+
+
+def payload_hash(data):
+    # Frozen copy of tree_manager.models.payload_hash
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def move_payloads(apps, schema_editor):
+    # Move the data of every node, edge and version row into PayloadBlob,
+    # one transaction per chunk of rows so large tables are not rewritten in
+    # a single transaction
+    PayloadBlob = apps.get_model('tree_manager', 'PayloadBlob')
+    db_alias = schema_editor.connection.alias
+    for model_name in MODEL_NAMES:
+        model = apps.get_model('tree_manager', model_name)
+        last_id = 0
+        while True:
+            rows = list(
+                model.objects.using(db_alias).filter(id__gt=last_id).order_by('id').only('id', 'data')[:CHUNK_SIZE]
+            )
+            if not rows:
+                break
+            blobs = {}
+            for row in rows:
+                row.payload_id = payload_hash(row.data)
+                blobs.setdefault(row.payload_id, PayloadBlob(hash=row.payload_id, data=row.data))
+            with transaction.atomic(using=db_alias):
+                PayloadBlob.objects.using(db_alias).bulk_create(blobs.values(), ignore_conflicts=True)
+                model.objects.using(db_alias).bulk_update(rows, ['payload_id'])
+            last_id = rows[-1].id
+
+
+def restore_payloads(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    for model_name in MODEL_NAMES:
+        model = apps.get_model('tree_manager', model_name)
+        last_id = 0
+        while True:
+            rows = list(
+                model.objects.using(db_alias).filter(id__gt=last_id).order_by('id').select_related('payload')[:CHUNK_SIZE]
+            )
+            if not rows:
+                break
+            for row in rows:
+                row.data = row.payload.data
+            with transaction.atomic(using=db_alias):
+                model.objects.using(db_alias).bulk_update(rows, ['data'])
+            last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('tree_manager', '0004_version_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayloadBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.JSONField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='treenode',
+            name='payload',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.AlterField(
+            model_name='treenode',
+            name='data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='treeedge',
+            name='payload',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.AlterField(
+            model_name='treeedge',
+            name='data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='treenodeversion',
+            name='payload',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.AlterField(
+            model_name='treenodeversion',
+            name='data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='treeedgeversion',
+            name='payload',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.AlterField(
+            model_name='treeedgeversion',
+            name='data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(move_payloads, restore_payloads),
+        migrations.RemoveField(
+            model_name='treenode',
+            name='data',
+        ),
+        migrations.AlterField(
+            model_name='treenode',
+            name='payload',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.RemoveField(
+            model_name='treeedge',
+            name='data',
+        ),
+        migrations.AlterField(
+            model_name='treeedge',
+            name='payload',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.RemoveField(
+            model_name='treenodeversion',
+            name='data',
+        ),
+        migrations.AlterField(
+            model_name='treenodeversion',
+            name='payload',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+        migrations.RemoveField(
+            model_name='treeedgeversion',
+            name='data',
+        ),
+        migrations.AlterField(
+            model_name='treeedgeversion',
+            name='payload',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, db_index=False, related_name='+', to='tree_manager.payloadblob'),
+        ),
+    ]
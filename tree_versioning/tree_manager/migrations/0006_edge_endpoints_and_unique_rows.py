@@ -0,0 +1,88 @@
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+from django.db.models import F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+CHUNK_SIZE = 2000
+
+
+def dedupe_and_copy_endpoints(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    TreeEdge = apps.get_model('tree_manager', 'TreeEdge')
+    TreeEdgeVersion = apps.get_model('tree_manager', 'TreeEdgeVersion')
+    TreeNodeVersion = apps.get_model('tree_manager', 'TreeNodeVersion')
+
+    # add_existing_node/add_existing_edge used to append a second row for a
+    # node or edge already in the version, and tagging a branch appended
+    # another copy of every node and edge taken from TreeNode/TreeEdge. Keep
+    # the latest row written before the version was tagged, which is the
+    # branch's own, and the latest row otherwise.
+    for model, key in ((TreeNodeVersion, 'node'), (TreeEdgeVersion, 'edge')):
+        kept = model.objects.using(db_alias).values('version', key).annotate(
+            kept=Coalesce(
+                Max('id', filter=Q(created_at__lt=F('version__tag__created_at'))),
+                Max('id'),
+            )
+        ).values('kept')
+        model.objects.using(db_alias).exclude(id__in=Subquery(kept)).delete()
+
+    # Copy the endpoints of each edge onto its version rows, one id range
+    # and transaction at a time
+    edge = TreeEdge.objects.using(db_alias).filter(pk=OuterRef('edge_id'))
+    rows = TreeEdgeVersion.objects.using(db_alias)
+    last_id = rows.aggregate(last_id=Max('id'))['last_id'] or 0
+    for start in range(0, last_id, CHUNK_SIZE):
+        with transaction.atomic(using=db_alias):
+            rows.filter(id__gt=start, id__lte=start + CHUNK_SIZE).update(
+                source_node_id=Subquery(edge.values('incoming_node_id')[:1]),
+                target_node_id=Subquery(edge.values('outgoing_node_id')[:1]),
+            )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('tree_manager', '0005_payload_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treeedgeversion',
+            name='source_node',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tree_manager.treenode'),
+        ),
+        migrations.AddField(
+            model_name='treeedgeversion',
+            name='target_node',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tree_manager.treenode'),
+        ),
+        migrations.RunPython(dedupe_and_copy_endpoints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='treeedgeversion',
+            name='source_node',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tree_manager.treenode'),
+        ),
+        migrations.AlterField(
+            model_name='treeedgeversion',
+            name='target_node',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tree_manager.treenode'),
+        ),
+        migrations.AddIndex(
+            model_name='treeedgeversion',
+            index=models.Index(fields=['version', 'source_node'], name='tree_manage_version_c2b646_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='treeedgeversion',
+            index=models.Index(fields=['version', 'target_node'], name='tree_manage_version_cc5ede_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='treeedgeversion',
+            constraint=models.UniqueConstraint(fields=('version', 'edge'), name='unique_edge_per_version'),
+        ),
+        migrations.AddConstraint(
+            model_name='treenodeversion',
+            constraint=models.UniqueConstraint(fields=('version', 'node'), name='unique_node_per_version'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-17 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0006_edge_endpoints_and_unique_rows'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['tree', 'created_at'], name='tree_manage_tree_id_e034e6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='treeversion',
+            index=models.Index(fields=['tree', 'created_at'], name='tree_manage_tree_id_6532a0_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.3 on 2026-10-17 03:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0007_version_and_tag_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexedPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PayloadAttribute',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('value', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='treenodeversion',
+            index=models.Index(fields=['payload', 'version'], name='tree_manage_payload_f28135_idx'),
+        ),
+        migrations.AddField(
+            model_name='indexedpath',
+            name='tree',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='indexed_paths', to='tree_manager.tree'),
+        ),
+        migrations.AddField(
+            model_name='payloadattribute',
+            name='payload',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='attributes', to='tree_manager.payloadblob'),
+        ),
+        migrations.AddConstraint(
+            model_name='indexedpath',
+            constraint=models.UniqueConstraint(fields=('tree', 'path'), name='unique_indexed_path'),
+        ),
+        migrations.AddIndex(
+            model_name='payloadattribute',
+            index=models.Index(fields=['path', 'value', 'payload'], name='tree_manage_path_0c2f7a_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='payloadattribute',
+            constraint=models.UniqueConstraint(fields=('payload', 'path'), name='unique_payload_attribute'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+FTS_TABLE = 'tree_manager_payloadsearch'
+
+
+def create_fts_table(apps, schema_editor):
+    # Only SQLite builds with FTS5 get the table; without it search falls
+    # back to SearchToken rows
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(content, tokenize='unicode61 remove_diacritics 0')"
+        )
+    except OperationalError:
+        pass
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0008_indexed_paths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='tree_manager.payloadblob')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=255)),
+                ('count', models.PositiveIntegerField()),
+                ('document', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='tree_manager.searchdocument')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['token', 'document'], name='tree_manage_token_44e351_idx')],
+                'constraints': [models.UniqueConstraint(fields=('document', 'token'), name='unique_search_token')],
+            },
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
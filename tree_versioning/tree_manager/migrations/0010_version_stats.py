@@ -0,0 +1,24 @@
+# Generated by Django 5.1.3 on 2026-10-17 03:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeVersionStats',
+            fields=[
+                ('version', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='tree_manager.treeversion')),
+                ('node_count', models.PositiveIntegerField(default=0)),
+                ('edge_count', models.PositiveIntegerField(default=0)),
+                ('root_count', models.PositiveIntegerField(default=0)),
+                ('max_depth', models.PositiveIntegerField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-17 03:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_manager', '0010_version_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treeversion',
+            name='archive_path',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+    ]
@@ -1,117 +1,519 @@
-from django.db import models
-from django.utils.timezone import now
+import hashlib
+import json
+import os
+import uuid
+from collections import namedtuple
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db import connections, models, transaction
+from django.db.models import Exists, F, OuterRef, Subquery, Value
+from django.db.models.expressions import RawSQL
+from django.utils.timezone import is_naive, make_aware, now
+
+from . import search
+from .adjacency import TreeAdjacency, walk_shortest_path
+from .archive import DEFAULT_BLOCK_SIZE as ARCHIVE_BLOCK_SIZE, ArchivedVersion, archive_dir, write_archive
+from .cache import version_cache
+from .csr import CSRGraph
+from .instrumentation import instrumented
+
+# One difference between two versions: kind is 'node' or 'edge', op is
+# 'added', 'removed' or 'changed', id is the node/edge id and old/new are its
+# data on each side (None where it does not exist)
+Change = namedtuple('Change', ['kind', 'op', 'id', 'old', 'new'])
+# Two changes made on either side of a merge that cannot both be applied
+Conflict = namedtuple('Conflict', ['ours', 'theirs'])
+# Outcome of TreeVersion.merge: the changes applied and the conflicts skipped
+MergeResult = namedtuple('MergeResult', ['applied', 'conflicts'])
+# Largest id list passed to a single __in filter (SQLite allows 999 parameters)
+MAX_IN_IDS = 500
+
+
+def _compile(queryset):
+    # SQL and parameters of a queryset, for embedding in hand-written statements
+    return queryset.query.get_compiler(queryset.db).as_sql()
+
+
+def _not_materialized(connection):
+    # Hint that keeps a CTE referenced several times inlined, so each
+    # reference can use the table's indexes instead of a temporary copy that
+    # recursive steps would have to scan or re-index. SQLite supports it
+    # since 3.35 and PostgreSQL since 12.
+    if connection.vendor == 'postgresql' or (
+        connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+    ):
+        return 'NOT MATERIALIZED '
+    return ''
+
+
+def _insert_from_select(model, queryset, **columns):
+    # Run a single INSERT INTO <model> (...) SELECT ... built from `queryset`.
+    # `columns` maps target field names to either a source field name on the
+    # queryset's model or an expression (e.g. Value) evaluated in the SELECT.
+    # Fields that are not listed are filled with their Python-side default.
+    for field in model._meta.concrete_fields:
+        if field.name not in columns and not field.primary_key and field.has_default():
+            columns[field.name] = Value(field.get_default(), output_field=field)
+    fields = [(name, source) for name, source in columns.items() if isinstance(source, str)]
+    expressions = [(name, source) for name, source in columns.items() if not isinstance(source, str)]
+    queryset = queryset.annotate(
+        **{f'insert_{name}': source for name, source in expressions}
+    ).values_list(
+        *[source for _, source in fields],
+        *[f'insert_{name}' for name, _ in expressions],
+    )
+    # Django selects plain fields before annotations, so list the target
+    # columns in the same order
+    connection = connections[queryset.db]
+    target_columns = ', '.join(
+        connection.ops.quote_name(model._meta.get_field(name).column)
+        for name, _ in fields + expressions
+    )
+    select_sql, params = _compile(queryset)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({target_columns}) {select_sql}",
+            params,
+        )
+        return cursor.rowcount
+
+
+def _insert_values(model, fields, rows):
+    # Insert rows given as tuples of values for `fields` with one
+    # executemany, without building model instances. Fields that are not
+    # listed are filled with their Python-side default.
+    connection = connections[model.objects.db]
+    fields = [model._meta.get_field(name) for name in fields]
+    defaults = [
+        field for field in model._meta.concrete_fields
+        if field not in fields and not field.primary_key and field.has_default()
+    ]
+    default_values = tuple(field.get_db_prep_save(field.get_default(), connection) for field in defaults)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields + defaults)
+    placeholders = ', '.join(['%s'] * (len(fields) + len(defaults)))
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({columns}) VALUES ({placeholders})",
+            [tuple(row) + default_values for row in rows],
+        )
+
+
+def _canonical_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def payload_hash(data):
+    # SHA-256 of the canonical JSON encoding, so equal payloads hash equally
+    # regardless of key order
+    return hashlib.sha256(_canonical_json(data).encode()).hexdigest()
+
+
+_MISSING = object()
+
+
+def _extract_path(data, path):
+    # Value at a dotted path of nested objects ('settings.theme'), or _MISSING
+    for key in path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            return _MISSING
+        data = data[key]
+    return data
+
+
+class PayloadBlob(models.Model):
+    # JSON data of nodes, edges and their versions, stored once per
+    # distinct content and keyed by its hash
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.JSONField()
+
+    def __str__(self):
+        return f"Payload {self.hash}"
+
+    @classmethod
+    def for_data(cls, data):
+        return cls(hash=payload_hash(data), data=data)
+
+    @classmethod
+    def store(cls, blobs):
+        # Insert the payloads that are not stored yet
+        unsaved = {blob.hash: blob for blob in blobs if blob._state.adding}
+        if unsaved:
+            cls.objects.bulk_create(unsaved.values(), ignore_conflicts=True)
+            PayloadAttribute.extract(unsaved.values())
+        for blob in unsaved.values():
+            blob._state.adding = False
+
+
+class PayloadAttribute(models.Model):
+    # Values of the indexed paths (see IndexedPath) of a payload, as
+    # canonical JSON so 1, "1" and true stay distinct. Payloads are immutable,
+    # so these are written once, when the payload is stored.
+    # The unique constraint's index serves lookups by payload
+    payload = models.ForeignKey(
+        PayloadBlob, on_delete=models.CASCADE, related_name='attributes', db_index=False
+    )
+    path = models.CharField(max_length=255)
+    value = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['payload', 'path'], name='unique_payload_attribute'),
+        ]
+        indexes = [
+            models.Index(fields=['path', 'value', 'payload']),
+        ]
+
+    def __str__(self):
+        return f"{self.path}={self.value} of Payload {self.payload_id}"
+
+    @classmethod
+    def extract(cls, blobs, paths=None):
+        # Store the attributes of `blobs` for `paths`, by default every path
+        # indexed by any tree (payloads are shared between trees)
+        if paths is None:
+            paths = version_cache.indexed_paths()
+        if not paths:
+            return
+        attributes = []
+        for blob in blobs:
+            for path in paths:
+                value = _extract_path(blob.data, path)
+                if value is not _MISSING:
+                    attributes.append(cls(payload_id=blob.hash, path=path, value=_canonical_json(value)))
+        cls.objects.bulk_create(attributes, batch_size=MAX_IN_IDS, ignore_conflicts=True)
+
+    @classmethod
+    def matching(cls, conditions):
+        # Subquery of the payload hashes whose data has every `path: value`
+        # of `conditions`
+        payloads = None
+        for path, value in conditions.items():
+            matches = cls.objects.filter(path=path, value=_canonical_json(value)).values('payload_id')
+            payloads = matches if payloads is None else payloads.filter(payload_id__in=matches)
+        return payloads
+
+
+class SearchDocument(models.Model):
+    # A payload in the full-text index. The id is the rowid of the payload's
+    # row in the FTS5 table on SQLite, and SearchToken rows refer to it
+    # elsewhere (see search.py).
+    payload = models.OneToOneField(PayloadBlob, on_delete=models.CASCADE, related_name='search_document')
+
+
+class SearchToken(models.Model):
+    # Fallback full-text index for databases without FTS5: how often each
+    # token occurs in a document
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='tokens', db_index=False)
+    token = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'token'], name='unique_search_token'),
+        ]
+        indexes = [
+            models.Index(fields=['token', 'document']),
+        ]
+
+
+class PayloadQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        PayloadBlob.store([
+            obj.payload for obj in objs
+            if obj._state.fields_cache.get('payload') is not None
+        ])
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class PayloadManager(models.Manager.from_queryset(PayloadQuerySet)):
+    # Instances almost always need their data, so fetch payloads with them
+    def get_queryset(self):
+        return super().get_queryset().select_related('payload')
+
+
+class PayloadModel(models.Model):
+    # Row whose JSON data lives in PayloadBlob. Assigning `data` (also as a
+    # constructor keyword) points the row at the payload's hash; the blob is
+    # stored when the row is saved or bulk created.
+    # Not indexed: rows are only ever read through their own keys, and an
+    # index of random hashes would slow down every snapshot insert
+    payload = models.ForeignKey(PayloadBlob, on_delete=models.PROTECT, related_name='+', db_index=False)
+
+    objects = PayloadManager()
+
+    class Meta:
+        abstract = True
+
+    @property
+    def data(self):
+        return self.payload.data
+
+    @data.setter
+    def data(self, value):
+        self.payload = PayloadBlob.for_data(value)
+
+    def save(self, *args, **kwargs):
+        if self._state.fields_cache.get('payload') is not None:
+            PayloadBlob.store([self.payload])
+        super().save(*args, **kwargs)
+
 
 class Tree(models.Model):
     name = models.CharField(max_length=255)
+    # Keep a closure table (every ancestor/descendant pair) for tagged versions
+    maintain_closure = models.BooleanField(default=False)
     created_at = models.DateTimeField(default=now)
 
     def __str__(self):
         return self.name
 
+    @instrumented
     def create_tag(self, name, description=None, version=None):
         if version and hasattr(version, 'tag'):
             raise ValueError("This version already has a tag associated with it.")
 
-        # If no version is provided, create a new TreeVersion without a tag initially
-        if not version:
-            version = TreeVersion.objects.create(tree=self)
+        if version:
+            # Resolved before the transaction, which then only writes
+            version.version_chain()
 
-        # Create the tag and associate it with the tree
-        tag = Tag.objects.create(tree=self, name=name, description=description, version=version)
+        with transaction.atomic():
+            # If no version is provided, create a new TreeVersion without a tag initially
+            if not version:
+                version = TreeVersion.objects.create(tree=self)
+            else:
+                # Lock the version (SQLite's IMMEDIATE transactions already
+                # hold the database write lock) and check again, as another
+                # writer may have tagged it in the meantime
+                TreeVersion.objects.select_for_update().filter(pk=version.pk).exists()
+                if Tag.objects.filter(version_id=version.pk).exists():
+                    raise ValueError("This version already has a tag associated with it.")
 
-        # Update the TreeVersion to link it back to the tag
-        version.tag = tag
-        version.save()
+            # Create the tag and associate it with the tree
+            tag = Tag.objects.create(tree=self, name=name, description=description, version=version)
+            version.tag = tag
 
-        self._snapshot_current_state(version)
+            self._snapshot_current_state(version)
+
+        # The closure and search index are derived from the snapshot, so they
+        # are built after it is committed, each in its own transaction
+        if self.maintain_closure:
+            version.build_closure()
+        with transaction.atomic():
+            search.index_version(version)
+        version.refresh_stats()
 
         return tag
 
     def _duplicate_version_data(self, source_version, target_version):
-        # Duplicate node versions
-        for node_version in source_version.node_versions.all():
-            TreeNodeVersion.objects.create(
-                node=node_version.node,
-                version=target_version,
-                data=node_version.data
-            )
-        # Duplicate edge versions
-        for edge_version in source_version.edge_versions.all():
-            TreeEdgeVersion.objects.create(
-                edge=edge_version.edge,
-                version=target_version,
-                data=edge_version.data
+        # Copy node and edge versions with one INSERT ... SELECT each, so the
+        # number of statements does not depend on the size of the tree
+        _insert_from_select(
+            TreeNodeVersion,
+            source_version.effective_node_versions(),
+            node='node_id',
+            version=Value(target_version.id, output_field=models.BigIntegerField()),
+            payload='payload_id',
+        )
+        _insert_from_select(
+            TreeEdgeVersion,
+            source_version.effective_edge_versions(),
+            edge='edge_id',
+            version=Value(target_version.id, output_field=models.BigIntegerField()),
+            source_node='source_node_id',
+            target_node='target_node_id',
+            payload='payload_id',
+        )
+        # A full copy has exactly the source's structure, so its closure rows
+        # can be copied as well
+        if source_version.has_closure:
+            _insert_from_select(
+                TreeClosure,
+                source_version.closure_rows.all(),
+                version=Value(target_version.id, output_field=models.BigIntegerField()),
+                ancestor='ancestor_id',
+                descendant='descendant_id',
+                depth='depth',
             )
+            TreeVersion.objects.filter(pk=target_version.pk).update(has_closure=True)
+            target_version.has_closure = True
 
     def _snapshot_current_state(self, version):
-        # Snapshot all current nodes
-        for node in self.nodes.all():
-            TreeNodeVersion.objects.create(
-                node=node,
-                version=version,
-                data=node.data
-            )
+        # Snapshot all current nodes and edges that are not already part of
+        # the version (a branch being tagged keeps its own copies, and nodes
+        # or edges it removed stay removed)
+        chain = version.version_chain()
+        nodes = self.nodes.exclude(
+            Exists(TreeNodeVersion.objects.filter(version_id__in=chain, node_id=OuterRef('pk')))
+        )
+        _insert_from_select(
+            TreeNodeVersion,
+            nodes,
+            node='id',
+            version=Value(version.id, output_field=models.BigIntegerField()),
+            payload='payload_id',
+        )
 
-        # Snapshot all current edges
-        for edge in TreeEdge.objects.filter(
+        edges = TreeEdge.objects.filter(
             incoming_node__tree=self,
             outgoing_node__tree=self
-        ):
-            TreeEdgeVersion.objects.create(
-                edge=edge,
-                version=version,
-                data=edge.data
-            )
+        ).exclude(
+            Exists(TreeEdgeVersion.objects.filter(version_id__in=chain, edge_id=OuterRef('pk')))
+        )
+        _insert_from_select(
+            TreeEdgeVersion,
+            edges,
+            edge='id',
+            version=Value(version.id, output_field=models.BigIntegerField()),
+            source_node='incoming_node_id',
+            target_node='outgoing_node_id',
+            payload='payload_id',
+        )
+        version._version_changed()
 
-    def create_new_tree_version_from_tag(self, tag_name):
+    @instrumented
+    def create_new_tree_version_from_tag(self, tag_name, delta=False):
         # Retrieve the tagged version
         try:
             tag = self.tags.get(name=tag_name)
             base_version = self.versions.get(tag=tag)
         except Tag.DoesNotExist:
             raise ValueError(f"Tag '{tag_name}' does not exist.")
-        # Create a new version with base_version as parent
-        new_version = TreeVersion.objects.create(tree=self, parent_version=base_version)
-        # Duplicate data from base_version to new_version
-        self._duplicate_version_data(base_version, new_version)
+        if base_version.archive_path:
+            # Branches read or copy the base's rows
+            base_version.rehydrate()
+        with transaction.atomic():
+            if delta:
+                # A delta version starts empty and resolves reads through
+                # base_version, so branching does not copy anything
+                new_version = TreeVersion.objects.create(tree=self, parent_version=base_version, is_delta=True)
+            else:
+                # Create a new version with base_version as parent
+                new_version = TreeVersion.objects.create(tree=self, parent_version=base_version)
+                # Duplicate data from base_version to new_version
+                self._duplicate_version_data(base_version, new_version)
+            # The branch starts out with its base's structure, so it starts
+            # out with its stats as well
+            _insert_from_select(
+                TreeVersionStats,
+                TreeVersionStats.objects.filter(version=base_version),
+                version=Value(new_version.id, output_field=models.BigIntegerField()),
+                node_count='node_count',
+                edge_count='edge_count',
+                root_count='root_count',
+                max_depth='max_depth',
+            )
         return new_version
     
+    @instrumented
     def restore_from_tag(self, tag_name):
-        # Retrieve the tagged version
+        # Retrieve the tagged version, served from the version cache when possible
         try:
-            tag = self.tags.get(name=tag_name)
-            base_version = self.versions.get(tag=tag)
+            base_version = version_cache.get_version_by_tag(tag_name)
         except Tag.DoesNotExist:
             raise ValueError(f"Tag '{tag_name}' does not exist.")
-        except TreeVersion.DoesNotExist:
-            raise ValueError(f"No version associated with tag '{tag_name}'.")
+        if base_version.tree_id != self.id:
+            raise ValueError(f"Tag '{tag_name}' does not exist.")
 
         return base_version
 
+    @instrumented
+    def as_of(self, timestamp, tagged=True):
+        # The version that was current at `timestamp`: the one most recently
+        # tagged by then or, with tagged=False, the one most recently created
+        # by then, tagged or not. Either is one probe of a (tree, created_at)
+        # index.
+        if is_naive(timestamp):
+            timestamp = make_aware(timestamp)
+        if tagged:
+            tag_name = self.tags.filter(created_at__lte=timestamp).order_by(
+                '-created_at', '-id'
+            ).values_list('name', flat=True).first()
+            if tag_name is not None:
+                return version_cache.get_version_by_tag(tag_name)
+        else:
+            version = self.versions.filter(created_at__lte=timestamp).order_by('-created_at', '-id').first()
+            if version is not None:
+                return version
+        raise ValueError(f"Tree '{self.name}' has no version as of {timestamp.isoformat()}.")
+
+    @instrumented
+    def index_path(self, path):
+        # Make the dotted JSON `path` of node data queryable with
+        # find_nodes() and find_versions(), extracting it from the payloads
+        # of this tree's nodes. Payloads stored later are indexed on insert.
+        with transaction.atomic():
+            _, created = IndexedPath.objects.get_or_create(tree=self, path=path)
+            if not created:
+                return
+            hashes = set(self.nodes.values_list('payload_id', flat=True).iterator())
+            hashes.update(
+                TreeNodeVersion.objects.filter(version__tree=self).values_list('payload_id', flat=True).iterator()
+            )
+            hashes = sorted(hashes)
+            for start in range(0, len(hashes), MAX_IN_IDS):
+                blobs = PayloadBlob.objects.filter(hash__in=hashes[start:start + MAX_IN_IDS])
+                PayloadAttribute.extract(blobs, paths=[path])
+
+    def _check_indexed(self, conditions):
+        if not conditions:
+            raise ValueError("At least one condition is required.")
+        indexed = set(self.indexed_paths.filter(path__in=list(conditions)).values_list('path', flat=True))
+        missing = [path for path in conditions if path not in indexed]
+        if missing:
+            raise ValueError(f"Path(s) {', '.join(missing)} are not indexed for tree '{self.name}'.")
+
+    @instrumented
+    def find_versions(self, conditions):
+        # Versions of this tree that set a node's data to match every
+        # `path: value` of `conditions` (delta versions only count the nodes
+        # they changed themselves)
+        self._check_indexed(conditions)
+        matching = TreeNodeVersion.objects.filter(
+            version_id=OuterRef('pk'), is_removed=False, payload_id__in=PayloadAttribute.matching(conditions)
+        )
+        return self.versions.filter(Exists(matching))
+
+    def list_versions(self):
+        # Every version of the tree, oldest first, with its tag and stats
+        # joined in: one query over the (tree, created_at) index. Stats whose
+        # max_depth an edge change cleared are recounted on the way.
+        versions = list(self.versions.select_related('tag', 'stats').order_by('created_at'))
+        for version in versions:
+            if hasattr(version, 'stats') and version.stats.max_depth is None:
+                version.refresh_stats()
+        return versions
+
     @classmethod
+    @instrumented
     def get_by_tag(cls, tag_name):
         try:
-            tag = Tag.objects.get(name=tag_name)
-            tree = tag.tree
-            version = tree.versions.get(tag=tag)
-            return version
+            return version_cache.get_version_by_tag(tag_name)
         except Tag.DoesNotExist:
             raise ValueError(f"Tag '{tag_name}' does not exist.")
 
+    @classmethod
+    @instrumented
+    async def aget_by_tag(cls, tag_name):
+        # The version cache takes a lock and may fall back to the database,
+        # so it runs in the sync thread
+        return await sync_to_async(cls.get_by_tag)(tag_name)
+
 
 
-class TreeNode(models.Model):
+class TreeNode(PayloadModel):
     tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='nodes')
-    data = models.JSONField()
     created_at = models.DateTimeField(default=now)
 
     def __str__(self):
         return f"Node {self.id} in Tree {self.tree.name}"
 
-class TreeEdge(models.Model):
+class TreeEdge(PayloadModel):
     incoming_node = models.ForeignKey(TreeNode, on_delete=models.CASCADE, related_name='outgoing_edges')
     outgoing_node = models.ForeignKey(TreeNode, on_delete=models.CASCADE, related_name='incoming_edges')
-    data = models.JSONField()
     created_at = models.DateTimeField(default=now)
 
     def __str__(self):
@@ -128,9 +530,29 @@ class Tag(models.Model):
     )
     created_at = models.DateTimeField(default=now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['tree', 'created_at']),
+        ]
+
     def __str__(self):
         return f"Tag {self.name} for Tree {self.tree.name}"
 
+class IndexedPath(models.Model):
+    # A dotted path into node data, e.g. 'settings.theme', whose values are
+    # kept in PayloadAttribute so nodes can be queried by it
+    tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='indexed_paths')
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(default=now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tree', 'path'], name='unique_indexed_path'),
+        ]
+
+    def __str__(self):
+        return f"Indexed path {self.path} of Tree {self.tree.name}"
+
 class TreeVersion(models.Model):
     tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='versions')
     parent_version = models.ForeignKey(
@@ -140,33 +562,178 @@ class TreeVersion(models.Model):
         null=True,
         related_name='child_versions'
     )
+    # Delta versions only store the nodes and edges they added, changed or
+    # removed relative to parent_version; everything else is read through
+    # the chain of ancestors up to the nearest full version
+    is_delta = models.BooleanField(default=False)
+    # Whether closure_rows currently describe this version's structure
+    has_closure = models.BooleanField(default=False)
+    # Bumped whenever a version changes, so the content of a version is
+    # identified by the revisions of its version chain
+    revision = models.PositiveIntegerField(default=0)
+    # Set while the version's rows live in an archive file instead of the
+    # database (see archive()); the version itself stays as a stub
+    archive_path = models.CharField(max_length=1024, blank=True, null=True)
     created_at = models.DateTimeField(default=now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['tree', 'created_at']),
+        ]
+
     def __str__(self):
         if hasattr(self, 'tag'):  # Check if a tag exists
             return f"Version {self.id} (Tag: {self.tag.name}) of Tree {self.tree.name}"
         return f"Version {self.id} of Tree {self.tree.name}"
+
+    def version_chain(self):
+        # Ids of the versions a read has to look at, nearest first: the
+        # version itself followed by its ancestors up to the first full one
+        if getattr(self, '_version_chain', None) is None:
+            chain = [self.id]
+            is_delta, parent_id = self.is_delta, self.parent_version_id
+            while is_delta and parent_id is not None:
+                chain.append(parent_id)
+                is_delta, parent_id = TreeVersion.objects.values_list(
+                    'is_delta', 'parent_version_id'
+                ).get(pk=parent_id)
+            self._version_chain = chain
+        return self._version_chain
+
+    async def aversion_chain(self):
+        if not self.archive_path and getattr(self, '_archive_path_cached', False):
+            await sync_to_async(self._current_archive_path)()
+        if self.archive_path:
+            await sync_to_async(self.rehydrate)()
+        if getattr(self, '_version_chain', None) is None:
+            chain = [self.id]
+            is_delta, parent_id = self.is_delta, self.parent_version_id
+            while is_delta and parent_id is not None:
+                chain.append(parent_id)
+                is_delta, parent_id = await TreeVersion.objects.values_list(
+                    'is_delta', 'parent_version_id'
+                ).aget(pk=parent_id)
+            self._version_chain = chain
+        return self._version_chain
+
+    def _current_archive_path(self):
+        # A version served from a cached tag lookup may have been archived
+        # since the entry was built, so a missing archive_path is read again
+        # (once per instance) before the rows are used
+        if not self.archive_path and getattr(self, '_archive_path_cached', False):
+            self._archive_path_cached = False
+            self.archive_path = TreeVersion.objects.values_list('archive_path', flat=True).get(pk=self.pk)
+        return self.archive_path
+
+    def _effective_rows(self, model, key):
+        if self._current_archive_path():
+            # Reading the rows of an archived version brings them back
+            self.rehydrate()
+        chain = self.version_chain()
+        if len(chain) == 1:
+            return model.objects.filter(version_id=self.id, is_removed=False)
+        # A row is visible when no version nearer in the chain has a row for
+        # the same node/edge. Versions are always created after their parent,
+        # so "nearer" is simply a higher version id.
+        newer = model.objects.filter(
+            version_id__in=chain,
+            version_id__gt=OuterRef('version_id'),
+            **{key: OuterRef(key)}
+        )
+        return model.objects.filter(version_id__in=chain).exclude(Exists(newer)).filter(is_removed=False)
+
+    def effective_node_versions(self):
+        return self._effective_rows(TreeNodeVersion, 'node_id')
+
+    def effective_edge_versions(self):
+        return self._effective_rows(TreeEdgeVersion, 'edge_id')
+
+    @instrumented
+    def search(self, query, limit=20):
+        # Node versions whose data matches every word of `query`, best match
+        # first. Only payloads indexed when a version was tagged are found.
+        return search.search_version(self, query, limit)
+
+    @instrumented
+    def find_nodes(self, conditions):
+        # Node versions of this version whose data has every `path: value`
+        # of `conditions`, e.g. {'feature_flag': True}. The paths must be
+        # indexed with tree.index_path().
+        self.tree._check_indexed(conditions)
+        return self.effective_node_versions().filter(payload_id__in=PayloadAttribute.matching(conditions))
     
+    @instrumented
     def add_node(self, data):
-        # Create a new node associated with the tree and pass the data
-        node = TreeNode.objects.create(tree=self.tree, data=data)
-        # Create a node version for this version
-        node_version = TreeNodeVersion.objects.create(
-            node=node,
-            version=self,
-            data=data
-        )
+        if self._current_archive_path():
+            self.rehydrate()
+        with transaction.atomic():
+            # Create a new node associated with the tree and pass the data
+            node = TreeNode.objects.create(tree=self.tree, data=data)
+            # Create a node version for this version
+            # The node version shares the payload the node just stored
+            node_version = TreeNodeVersion.objects.create(
+                node=node,
+                version=self,
+                payload=node.payload
+            )
+            if self.has_closure:
+                self._add_closure_node(node.id)
+            self._update_stats(nodes=1, roots=1)
+            self._version_changed()
         return node_version
 
+    @instrumented
+    def add_nodes(self, data_items, batch_size=1000):
+        # add_node for many nodes: creates a node and a node version for each
+        # item of `data_items` with bulk inserts of `batch_size` rows, and
+        # returns the node versions in the same order
+        data_items = list(data_items)
+        if self._current_archive_path():
+            self.rehydrate()
+        with transaction.atomic():
+            nodes = TreeNode.objects.bulk_create(
+                [TreeNode(tree=self.tree, data=data) for data in data_items], batch_size=batch_size
+            )
+            node_versions = TreeNodeVersion.objects.bulk_create(
+                [TreeNodeVersion(node=node, version=self, payload=node.payload) for node in nodes],
+                batch_size=batch_size,
+            )
+            if self.has_closure:
+                TreeClosure.objects.bulk_create(
+                    [TreeClosure(version=self, ancestor=node, descendant=node, depth=0) for node in nodes],
+                    batch_size=batch_size,
+                    ignore_conflicts=True,
+                )
+            self._update_stats(nodes=len(nodes), roots=len(nodes))
+            self._version_changed()
+        return node_versions
+
+    @instrumented
     def add_existing_node(self, node, data):
-        # Create a node version for an existing node
-        node_version = TreeNodeVersion.objects.create(
-            node=node,
-            version=self,
-            data=data
-        )
+        # Create or replace this version's row for an existing node
+        with transaction.atomic():
+            existed = self.effective_node_versions().filter(node=node).exists()
+            if not existed:
+                added_edges = self._node_added_edges(node.id)
+                edges, roots = self._node_added_stats(node.id, added_edges)
+            node_version, _ = TreeNodeVersion.objects.update_or_create(
+                node=node,
+                version=self,
+                defaults={'data': data, 'is_removed': False}
+            )
+            if self.has_closure:
+                self._add_closure_node(node.id)
+                if not existed:
+                    # Edges added while the node was missing join the
+                    # closure along with it
+                    for source_id, target_id in added_edges:
+                        self._extend_closure(source_id, target_id)
+            if not existed:
+                self._update_stats(nodes=1, edges=edges, roots=roots, depth_changed=bool(edges))
+            self._version_changed()
         return node_version
     
+    @instrumented
     def add_edge(self, incoming_node_id, outgoing_node_id, data):
         # Retrieve the incoming and outgoing nodes
         try:
@@ -175,131 +742,1239 @@ class TreeVersion(models.Model):
         except TreeNode.DoesNotExist:
             raise ValueError("One or both of the nodes do not exist in this tree.")
 
-        # Create a new edge and pass the data
-        edge = TreeEdge.objects.create(
-            incoming_node=incoming_node,
-            outgoing_node=outgoing_node,
-            data=data  # Pass the required data here
-        )
+        with transaction.atomic():
+            edges, roots = self._edge_added_stats(incoming_node.id, outgoing_node.id)
+            max_depth = self._max_depth_after_edge(incoming_node.id, outgoing_node.id) if roots else None
+            # Create a new edge and pass the data
+            edge = TreeEdge.objects.create(
+                incoming_node=incoming_node,
+                outgoing_node=outgoing_node,
+                data=data  # Pass the required data here
+            )
 
-        # Create an edge version for this version
-        edge_version = TreeEdgeVersion.objects.create(
-            edge=edge,
-            version=self,
-            data=data
-        )
+            # Create an edge version for this version
+            edge_version = TreeEdgeVersion.objects.create(
+                edge=edge,
+                version=self,
+                source_node=incoming_node,
+                target_node=outgoing_node,
+                payload=edge.payload
+            )
+            if self.has_closure:
+                self._extend_closure(incoming_node.id, outgoing_node.id)
+            self._update_stats(edges=edges, roots=roots, depth_changed=bool(edges), max_depth=max_depth)
+            self._version_changed()
         return edge_version
 
+    @instrumented
+    def add_edges(self, edges, batch_size=1000):
+        # add_edge for many edges, given as (incoming_node_id,
+        # outgoing_node_id, data) tuples. All node ids are checked up front, so
+        # nothing is written unless every one exists in the tree. Returns the
+        # edge versions in the same order.
+        edges = list(edges)
+        node_ids = sorted({node_id for source_id, target_id, _ in edges for node_id in (source_id, target_id)})
+        existing = set()
+        for start in range(0, len(node_ids), MAX_IN_IDS):
+            existing.update(
+                self.tree.nodes.filter(id__in=node_ids[start:start + MAX_IN_IDS]).values_list('id', flat=True)
+            )
+        missing = [node_id for node_id in node_ids if node_id not in existing]
+        if missing:
+            raise ValueError(f"Nodes {', '.join(map(str, missing))} do not exist in this tree.")
+
+        with transaction.atomic():
+            # Only edges between nodes of the version count, and their
+            # targets without an incoming edge so far stop being roots
+            present = self._present(node_ids)
+            counted = [
+                (source_id, target_id) for source_id, target_id, _ in edges
+                if source_id in present and target_id in present
+            ]
+            target_ids = {target_id for _, target_id in counted}
+            new_parents = target_ids - self._counted_parents(target_ids)
+            created = TreeEdge.objects.bulk_create(
+                [
+                    TreeEdge(incoming_node_id=source_id, outgoing_node_id=target_id, data=data)
+                    for source_id, target_id, data in edges
+                ],
+                batch_size=batch_size,
+            )
+            edge_versions = TreeEdgeVersion.objects.bulk_create(
+                [
+                    TreeEdgeVersion(
+                        edge=edge,
+                        version=self,
+                        source_node_id=edge.incoming_node_id,
+                        target_node_id=edge.outgoing_node_id,
+                        payload=edge.payload,
+                    )
+                    for edge in created
+                ],
+                batch_size=batch_size,
+            )
+            if self.has_closure and edges:
+                # One recursive rebuild instead of extending the closure per edge
+                self.build_closure()
+            if counted:
+                self._update_stats(edges=len(counted), roots=-len(new_parents), depth_changed=True)
+            self._version_changed()
+        return edge_versions
+
+    @instrumented
     def add_existing_edge(self, edge, data):
-        # Create an edge version for an existing edge
-        edge_version = TreeEdgeVersion.objects.create(
-            edge=edge,
-            version=self,
-            data=data
-        )
+        # Create or replace this version's row for an existing edge
+        with transaction.atomic():
+            existed = self.effective_edge_versions().filter(edge=edge).exists()
+            if not existed:
+                edges, roots = self._edge_added_stats(edge.incoming_node_id, edge.outgoing_node_id)
+                max_depth = self._max_depth_after_edge(edge.incoming_node_id, edge.outgoing_node_id) if roots else None
+            edge_version, _ = TreeEdgeVersion.objects.update_or_create(
+                edge=edge,
+                version=self,
+                defaults={
+                    'source_node_id': edge.incoming_node_id,
+                    'target_node_id': edge.outgoing_node_id,
+                    'data': data,
+                    'is_removed': False,
+                }
+            )
+            if self.has_closure:
+                self._extend_closure(edge.incoming_node_id, edge.outgoing_node_id)
+            if not existed:
+                self._update_stats(edges=edges, roots=roots, depth_changed=bool(edges), max_depth=max_depth)
+            self._version_changed()
         return edge_version
 
+    @instrumented
+    def remove_node(self, node_id):
+        # Remove a node and the edges touching it from this version. A
+        # tombstone row hides the node from the ancestors of a delta version.
+        node_version = self.get_node(node_id)
+        with transaction.atomic():
+            for edge_version in self.get_node_edges(node_id):
+                self.remove_edge(edge_version.edge_id)
+            self.node_versions.filter(node_id=node_id).delete()
+            TreeNodeVersion.objects.create(
+                node_id=node_id,
+                version=self,
+                payload_id=node_version.payload_id,
+                is_removed=True
+            )
+            if self.has_closure:
+                self._drop_closure()
+            # Without its edges the node was a root
+            self._update_stats(nodes=-1, roots=-1)
+            self._version_changed()
+
+    @instrumented
+    def remove_edge(self, edge_id):
+        try:
+            edge_version = self.effective_edge_versions().get(edge_id=edge_id)
+        except TreeEdgeVersion.DoesNotExist:
+            raise ValueError(f"Edge with id {edge_id} does not exist in this version.")
+        with transaction.atomic():
+            source_id, target_id = edge_version.source_node_id, edge_version.target_node_id
+            counted = self._present({source_id, target_id}) == {source_id, target_id}
+            self.edge_versions.filter(edge_id=edge_id).delete()
+            TreeEdgeVersion.objects.create(
+                edge_id=edge_id,
+                version=self,
+                source_node_id=edge_version.source_node_id,
+                target_node_id=edge_version.target_node_id,
+                payload_id=edge_version.payload_id,
+                is_removed=True
+            )
+            if self.has_closure:
+                self._drop_closure()
+            if counted:
+                orphaned = not self._counted_parents({target_id})
+                self._update_stats(edges=-1, roots=int(orphaned), depth_changed=True)
+            self._version_changed()
+
+    def diff(self, other, chunk_size=2000):
+        # Stream the changes that turn this version into `other`. Each kind of
+        # change is one set-based query (anti-join for added/removed, a
+        # correlated payload hash comparison for changed) read in chunks, so
+        # neither version is loaded into memory.
+        for kind, model, key in (('node', TreeNodeVersion, 'node_id'), ('edge', TreeEdgeVersion, 'edge_id')):
+            old = self._effective_rows(model, key)
+            new = other._effective_rows(model, key)
+
+            # Versions that share part of their chain resolve every node/edge
+            # without a row in the unshared part to the same row, so only
+            # those rows can differ. For delta branches of a common tag this
+            # restricts the diff to what the branches touched.
+            own_chain, other_chain = set(self.version_chain()), set(other.version_chain())
+            if own_chain & other_chain:
+                touched = model.objects.filter(
+                    version_id__in=own_chain ^ other_chain
+                ).values(key)
+                old = old.filter(**{f'{key}__in': touched})
+                new = new.filter(**{f'{key}__in': touched})
+
+            same_key = {key: OuterRef(key)}
+            added = new.exclude(Exists(old.filter(**same_key))).values_list(key, 'payload__data')
+            for row_id, data in added.iterator(chunk_size=chunk_size):
+                yield Change(kind, 'added', row_id, None, data)
+
+            removed = old.exclude(Exists(new.filter(**same_key))).values_list(key, 'payload__data')
+            for row_id, data in removed.iterator(chunk_size=chunk_size):
+                yield Change(kind, 'removed', row_id, data, None)
+
+            changed = new.filter(
+                Exists(old.filter(**same_key).exclude(payload_id=OuterRef('payload_id')))
+            ).annotate(
+                old_data=Subquery(old.filter(**same_key).values('payload__data')[:1], output_field=models.JSONField())
+            ).values_list(key, 'old_data', 'payload__data')
+            for row_id, old_data, data in changed.iterator(chunk_size=chunk_size):
+                yield Change(kind, 'changed', row_id, old_data, data)
+
+    def ancestry(self):
+        # Ids of this version and all its ancestors, nearest first
+        ancestry = [self.id]
+        parent_id = self.parent_version_id
+        while parent_id is not None and parent_id not in ancestry:
+            ancestry.append(parent_id)
+            parent_id = TreeVersion.objects.values_list('parent_version_id', flat=True).get(pk=parent_id)
+        return ancestry
+
+    def merge_base(self, other):
+        # The nearest version both this version and `other` descend from
+        own_ancestry = set(self.ancestry())
+        for version_id in other.ancestry():
+            if version_id in own_ancestry:
+                return TreeVersion.objects.get(pk=version_id)
+        raise ValueError(f"Versions {self.id} and {other.id} have no common ancestor.")
+
+    @instrumented
+    def merge(self, other, base=None):
+        # Three-way merge of `other` into this version. Both sides' changes
+        # since the merge base come from base.diff(), which for branches of a
+        # common version only looks at the rows the branches wrote. Changes
+        # of `other` that do not conflict with ours are applied with bulk
+        # writes; conflicting ones are left out and reported.
+        if base is None:
+            base = self.merge_base(other)
+        ours = {(change.kind, change.id): change for change in base.diff(self)}
+
+        applied = []
+        conflicts = []
+        for theirs in base.diff(other):
+            mine = ours.get((theirs.kind, theirs.id))
+            if mine is None:
+                applied.append(theirs)
+            elif mine.op != theirs.op or payload_hash(mine.new) != payload_hash(theirs.new):
+                conflicts.append(Conflict(mine, theirs))
+
+        # An edge added on one side cannot keep a node removed on the other
+        added_edges = [change for change in (*ours.values(), *applied) if change.kind == 'edge' and change.op == 'added']
+        removed_edges = [change for change in applied if change.kind == 'edge' and change.op == 'removed']
+        endpoint_edge_ids = [change.id for change in (*added_edges, *removed_edges)]
+        endpoints = {}
+        for start in range(0, len(endpoint_edge_ids), MAX_IN_IDS):
+            edge_ids = endpoint_edge_ids[start:start + MAX_IN_IDS]
+            for edge_id, source_id, target_id in TreeEdge.objects.filter(id__in=edge_ids).values_list(
+                'id', 'incoming_node_id', 'outgoing_node_id'
+            ):
+                endpoints[edge_id] = (source_id, target_id)
+        removed_by_us = {change.id: change for change in ours.values() if change.kind == 'node' and change.op == 'removed'}
+        removed_by_them = {change.id: change for change in applied if change.kind == 'node' and change.op == 'removed'}
+        theirs_edges = {change.id for change in applied if change.kind == 'edge'}
+        skipped = set()
+        for change in added_edges:
+            for node_id in endpoints[change.id]:
+                if change.id in theirs_edges and node_id in removed_by_us:
+                    conflicts.append(Conflict(removed_by_us[node_id], change))
+                    skipped.add(('edge', change.id))
+                elif change.id not in theirs_edges and node_id in removed_by_them:
+                    conflicts.append(Conflict(change, removed_by_them[node_id]))
+                    skipped.add(('node', node_id))
+        # remove_node also removed the node's edges, so when their removal of
+        # a node conflicts, the removals of its edges are left out with it
+        kept_nodes = {
+            conflict.theirs.id for conflict in conflicts
+            if conflict.theirs.kind == 'node' and conflict.theirs.op == 'removed'
+        }
+        for change in removed_edges:
+            if kept_nodes.intersection(endpoints[change.id]):
+                skipped.add(('edge', change.id))
+        applied = [change for change in applied if (change.kind, change.id) not in skipped]
+
+        with transaction.atomic():
+            for kind, model, key in (('node', TreeNodeVersion, 'node_id'), ('edge', TreeEdgeVersion, 'edge_id')):
+                changes = [change for change in applied if change.kind == kind]
+                # Replace this version's own rows; removals become tombstones
+                # like in remove_node/remove_edge
+                for start in range(0, len(changes), MAX_IN_IDS):
+                    model.objects.filter(
+                        version=self, **{f'{key}__in': [change.id for change in changes[start:start + MAX_IN_IDS]]}
+                    ).delete()
+                model.objects.bulk_create([
+                    model(
+                        version=self,
+                        data=change.old if change.op == 'removed' else change.new,
+                        is_removed=change.op == 'removed',
+                        **{key: change.id}
+                    )
+                    for change in changes
+                ], batch_size=MAX_IN_IDS)
+            if applied and self.has_closure:
+                self.build_closure()
+        if applied:
+            self._version_changed()
+            # A merge can change anything, so the stats are recounted
+            self.refresh_stats()
+        return MergeResult(applied, conflicts)
+
     def get_root_nodes(self):
         # Root nodes are those with no incoming edges in this version
-        node_ids_with_incoming_edges = self.edge_versions.values_list('edge__outgoing_node_id', flat=True)
-        root_node_versions = self.node_versions.exclude(node__id__in=node_ids_with_incoming_edges)
+        node_ids_with_incoming_edges = self.effective_edge_versions().values_list('target_node_id', flat=True)
+        root_node_versions = self.effective_node_versions().exclude(node__id__in=node_ids_with_incoming_edges)
         return root_node_versions
 
+    @instrumented
     def get_node(self, node_id):
         try:
-            node_version = self.node_versions.get(node__id=node_id)
+            node_version = self.effective_node_versions().get(node__id=node_id)
             return node_version
         except TreeNodeVersion.DoesNotExist:
             raise ValueError(f"Node with id {node_id} does not exist in this version.")
 
     def get_child_nodes(self, node_id):
-        outgoing_edges = self.edge_versions.filter(edge__incoming_node__id=node_id)
-        child_node_ids = outgoing_edges.values_list('edge__outgoing_node__id', flat=True)
-        child_nodes = self.node_versions.filter(node__id__in=child_node_ids)
+        outgoing_edges = self.effective_edge_versions().filter(source_node_id=node_id)
+        child_node_ids = outgoing_edges.values_list('target_node_id', flat=True)
+        child_nodes = self.effective_node_versions().filter(node__id__in=child_node_ids)
         return child_nodes
 
     def get_parent_nodes(self, node_id):
-        incoming_edges = self.edge_versions.filter(edge__outgoing_node__id=node_id)
-        parent_node_ids = incoming_edges.values_list('edge__incoming_node__id', flat=True)
-        parent_nodes = self.node_versions.filter(node__id__in=parent_node_ids)
+        incoming_edges = self.effective_edge_versions().filter(target_node_id=node_id)
+        parent_node_ids = incoming_edges.values_list('source_node_id', flat=True)
+        parent_nodes = self.effective_node_versions().filter(node__id__in=parent_node_ids)
         return parent_nodes
     
     def get_node_edges(self, node_id):
-        node_edges = self.edge_versions.filter(
-            models.Q(edge__incoming_node__id=node_id) | models.Q(edge__outgoing_node__id=node_id)
+        node_edges = self.effective_edge_versions().filter(
+            models.Q(source_node_id=node_id) | models.Q(target_node_id=node_id)
         )
         return node_edges
 
+    @instrumented
+    def adjacency_index(self, refresh=False):
+        # Load every node id and edge endpoint of the version in two queries
+        # and keep the resulting child/parent lists on this instance
+        if refresh or getattr(self, '_adjacency', None) is None:
+            node_ids = self.effective_node_versions().values_list('node_id', flat=True)
+            edges = self.effective_edge_versions().values_list('id', 'source_node_id', 'target_node_id')
+            self._adjacency = TreeAdjacency(node_ids, edges)
+        return self._adjacency
+
+    def _restore_referenced(self, archived):
+        # Put back the payloads, nodes and edges that rows restored from
+        # `archived` refer to but garbage collection deleted. Foreign keys
+        # are only checked on commit, so this runs after the rows went in
+        # and usually finds nothing to do.
+        blob_hashes = PayloadBlob.objects.values('hash')
+        missing_payloads = set(self.node_versions.exclude(payload_id__in=blob_hashes).values_list(
+            'payload_id', flat=True
+        )) | set(self.edge_versions.exclude(payload_id__in=blob_hashes).values_list('payload_id', flat=True))
+        missing_nodes = set(self.node_versions.exclude(node_id__in=TreeNode.objects.values('id')).values_list(
+            'node_id', flat=True
+        ))
+        missing_edges = set(self.edge_versions.exclude(edge_id__in=TreeEdge.objects.values('id')).values_list(
+            'edge_id', flat=True
+        ))
+        if not (missing_payloads or missing_nodes or missing_edges):
+            return
+        blobs = {}
+        nodes = []
+        for node_id, _, payload_id, data, _ in archived.iter_node_records():
+            if payload_id in missing_payloads:
+                blobs[payload_id] = PayloadBlob(hash=payload_id, data=data)
+            if node_id in missing_nodes:
+                nodes.append(TreeNode(id=node_id, tree_id=self.tree_id, payload_id=payload_id))
+        edges = []
+        for _, edge_id, source_id, target_id, payload_id, data, _ in archived.iter_edge_records():
+            if payload_id in missing_payloads:
+                blobs[payload_id] = PayloadBlob(hash=payload_id, data=data)
+            if edge_id in missing_edges:
+                edges.append(TreeEdge(
+                    id=edge_id, incoming_node_id=source_id, outgoing_node_id=target_id, payload_id=payload_id
+                ))
+        PayloadBlob.store(blobs.values())
+        TreeNode.objects.bulk_create(nodes, batch_size=MAX_IN_IDS)
+        TreeEdge.objects.bulk_create(edges, batch_size=MAX_IN_IDS)
+
+    # The stats count what to_csr() sees: the version's nodes, the edges
+    # between two of them, and the nodes with no such edge coming in
+
+    def _present(self, node_ids):
+        # The ids of `node_ids` that are nodes of this version
+        node_ids = list(node_ids)
+        present = set()
+        for start in range(0, len(node_ids), MAX_IN_IDS):
+            present.update(self.effective_node_versions().filter(
+                node_id__in=node_ids[start:start + MAX_IN_IDS]
+            ).values_list('node_id', flat=True))
+        return present
+
+    def _counted_parents(self, node_ids):
+        # The ids of `node_ids` with an incoming edge from a node of this version
+        node_ids = list(node_ids)
+        with_parents = set()
+        for start in range(0, len(node_ids), MAX_IN_IDS):
+            with_parents.update(self.effective_edge_versions().filter(
+                target_node_id__in=node_ids[start:start + MAX_IN_IDS],
+                source_node_id__in=self.effective_node_versions().values('node_id'),
+            ).values_list('target_node_id', flat=True))
+        return with_parents
+
+    def _edge_added_stats(self, source_id, target_id):
+        # (edges, roots) changes of adding an edge, called before it is added
+        if self._present({source_id, target_id}) != {source_id, target_id}:
+            return 0, 0
+        return 1, -int(not self._counted_parents({target_id}))
+
+    def _node_added_edges(self, node_id):
+        # (source, target) of the edges of the version that already point to
+        # or from a node and start to count once it is added: those whose
+        # other end is in the version. Called before the node is added.
+        touching = list(self.effective_edge_versions().filter(
+            models.Q(source_node_id=node_id) | models.Q(target_node_id=node_id)
+        ).values_list('source_node_id', 'target_node_id'))
+        present = self._present({
+            other for edge in touching for other in edge if other != node_id
+        }) | {node_id}
+        return [(source_id, target_id) for source_id, target_id in touching if {source_id, target_id} <= present]
+
+    def _node_added_stats(self, node_id, counted):
+        # (edges, roots) changes of bringing back a node with the edges
+        # _node_added_edges() found for it
+        children = {target_id for source_id, target_id in counted if source_id == node_id and target_id != node_id}
+        is_root = not any(target_id == node_id for _, target_id in counted)
+        return len(counted), int(is_root) - len(children - self._counted_parents(children))
+
+    def _max_depth_after_edge(self, source_id, target_id):
+        # The stats' max_depth once the edge source -> target is added, when
+        # it can be worked out without a recount, or None. Called before the
+        # edge is added, and only when it makes target_id stop being a root.
+        # If every node but the roots has exactly one parent (edge_count ==
+        # node_count - root_count), the edge hangs the target's subtree below
+        # the source and no other node moves, unless the source is below the
+        # target or on a cycle.
+        if source_id == target_id:
+            return None
+        counts = TreeVersionStats.objects.filter(version=self).values_list(
+            'node_count', 'edge_count', 'root_count', 'max_depth'
+        ).first()
+        if counts is None:
+            return None
+        node_count, edge_count, root_count, max_depth = counts
+        if max_depth is None or edge_count != node_count - root_count:
+            return None
+        top_id, source_depth = self._farthest(source_id, upward=True)
+        if top_id == target_id or self._counted_parents({top_id}):
+            return None
+        _, height = self._farthest(target_id, upward=False)
+        return max(max_depth, source_depth + 1 + height)
+
+    def _update_stats(self, nodes=0, edges=0, roots=0, depth_changed=False, max_depth=None):
+        # Apply a mutation's changes to the version's stats row, if it has
+        # one. Adding or removing edges can move nodes to any depth, so
+        # max_depth is set to `max_depth` when the caller could work it out
+        # and otherwise cleared until the next refresh_stats().
+        updates = {
+            name: F(name) + delta
+            for name, delta in (('node_count', nodes), ('edge_count', edges), ('root_count', roots))
+            if delta
+        }
+        if depth_changed:
+            updates['max_depth'] = max_depth
+        if updates:
+            TreeVersionStats.objects.filter(version=self).update(**updates)
+            self._state.fields_cache.pop('stats', None)
+
+    @instrumented
+    def refresh_stats(self):
+        # Count the version's nodes, edges and roots and its maximum depth
+        # (as in to_csr().depths()) and store them in its stats row
+        graph = self.to_csr()
+        stats, _ = TreeVersionStats.objects.update_or_create(version=self, defaults={
+            'node_count': len(graph),
+            'edge_count': len(graph.targets),
+            'root_count': len(graph.roots()),
+            'max_depth': max(max(graph.depths(), default=0), 0),
+        })
+        self.stats = stats
+        return stats
+
+    def _version_changed(self):
+        # Drop per-instance read caches and cached materializations after a mutation
+        self._adjacency = None
+        version_cache.invalidate_version(self.id)
+        TreeVersion.objects.filter(pk=self.pk).update(revision=F('revision') + 1)
+
+    def chain_revisions(self):
+        # (version id, revision) for every version a read of this one depends on
+        return list(
+            TreeVersion.objects.filter(id__in=self.version_chain()).order_by('id').values_list('id', 'revision')
+        )
+
+    async def achain_revisions(self):
+        chain = await self.aversion_chain()
+        return [
+            row async for row in
+            TreeVersion.objects.filter(id__in=chain).order_by('id').values_list('id', 'revision')
+        ]
+
+    # Async read API. The querysets are built by the sync methods, which do
+    # not touch the database once the version chain is resolved, and are
+    # evaluated with the async ORM.
+
+    @instrumented
+    async def aget_node(self, node_id):
+        await self.aversion_chain()
+        try:
+            return await self.effective_node_versions().aget(node__id=node_id)
+        except TreeNodeVersion.DoesNotExist:
+            raise ValueError(f"Node with id {node_id} does not exist in this version.")
+
+    @instrumented
+    async def aget_root_nodes(self):
+        await self.aversion_chain()
+        return [node_version async for node_version in self.get_root_nodes()]
+
+    @instrumented
+    async def aget_child_nodes(self, node_id):
+        await self.aversion_chain()
+        return [node_version async for node_version in self.get_child_nodes(node_id)]
+
+    @instrumented
+    async def aget_parent_nodes(self, node_id):
+        await self.aversion_chain()
+        return [node_version async for node_version in self.get_parent_nodes(node_id)]
+
+    @instrumented
+    async def aget_node_edges(self, node_id):
+        await self.aversion_chain()
+        return [
+            edge_version async for edge_version in
+            self.get_node_edges(node_id).select_related('edge')
+        ]
+
+    async def aiter_nodes(self, chunk_size=2000):
+        # Every node version, streamed in chunks
+        await self.aversion_chain()
+        async for node_version in self.effective_node_versions().aiterator(chunk_size=chunk_size):
+            yield node_version
+
+    async def atraverse(self, node_id, max_depth=None):
+        # Breadth-first walk below node_id (included), one query per level:
+        # the children of the whole frontier are fetched together
+        yield await self.aget_node(node_id)
+        visited = {node_id}
+        frontier = [node_id]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            next_frontier = []
+            for start in range(0, len(frontier), MAX_IN_IDS):
+                child_ids = self.effective_edge_versions().filter(
+                    source_node_id__in=frontier[start:start + MAX_IN_IDS]
+                ).values('target_node_id')
+                async for child in self.effective_node_versions().filter(node_id__in=child_ids):
+                    if child.node_id not in visited:
+                        visited.add(child.node_id)
+                        next_frontier.append(child.node_id)
+                        yield child
+            frontier = next_frontier
+            depth += 1
+
+    @instrumented
+    def materialize(self):
+        # Every node and edge of the version loaded into memory, with read
+        # methods that mirror this class's. Tagged versions are kept in the
+        # process-wide version cache, so repeated calls do not hit the database.
+        # Archived versions are read from their memory-mapped archive file.
+        if self.archive_path:
+            if getattr(self, '_archived', None) is None or self._archived.path != self.archive_path:
+                self._archived = ArchivedVersion(self.archive_path)
+            return self._archived
+        return version_cache.materialize(self)
+
+    @instrumented
+    def archive(self, directory=None, block_size=ARCHIVE_BLOCK_SIZE):
+        # Move the rows of a tagged version into a compressed archive file
+        # (see archive.py) and delete them from the database, leaving the
+        # version with its tag and stats as a stub. materialize() then reads
+        # from the file; anything reading or changing the rows rehydrates the
+        # version first. Returns the path of the archive.
+        if not hasattr(self, 'tag'):
+            raise ValueError("Only tagged versions can be archived.")
+        if self.archive_path:
+            raise ValueError("This version is already archived.")
+        if self.child_versions.filter(is_delta=True).exists():
+            raise ValueError("Delta versions read through this version, so it cannot be archived.")
+
+        directory = directory or archive_dir()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"version-{self.id}-{uuid.uuid4().hex}.tva")
+        revision = TreeVersion.objects.values_list('revision', flat=True).get(pk=self.pk)
+        # Rows a delta version reads from its ancestors are marked inherited:
+        # their ids belong to the ancestors' rows, which stay in place
+        nodes = (
+            [node_id, node_version_id, payload_id, data, version_id != self.id]
+            for node_id, node_version_id, payload_id, data, version_id in self.effective_node_versions().order_by(
+                'node_id'
+            ).values_list('node_id', 'id', 'payload_id', 'payload__data', 'version_id').iterator(chunk_size=2000)
+        )
+        edges = (
+            [edge_version_id, edge_id, source_id, target_id, payload_id, data, version_id != self.id]
+            for edge_version_id, edge_id, source_id, target_id, payload_id, data, version_id in (
+                self.effective_edge_versions().order_by('source_node_id', 'id').values_list(
+                    'id', 'edge_id', 'source_node_id', 'target_node_id', 'payload_id', 'payload__data', 'version_id'
+                ).iterator(chunk_size=2000)
+            )
+        )
+        # The file is written outside the transaction, so writers are only
+        # held up by the deletes
+        write_archive(
+            path, {'id': self.id, 'tree': self.tree.name, 'tag': self.tag.name}, nodes, edges, block_size=block_size
+        )
+        try:
+            with transaction.atomic():
+                locked = TreeVersion.objects.select_for_update().get(pk=self.pk)
+                if locked.revision != revision or locked.archive_path:
+                    raise ValueError("This version changed while it was being archived.")
+                if self.child_versions.filter(is_delta=True).exists():
+                    raise ValueError("Delta versions read through this version, so it cannot be archived.")
+                self.closure_rows.all().delete()
+                self.node_versions.all().delete()
+                self.edge_versions.all().delete()
+                # The archive holds every row the version read through its
+                # ancestors, so the stub no longer depends on them
+                TreeVersion.objects.filter(pk=self.pk).update(archive_path=path, is_delta=False, has_closure=False)
+                version_cache.invalidate_version(self.id)
+        except BaseException:
+            os.remove(path)
+            raise
+        self.archive_path = path
+        self.is_delta = False
+        self.has_closure = False
+        self._version_chain = None
+        self._adjacency = None
+        return path
+
+    @instrumented
+    def rehydrate(self, batch_size=2000):
+        # Restore the rows of an archived version from its archive file, with
+        # their original ids, and delete the file once that is committed. A
+        # no-op for versions that are not archived. The archive has every
+        # value of the rows, so they are inserted as plain tuples.
+        if not self._current_archive_path():
+            return
+        archived = ArchivedVersion(self.archive_path)
+        with transaction.atomic():
+            locked = TreeVersion.objects.select_for_update().get(pk=self.pk)
+            if locked.archive_path == self.archive_path:
+                # The version comes back as a full copy. Its own rows keep
+                # their ids; rows it inherited from ancestors get new ones.
+                records = archived.iter_node_records()
+                while batch := list(islice(records, batch_size)):
+                    _insert_values(
+                        TreeNodeVersion,
+                        ['id', 'node', 'version', 'payload'],
+                        [
+                            (node_version_id, node_id, self.id, payload_id)
+                            for node_id, node_version_id, payload_id, _, inherited in batch if not inherited
+                        ],
+                    )
+                    _insert_values(
+                        TreeNodeVersion,
+                        ['node', 'version', 'payload'],
+                        [
+                            (node_id, self.id, payload_id)
+                            for node_id, _, payload_id, _, inherited in batch if inherited
+                        ],
+                    )
+                records = archived.iter_edge_records()
+                while batch := list(islice(records, batch_size)):
+                    _insert_values(
+                        TreeEdgeVersion,
+                        ['id', 'edge', 'version', 'source_node', 'target_node', 'payload'],
+                        [
+                            (edge_version_id, edge_id, self.id, source_id, target_id, payload_id)
+                            for edge_version_id, edge_id, source_id, target_id, payload_id, _, inherited in batch
+                            if not inherited
+                        ],
+                    )
+                    _insert_values(
+                        TreeEdgeVersion,
+                        ['edge', 'version', 'source_node', 'target_node', 'payload'],
+                        [
+                            (edge_id, self.id, source_id, target_id, payload_id)
+                            for _, edge_id, source_id, target_id, payload_id, _, inherited in batch if inherited
+                        ],
+                    )
+                self._restore_referenced(archived)
+                TreeVersion.objects.filter(pk=self.pk).update(archive_path=None)
+                version_cache.invalidate_version(self.id)
+                path = self.archive_path
+                transaction.on_commit(lambda: os.remove(path))
+        archived.close()
+        self.archive_path = None
+        self._archived = None
+        # Derived data is rebuilt as when the version was tagged
+        if self.tree.maintain_closure:
+            self.build_closure()
+        with transaction.atomic():
+            search.index_version(self)
+
+    @instrumented
+    def to_csr(self):
+        # The version's structure as typed arrays (see csr.CSRGraph) for
+        # analytics over every node, such as depth and subtree size histograms
+        return CSRGraph.from_version(self)
+
+    def _node_versions_by_node_id(self, node_ids):
+        # Fetch node versions for many nodes in a single query. Large id lists
+        # would exceed the backend's parameter limit, so scan the version
+        # instead and keep the requested rows.
+        node_ids = set(node_ids)
+        node_versions = self.effective_node_versions()
+        if len(node_ids) <= MAX_IN_IDS:
+            node_versions = node_versions.filter(node_id__in=node_ids)
+        return {
+            node_version.node_id: node_version
+            for node_version in node_versions.iterator()
+            if node_version.node_id in node_ids
+        }
+
+    def _edge_versions_by_id(self, edge_version_ids):
+        edge_version_ids = set(edge_version_ids)
+        edge_versions = self.effective_edge_versions()
+        if len(edge_version_ids) <= MAX_IN_IDS:
+            edge_versions = edge_versions.filter(id__in=edge_version_ids)
+        return {
+            edge_version.id: edge_version
+            for edge_version in edge_versions.iterator()
+            if edge_version.id in edge_version_ids
+        }
+
+    def _children_of(self, frontier, visited, predicate):
+        # The node versions one level below `frontier`, as {parent id: [child
+        # node version, ...]} with each parent's children ordered by node id.
+        # With the adjacency index loaded, the child ids come from it and
+        # only the node versions are queried, in batches of MAX_IN_IDS.
+        # Otherwise each MAX_IN_IDS frontier nodes take two queries, for the
+        # edges and for the node versions they point at. Children already in
+        # `visited` (reached through another path) or rejected by
+        # `predicate` are left out; the others are added to `visited`.
+        index = getattr(self, '_adjacency', None)
+        children = {}
+        for start in range(0, len(frontier), MAX_IN_IDS):
+            chunk = frontier[start:start + MAX_IN_IDS]
+            if index is not None:
+                targets = {source_id: index.get_children(source_id) for source_id in chunk}
+                target_ids = list({
+                    target_id for target_ids in targets.values() for target_id in target_ids
+                    if target_id not in visited
+                })
+                node_versions = {}
+                for batch in range(0, len(target_ids), MAX_IN_IDS):
+                    node_versions.update(self._node_versions_by_node_id(target_ids[batch:batch + MAX_IN_IDS]))
+            else:
+                edges = self.effective_edge_versions().filter(source_node_id__in=chunk)
+                node_versions = {
+                    node_version.node_id: node_version
+                    for node_version in self.effective_node_versions().filter(
+                        node_id__in=edges.values('target_node_id')
+                    )
+                }
+                targets = {}
+                for source_id, target_id in edges.values_list('source_node_id', 'target_node_id'):
+                    targets.setdefault(source_id, []).append(target_id)
+            for source_id in chunk:
+                for target_id in sorted(set(targets.get(source_id, ()))):
+                    # Edges pointing at nodes outside the version are not traversable
+                    node_version = node_versions.get(target_id)
+                    if node_version is None or target_id in visited:
+                        continue
+                    visited.add(target_id)
+                    if predicate is None or predicate(node_version):
+                        children.setdefault(source_id, []).append(node_version)
+        return children
+
+    def iter_nodes(self, start, order='pre', max_depth=None, predicate=None):
+        # Lazily yield the node versions below `start` (included) in
+        # pre-order, post-order or breadth-first ('bfs') order, down to
+        # `max_depth` levels below it. Nodes for which `predicate` returns
+        # False are skipped along with everything below them.
+        #
+        # Children are fetched a whole level at a time, so the number of
+        # queries grows with the depth of the walk and not with the number
+        # of nodes; with the adjacency index loaded only the node versions
+        # are queried. A node reachable along several paths is visited once,
+        # below the parent that reaches it first breadth-first, and siblings
+        # come in node id order.
+        #
+        # Memory is not constant: the ids of every visited node are kept, and
+        # a fetched level stays in memory until it has been yielded. The
+        # pre- and post-orders fetch the level below the first node they
+        # descend into for the whole frontier, so on wide trees they can
+        # hold O(N) node versions at once; post-order additionally keeps
+        # every ancestor of the current node on its stack.
+        if order not in ('pre', 'post', 'bfs'):
+            raise ValueError(f"Unknown traversal order '{order}'.")
+        root = self.get_node(start)
+        if predicate is not None and not predicate(root):
+            return
+        visited = {start}
+
+        if order == 'bfs':
+            yield root
+            frontier = [start]
+            depth = 0
+            while frontier and (max_depth is None or depth < max_depth):
+                children = self._children_of(frontier, visited, predicate)
+                frontier = []
+                for node_versions in children.values():
+                    for node_version in node_versions:
+                        frontier.append(node_version.node_id)
+                        yield node_version
+                depth += 1
+            return
+
+        # Depth-first over the same levels: the level below a node is fetched
+        # when the walk first needs it, for the whole frontier at once
+        children = {}
+        frontier = [start]
+        fetched_depth = 0
+        stack = [(root, 0, False)]
+        while stack:
+            node_version, depth, expanded = stack.pop()
+            if expanded:
+                yield node_version
+                continue
+            if order == 'pre':
+                yield node_version
+            else:
+                stack.append((node_version, depth, True))
+            if max_depth is not None and depth >= max_depth:
+                continue
+            if fetched_depth == depth and frontier:
+                level = self._children_of(frontier, visited, predicate)
+                children.update(level)
+                frontier = [child.node_id for node_versions in level.values() for child in node_versions]
+                fetched_depth += 1
+            stack.extend(
+                (child, depth + 1, False) for child in reversed(children.pop(node_version.node_id, []))
+            )
+
+    @instrumented
     def traverse_tree(self, node_id, visited=None):
+        # Print the nodes below node_id in pre-order. Nodes already in
+        # `visited` are skipped and the set is updated in place. Like
+        # iter_nodes, this reads the structure from the adjacency index when
+        # it is loaded.
         if visited is None:
             visited = set()
-        if node_id in visited:
-            return
-        visited.add(node_id)
-        node = self.get_node(node_id)
-        print(f"Node {node_id} metadata: {node.data}")
-        edges = self.get_node_edges(node_id)
-        for edge_version in edges:
-            edge = edge_version.edge
-            outgoing_node_id = edge.outgoing_node.id if edge.incoming_node.id == node_id else None
-            if outgoing_node_id and outgoing_node_id not in visited:
-                self.traverse_tree(outgoing_node_id, visited)
+        for node_version in self.iter_nodes(
+            node_id, predicate=lambda node_version: node_version.node_id not in visited
+        ):
+            visited.add(node_version.node_id)
+            print(f"Node {node_version.node_id} metadata: {node_version.data}")
+
+    def _recursive_cte(self, ctes):
+        # Prefix `ctes` with the version's resolved nodes and edges as common
+        # table expressions, so recursive queries work for delta versions too
+        nodes_sql, nodes_params = _compile(self.effective_node_versions().values('node_id'))
+        edges_sql, edges_params = _compile(self.effective_edge_versions().values(
+            edge_version_id=F('id'),
+            source=F('source_node_id'),
+            target=F('target_node_id'),
+        ))
+        hint = _not_materialized(connections[TreeEdgeVersion.objects.db])
+        return (
+            f"WITH RECURSIVE nodes AS {hint}({nodes_sql}), edges AS {hint}({edges_sql}), {ctes}",
+            [*nodes_params, *edges_params],
+        )
+
+    def _nodes_from_walk(self, ctes, params, where='', where_params=()):
+        # Node versions whose node id is returned by the recursive `walk`,
+        # fetched in the same statement through an IN (WITH RECURSIVE ...) subquery
+        sql, cte_params = self._recursive_cte(ctes)
+        return self.effective_node_versions().filter(
+            node_id__in=RawSQL(
+                f"{sql} SELECT node_id FROM walk {where}",
+                [*cte_params, *params, *where_params],
+            )
+        )
+
+    @instrumented
+    def get_descendants(self, node_id, max_depth=None):
+        if max_depth is None:
+            # UNION drops rows already produced, which also stops on cycles
+            return self._nodes_from_walk(
+                """walk(node_id) AS (
+                    SELECT target FROM edges WHERE source = %s
+                    UNION
+                    SELECT edges.target FROM walk JOIN edges ON edges.source = walk.node_id
+                )""",
+                [node_id],
+            )
+        return self._nodes_from_walk(
+            """walk(node_id, depth) AS (
+                SELECT target, 1 FROM edges WHERE source = %s
+                UNION
+                SELECT edges.target, walk.depth + 1 FROM walk
+                JOIN edges ON edges.source = walk.node_id
+                WHERE walk.depth < %s
+            )""",
+            [node_id, max_depth],
+        )
+
+    @instrumented
+    def get_ancestors(self, node_id, max_depth=None):
+        if max_depth is None:
+            return self._nodes_from_walk(
+                """walk(node_id) AS (
+                    SELECT source FROM edges WHERE target = %s
+                    UNION
+                    SELECT edges.source FROM walk JOIN edges ON edges.target = walk.node_id
+                )""",
+                [node_id],
+            )
+        return self._nodes_from_walk(
+            """walk(node_id, depth) AS (
+                SELECT source, 1 FROM edges WHERE target = %s
+                UNION
+                SELECT edges.source, walk.depth + 1 FROM walk
+                JOIN edges ON edges.target = walk.node_id
+                WHERE walk.depth < %s
+            )""",
+            [node_id, max_depth],
+        )
+
+    @instrumented
+    def build_closure(self):
+        # (Re)build the closure table from the version's edges with a single
+        # recursive INSERT ... SELECT. Paths longer than the number of nodes
+        # can only come from cycles, so they bound the recursion.
+        closure_table = connections[TreeClosure.objects.db].ops.quote_name(TreeClosure._meta.db_table)
+        sql, params = self._recursive_cte(
+            """walk(ancestor, descendant, depth) AS (
+                SELECT node_id, node_id, 0 FROM nodes
+                UNION
+                SELECT walk.ancestor, edges.target, walk.depth + 1 FROM walk
+                JOIN edges ON edges.source = walk.descendant
+                JOIN nodes ON nodes.node_id = edges.target
+                WHERE walk.depth < (SELECT COUNT(*) FROM nodes)
+            )"""
+        )
+        with transaction.atomic():
+            self.closure_rows.all().delete()
+            with connections[TreeClosure.objects.db].cursor() as cursor:
+                cursor.execute(
+                    f"""{sql} INSERT INTO {closure_table} (version_id, ancestor_id, descendant_id, depth)
+                    SELECT %s, ancestor, descendant, MIN(depth) FROM walk GROUP BY ancestor, descendant""",
+                    [*params, self.id],
+                )
+            TreeVersion.objects.filter(pk=self.pk).update(has_closure=True)
+        self.has_closure = True
+
+    def _drop_closure(self):
+        # Removing an edge can split many ancestor/descendant pairs, so the
+        # closure is dropped and rebuilt the next time the version is tagged
+        self.closure_rows.all().delete()
+        TreeVersion.objects.filter(pk=self.pk).update(has_closure=False)
+        self.has_closure = False
+
+    def _add_closure_node(self, node_id):
+        TreeClosure.objects.bulk_create(
+            [TreeClosure(version=self, ancestor_id=node_id, descendant_id=node_id, depth=0)],
+            ignore_conflicts=True,
+        )
+
+    def _extend_closure(self, source_id, target_id):
+        # A new edge source -> target connects every ancestor of source
+        # (including itself) with every descendant of target (including itself)
+        closure_table = connections[TreeClosure.objects.db].ops.quote_name(TreeClosure._meta.db_table)
+        with connections[TreeClosure.objects.db].cursor() as cursor:
+            cursor.execute(
+                f"""INSERT INTO {closure_table} (version_id, ancestor_id, descendant_id, depth)
+                SELECT a.version_id, a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM {closure_table} a JOIN {closure_table} d ON d.version_id = a.version_id
+                WHERE a.version_id = %s AND a.descendant_id = %s AND d.ancestor_id = %s
+                AND NOT EXISTS (
+                    SELECT 1 FROM {closure_table} c
+                    WHERE c.version_id = a.version_id
+                    AND c.ancestor_id = a.ancestor_id
+                    AND c.descendant_id = d.descendant_id
+                )""",
+                [self.id, source_id, target_id],
+            )
+
+    @instrumented
+    def is_ancestor(self, ancestor_id, descendant_id):
+        if self.has_closure:
+            return self.closure_rows.filter(
+                ancestor_id=ancestor_id, descendant_id=descendant_id, depth__gt=0
+            ).exists()
+        return self.get_ancestors(descendant_id).filter(node_id=ancestor_id).exists()
 
+    @instrumented
+    def subtree_size(self, node_id):
+        # Number of nodes in the subtree rooted at node_id, the node included
+        if self.has_closure:
+            # Every node of the version has its depth-0 row, so no rows
+            # means the node is not in the version
+            size = self.closure_rows.filter(ancestor_id=node_id).count()
+            if not size:
+                raise ValueError(f"Node with id {node_id} does not exist in this version.")
+            return size
+        self.get_node(node_id)
+        return self.get_descendants(node_id).exclude(node_id=node_id).count() + 1
+
+    @instrumented
+    def node_depth(self, node_id):
+        # Distance from the root above node_id
+        farthest = self._farthest(node_id, upward=True)
+        if farthest is None:
+            raise ValueError(f"Node with id {node_id} does not exist in this version.")
+        return farthest[1]
+
+    def _farthest(self, node_id, upward):
+        # (node id, distance) of the ancestor (or with upward=False, the
+        # descendant) farthest from node_id, node_id itself at distance 0
+        # included, or None if node_id is not in the version. As in the
+        # closure, the distance of each node is its shortest one.
+        if self.has_closure:
+            near, far = ('descendant_id', 'ancestor_id') if upward else ('ancestor_id', 'descendant_id')
+            return self.closure_rows.filter(**{near: node_id}).order_by('-depth', far).values_list(
+                far, 'depth'
+            ).first()
+        # UNION keeps one row per node and distance, and the node count bounds
+        # the distance on cycles
+        near, far = ('target', 'source') if upward else ('source', 'target')
+        sql, params = self._recursive_cte(
+            f"""walk(node_id, distance) AS (
+                SELECT node_id, 0 FROM nodes WHERE node_id = %s
+                UNION
+                SELECT edges.{far}, walk.distance + 1 FROM walk
+                JOIN edges ON edges.{near} = walk.node_id
+                WHERE walk.distance < (SELECT COUNT(*) FROM nodes)
+                AND EXISTS (SELECT 1 FROM nodes WHERE nodes.node_id = edges.{far})
+            )"""
+        )
+        with connections[TreeEdgeVersion.objects.db].cursor() as cursor:
+            cursor.execute(
+                f"""{sql} SELECT node_id, MIN(distance) AS distance FROM walk
+                GROUP BY node_id ORDER BY distance DESC, node_id LIMIT 1""",
+                [*params, node_id],
+            )
+            return cursor.fetchone()
+
+    @instrumented
     def get_nodes_at_depth(self, depth):
-        from collections import deque
-
-        root_nodes = self.get_root_nodes()
-        nodes_at_depth = []
-        queue = deque([(node.node.id, 0) for node in root_nodes])
-
-        while queue:
-            current_node_id, current_depth = queue.popleft()
-            if current_depth == depth:
-                node_version = self.get_node(current_node_id)
-                nodes_at_depth.append(node_version)
-            elif current_depth < depth:
-                child_nodes = self.get_child_nodes(current_node_id)
-                for child in child_nodes:
-                    queue.append((child.node.id, current_depth + 1))
-        return nodes_at_depth
+        # Nodes reachable from a root by a path of exactly `depth` edges, once
+        # each and ordered by id, whether or not the adjacency index is loaded
+        if getattr(self, '_adjacency', None) is not None:
+            node_ids = self._adjacency.nodes_at_depth(depth)
+            node_versions = self._node_versions_by_node_id(node_ids)
+            return [node_versions[node_id] for node_id in node_ids]
+        # Walk down from the roots in the database; the depth bound keeps the
+        # recursion finite even if the graph has cycles. Node membership is
+        # checked with EXISTS rather than a join, which keeps the planner on
+        # the (version, source_node) index for each step.
+        return list(self._nodes_from_walk(
+            """walk(node_id, depth) AS (
+                SELECT node_id, 0 FROM nodes
+                WHERE node_id NOT IN (
+                    SELECT edges.target FROM edges JOIN nodes parents ON parents.node_id = edges.source
+                )
+                UNION
+                SELECT edges.target, walk.depth + 1 FROM walk
+                JOIN edges ON edges.source = walk.node_id
+                WHERE walk.depth < %s
+                AND EXISTS (SELECT 1 FROM nodes WHERE nodes.node_id = edges.target)
+            )""",
+            [depth],
+            where='WHERE depth = %s',
+            where_params=[depth],
+        ).order_by('node_id'))
 
+    @instrumented
     def find_path(self, start_node_id, end_node_id):
-        from collections import deque
-
-        queue = deque()
-        queue.append((start_node_id, []))
-        visited = set()
-
-        while queue:
-            current_node_id, path = queue.popleft()
-            if current_node_id == end_node_id:
-                # Return the path along with the edges
-                return path + [(current_node_id, None)]
-            if current_node_id in visited:
-                continue
-            visited.add(current_node_id)
-            edges = self.edge_versions.filter(edge__incoming_node__id=current_node_id)
-            for edge_version in edges:
-                edge = edge_version.edge
-                next_node_id = edge.outgoing_node.id
-                queue.append((next_node_id, path + [(current_node_id, edge_version)]))
-        return None
+        if getattr(self, '_adjacency', None) is not None:
+            path = self._adjacency.find_path(start_node_id, end_node_id)
+        else:
+            path = self._find_path_in_database(start_node_id, end_node_id)
+        if path is None:
+            return None
+        # Return the path along with the edges
+        edge_versions = self._edge_versions_by_id(
+            edge_version_id for _, edge_version_id in path if edge_version_id is not None
+        )
+        return [
+            (node_id, edge_versions[edge_version_id] if edge_version_id is not None else None)
+            for node_id, edge_version_id in path
+        ]
 
+    def _find_path_in_database(self, start_node_id, end_node_id):
+        # Breadth-first search back from the end node: UNION keeps one row
+        # per node and distance, and the node count bounds the distance on
+        # cycles. Only the edges that bring an ancestor one step closer to
+        # the end node are fetched, and the path is then followed from the
+        # start node in Python, as in TreeAdjacency.find_path.
+        if start_node_id == end_node_id:
+            return [(start_node_id, None)]
+        sql, params = self._recursive_cte(
+            """back(node_id, distance) AS (
+                SELECT node_id, 0 FROM nodes WHERE node_id = %s
+                UNION
+                SELECT edges.source, back.distance + 1 FROM back
+                JOIN edges ON edges.target = back.node_id
+                WHERE back.node_id <> %s AND back.distance < (SELECT COUNT(*) FROM nodes)
+                AND EXISTS (SELECT 1 FROM nodes WHERE nodes.node_id = edges.source)
+            ),
+            distances(node_id, distance) AS (
+                SELECT node_id, MIN(distance) FROM back GROUP BY node_id
+            )"""
+        )
+        connection = connections[TreeEdgeVersion.objects.db]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""{sql} SELECT edges.source, edges.target, MIN(edges.edge_version_id), s.distance
+                FROM edges
+                JOIN distances s ON s.node_id = edges.source
+                JOIN distances t ON t.node_id = edges.target AND t.distance = s.distance - 1
+                GROUP BY edges.source, edges.target, s.distance""",
+                [*params, end_node_id, start_node_id],
+            )
+            rows = cursor.fetchall()
+        distances = {end_node_id: 0}
+        children = {}
+        edge_ids = {}
+        for source_id, target_id, edge_version_id, distance in rows:
+            distances[source_id] = distance
+            children.setdefault(source_id, []).append(target_id)
+            edge_ids[(source_id, target_id)] = edge_version_id
+        if start_node_id not in distances:
+            return None
+        return walk_shortest_path(
+            start_node_id, end_node_id, distances, lambda node_id: children.get(node_id, []), edge_ids
+        )
+
+
+class TreeClosure(models.Model):
+    # One row per (ancestor, descendant) pair of a version, including each
+    # node paired with itself at depth 0
+    version = models.ForeignKey(TreeVersion, on_delete=models.CASCADE, related_name='closure_rows')
+    ancestor = models.ForeignKey(TreeNode, on_delete=models.CASCADE, related_name='+')
+    descendant = models.ForeignKey(TreeNode, on_delete=models.CASCADE, related_name='+')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['version', 'ancestor', 'descendant'],
+                name='unique_closure_pair',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['version', 'descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"Closure {self.ancestor_id} -> {self.descendant_id} ({self.depth}) in Version {self.version_id}"
 
-class TreeNodeVersion(models.Model):
+
+class TreeVersionStats(models.Model):
+    # Summary of a version's structure for listings, filled when the version
+    # is tagged or branched and kept up to date by its mutators. max_depth is
+    # NULL while it needs recounting with version.refresh_stats().
+    version = models.OneToOneField(TreeVersion, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    node_count = models.PositiveIntegerField(default=0)
+    edge_count = models.PositiveIntegerField(default=0)
+    root_count = models.PositiveIntegerField(default=0)
+    max_depth = models.PositiveIntegerField(null=True)
+
+    def __str__(self):
+        return f"Stats of Version {self.version_id}: {self.node_count} nodes, {self.edge_count} edges"
+
+
+class TreeNodeVersion(PayloadModel):
     node = models.ForeignKey(TreeNode, on_delete=models.CASCADE, related_name='versions')
     version = models.ForeignKey(TreeVersion, on_delete=models.CASCADE, related_name='node_versions')
-    data = models.JSONField()
+    # Tombstone marking the node as removed in this version
+    is_removed = models.BooleanField(default=False)
     created_at = models.DateTimeField(default=now)
 
+    class Meta:
+        # A node has at most one row per version; the constraint's index also
+        # serves lookups of a node within a version
+        constraints = [
+            models.UniqueConstraint(fields=['version', 'node'], name='unique_node_per_version'),
+        ]
+        # Finds the rows using a payload, for queries on indexed paths
+        indexes = [
+            models.Index(fields=['payload', 'version']),
+        ]
+
     def __str__(self):
         return f"NodeVersion {self.id} for Node {self.node.id} in Version {self.version.id}"
 
-class TreeEdgeVersion(models.Model):
+class TreeEdgeVersionQuerySet(PayloadQuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # Copy the endpoints of the edges for rows created without them
+        objs = list(objs)
+        missing = [obj for obj in objs if obj.source_node_id is None]
+        for start in range(0, len(missing), MAX_IN_IDS):
+            chunk = missing[start:start + MAX_IN_IDS]
+            endpoints = {
+                edge_id: (source_id, target_id)
+                for edge_id, source_id, target_id in TreeEdge.objects.filter(
+                    id__in={obj.edge_id for obj in chunk}
+                ).values_list('id', 'incoming_node_id', 'outgoing_node_id')
+            }
+            for obj in chunk:
+                obj.source_node_id, obj.target_node_id = endpoints[obj.edge_id]
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class TreeEdgeVersionManager(PayloadManager.from_queryset(TreeEdgeVersionQuerySet)):
+    pass
+
+
+class TreeEdgeVersion(PayloadModel):
     edge = models.ForeignKey(TreeEdge, on_delete=models.CASCADE, related_name='versions')
     version = models.ForeignKey(TreeVersion, on_delete=models.CASCADE, related_name='edge_versions')
-    data = models.JSONField()
+    # The edge's endpoints, copied from TreeEdge so child/parent lookups are
+    # index range scans on this table instead of joins. Deleting a node
+    # already deletes these rows through its edges.
+    source_node = models.ForeignKey(TreeNode, on_delete=models.DO_NOTHING, related_name='+', db_index=False)
+    target_node = models.ForeignKey(TreeNode, on_delete=models.DO_NOTHING, related_name='+', db_index=False)
+    # Tombstone marking the edge as removed in this version
+    is_removed = models.BooleanField(default=False)
     created_at = models.DateTimeField(default=now)
 
+    objects = TreeEdgeVersionManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['version', 'edge'], name='unique_edge_per_version'),
+        ]
+        indexes = [
+            models.Index(fields=['version', 'source_node']),
+            models.Index(fields=['version', 'target_node']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.source_node_id is None:
+            self.source_node_id, self.target_node_id = TreeEdge.objects.values_list(
+                'incoming_node_id', 'outgoing_node_id'
+            ).get(pk=self.edge_id)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"EdgeVersion {self.id} for Edge {self.edge.id} in Version {self.version.id}"
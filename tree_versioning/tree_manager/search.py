@@ -0,0 +1,159 @@
+import math
+import re
+from collections import Counter
+
+from django.db import connections
+from django.db.models import Count, Exists, F, Max, OuterRef
+
+# Full-text search over node payloads. Each payload is indexed once, as a
+# SearchDocument, when the first version using it is tagged. On SQLite with
+# FTS5 the text goes into the FTS5 table created by migration 0009 and is
+# ranked with bm25; elsewhere it is tokenized here into SearchToken rows and
+# ranked by tf-idf. Either way a query matches documents containing all of
+# its words.
+FTS_TABLE = 'tree_manager_payloadsearch'
+
+# Words as FTS5's unicode61 tokenizer sees them: runs of letters and digits
+_WORD = re.compile(r'[^\W_]+')
+
+_fts_available = {}
+
+
+def has_fts(alias):
+    if alias not in _fts_available:
+        connection = connections[alias]
+        _fts_available[alias] = (
+            connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_available[alias]
+
+
+def tokenize(text):
+    return _WORD.findall(text.lower())
+
+
+def payload_text(data):
+    # The searchable text of a payload: its object keys and scalar values
+    if isinstance(data, dict):
+        return ' '.join(f'{key} {payload_text(value)}' for key, value in data.items())
+    if isinstance(data, list):
+        return ' '.join(payload_text(value) for value in data)
+    if isinstance(data, bool) or data is None:
+        return ''
+    return str(data)
+
+
+def index_version(version):
+    # Index the payloads of `version` that are not indexed yet
+    from .models import MAX_IN_IDS, SearchDocument, SearchToken, _compile, _insert_from_select
+
+    alias = SearchDocument.objects.db
+    last_id = SearchDocument.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    rows = version.effective_node_versions().exclude(
+        Exists(SearchDocument.objects.filter(payload_id=OuterRef('payload_id')))
+    ).distinct()
+    if not _insert_from_select(SearchDocument, rows, payload='payload_id'):
+        return
+    documents = SearchDocument.objects.filter(id__gt=last_id)
+
+    connection = connections[alias]
+    if has_fts(alias):
+        # Extract the text in SQL, so indexing stays one statement however
+        # many payloads are new
+        documents_sql, params = _compile(documents.values(document_id=F('id'), data=F('payload__data')))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""INSERT OR REPLACE INTO {FTS_TABLE} (rowid, content)
+                SELECT d.document_id, (
+                    SELECT group_concat(
+                        CASE WHEN typeof(t.key) = 'text' THEN t.key ELSE '' END || ' ' ||
+                        CASE WHEN t.type IN ('text', 'integer', 'real') THEN t.atom ELSE '' END,
+                        ' '
+                    ) FROM json_tree(d.data) t
+                ) FROM ({documents_sql}) d""",
+                params,
+            )
+        return
+
+    ids = list(documents.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(ids), MAX_IN_IDS):
+        tokens = []
+        for document_id, data in documents.filter(id__in=ids[start:start + MAX_IN_IDS]).values_list(
+            'id', 'payload__data'
+        ):
+            counts = Counter(tokenize(payload_text(data)))
+            tokens.extend(
+                SearchToken(document_id=document_id, token=token[:255], count=count)
+                for token, count in counts.items()
+            )
+        SearchToken.objects.bulk_create(tokens, batch_size=MAX_IN_IDS, ignore_conflicts=True)
+
+
+def search_version(version, query, limit=20):
+    # The best `limit` node versions of `version` matching `query`
+    from .models import SearchDocument, SearchToken, TreeNodeVersion, _compile
+
+    words = list(dict.fromkeys(tokenize(query)))
+    if not words or limit <= 0:
+        return []
+    alias = TreeNodeVersion.objects.db
+    nodes_sql, nodes_params = _compile(version.effective_node_versions().values('id', 'payload_id'))
+    documents_table = SearchDocument._meta.db_table
+
+    if has_fts(alias):
+        # Quoted, so the words are searched for literally and never parsed as
+        # FTS5 operators
+        match = ' '.join(f'"{word}"' for word in words)
+        sql = f"""WITH nodes AS ({nodes_sql})
+            SELECT nodes.id FROM {FTS_TABLE}
+            JOIN {documents_table} d ON d.id = {FTS_TABLE}.rowid
+            JOIN nodes ON nodes.payload_id = d.payload_id
+            WHERE {FTS_TABLE} MATCH %s
+            ORDER BY {FTS_TABLE}.rank, nodes.id LIMIT %s"""
+        params = [*nodes_params, match, limit]
+    else:
+        # tf-idf: occurrences of each word weighted by how rare it is
+        total = SearchDocument.objects.count()
+        frequencies = dict(
+            SearchToken.objects.filter(token__in=words).values('token').annotate(
+                documents=Count('document')
+            ).values_list('token', 'documents')
+        )
+        if len(frequencies) < len(words):
+            return []
+        weights = ' '.join('WHEN %s THEN %s' for _ in words)
+        tokens_table = SearchToken._meta.db_table
+        sql = f"""WITH nodes AS ({nodes_sql})
+            SELECT nodes.id FROM {tokens_table} t
+            JOIN {documents_table} d ON d.id = t.document_id
+            JOIN nodes ON nodes.payload_id = d.payload_id
+            WHERE t.token IN ({', '.join(['%s'] * len(words))})
+            GROUP BY nodes.id HAVING COUNT(*) = %s
+            ORDER BY SUM(t.count * CASE t.token {weights} END) DESC, nodes.id LIMIT %s"""
+        params = [*nodes_params, *words, len(words)]
+        for word in words:
+            params += [word, math.log(1 + total / frequencies[word])]
+        params.append(limit)
+
+    with connections[alias].cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+    node_versions = TreeNodeVersion.objects.in_bulk(ids)
+    return [node_versions[node_version_id] for node_version_id in ids]
+
+
+def unindex(documents):
+    # Remove `documents` (a SearchDocument queryset) from the index, along
+    # with their FTS5 rows or tokens. Returns the number removed.
+    from .models import MAX_IN_IDS, SearchDocument, SearchToken
+
+    alias = documents.db
+    ids = list(documents.values_list('id', flat=True))
+    for start in range(0, len(ids), MAX_IN_IDS):
+        chunk = ids[start:start + MAX_IN_IDS]
+        if has_fts(alias):
+            with connections[alias].cursor() as cursor:
+                cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(chunk))})", chunk)
+        SearchToken.objects.filter(document_id__in=chunk)._raw_delete(alias)
+        SearchDocument.objects.filter(id__in=chunk)._raw_delete(alias)
+    return len(ids)
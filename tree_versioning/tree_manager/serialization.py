@@ -0,0 +1,151 @@
+import json
+
+from django.db import transaction
+
+from .models import Tree, TreeEdge, TreeNode
+
+# A version is exported as newline-delimited JSON: one header record, then
+# every node, then every edge.
+#
+#   {"type": "version", "tree": "...", "tag": "...", "description": "..."}
+#   {"type": "node", "id": 1, "data": {...}}
+#   {"type": "edge", "id": 7, "source": 1, "target": 2, "data": {...}}
+#
+# Ids are those of the exporting database; the importer maps them to new rows.
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def _dump(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def _header(version, tree):
+    tag = getattr(version, 'tag', None)
+    return _dump({
+        'type': 'version',
+        'tree': tree.name,
+        'tag': tag.name if tag else None,
+        'description': tag.description if tag else None,
+    })
+
+
+# Rows are read with values() rather than values_list(): only values()
+# builds its rows lazily, which aiterator() needs to fetch them off the
+# event loop.
+def _node_rows(version):
+    return version.effective_node_versions().values('node_id', 'payload__data')
+
+
+def _edge_rows(version):
+    return version.effective_edge_versions().values(
+        'edge_id', 'source_node_id', 'target_node_id', 'payload__data'
+    )
+
+
+def _node_line(row):
+    return _dump({'type': 'node', 'id': row['node_id'], 'data': row['payload__data']})
+
+
+def _edge_line(row):
+    return _dump({
+        'type': 'edge',
+        'id': row['edge_id'],
+        'source': row['source_node_id'],
+        'target': row['target_node_id'],
+        'data': row['payload__data'],
+    })
+
+
+def iter_version_ndjson(version, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Yield the version line by line. Rows are fetched with server-side
+    # chunking, so memory stays flat regardless of the version's size.
+    yield _header(version, version.tree)
+    for row in _node_rows(version).iterator(chunk_size=chunk_size):
+        yield _node_line(row)
+    for row in _edge_rows(version).iterator(chunk_size=chunk_size):
+        yield _edge_line(row)
+
+
+async def aiter_version_ndjson(version, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Async counterpart of iter_version_ndjson for streaming from async views
+    tree = await Tree.objects.aget(pk=version.tree_id)
+    await version.aversion_chain()
+    yield _header(version, tree)
+    async for row in _node_rows(version).aiterator(chunk_size=chunk_size):
+        yield _node_line(row)
+    async for row in _edge_rows(version).aiterator(chunk_size=chunk_size):
+        yield _edge_line(row)
+
+
+def export_version(version, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    for line in iter_version_ndjson(version, chunk_size=chunk_size):
+        stream.write(line)
+
+
+def import_version(lines, tree_name=None, tag_name=None, description=None, batch_size=DEFAULT_CHUNK_SIZE):
+    # Rebuild a Tree and a tagged version from an NDJSON stream. Nodes and
+    # edges are written with bulk inserts, one short transaction per batch;
+    # the tagged version is then snapshotted set-based by create_tag. If the
+    # import fails, the partially imported tree is deleted.
+    records = (json.loads(line) for line in lines if line.strip())
+    header = next(records, None)
+    if header is None or header.get('type') != 'version':
+        raise ValueError("The stream does not start with a version record.")
+    tag_name = tag_name or header.get('tag')
+    if not tag_name:
+        raise ValueError("A tag name is required to import a version.")
+
+    tree = Tree.objects.create(name=tree_name or header['tree'])
+    try:
+        node_ids = {}
+        node_batch = []
+        edge_batch = []
+
+        def flush_nodes():
+            with transaction.atomic():
+                created = TreeNode.objects.bulk_create(
+                    [TreeNode(tree=tree, data=record['data']) for record in node_batch]
+                )
+            for record, node in zip(node_batch, created):
+                node_ids[record['id']] = node.id
+            node_batch.clear()
+
+        def flush_edges():
+            with transaction.atomic():
+                TreeEdge.objects.bulk_create([
+                    TreeEdge(
+                        incoming_node_id=node_ids[record['source']],
+                        outgoing_node_id=node_ids[record['target']],
+                        data=record['data'],
+                    )
+                    for record in edge_batch
+                ])
+            edge_batch.clear()
+
+        for record in records:
+            if record['type'] == 'node':
+                if edge_batch:
+                    raise ValueError("Node records must come before edge records.")
+                node_batch.append(record)
+                if len(node_batch) >= batch_size:
+                    flush_nodes()
+            elif record['type'] == 'edge':
+                if node_batch:
+                    flush_nodes()
+                missing = {record['source'], record['target']} - node_ids.keys()
+                if missing:
+                    raise ValueError(f"Edge {record['id']} references unknown nodes: {sorted(missing)}")
+                edge_batch.append(record)
+                if len(edge_batch) >= batch_size:
+                    flush_edges()
+            else:
+                raise ValueError(f"Unknown record type '{record['type']}'.")
+        if node_batch:
+            flush_nodes()
+        if edge_batch:
+            flush_edges()
+
+        return tree.create_tag(name=tag_name, description=description or header.get('description'))
+    except Exception:
+        tree.delete()
+        raise
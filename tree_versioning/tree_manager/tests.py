@@ -1,12 +1,40 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
 from tree_manager.models import (
     Tree,
+    Tag,
     TreeNode,
     TreeEdge,
     TreeVersion,
     TreeNodeVersion,
     TreeEdgeVersion,
+    TreeClosure,
+    TreeVersionStats,
+    PayloadBlob,
+    SearchDocument,
+    SearchToken,
+    payload_hash,
 )
+from tree_manager import garbage, instrumentation, search
+from tree_manager.benchmarks import build_tree
+from tree_manager.cache import version_cache
+from tree_manager.garbage import collect_garbage
+from tree_manager.instrumentation import instrument, operation_finished, record_operations
+from tree_manager.serialization import export_version, import_version, iter_version_ndjson
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 class ConfigurationManagementTestCase(TestCase):
@@ -318,3 +346,1726 @@ class NodeAndEdgeMetadataVersioningTestCase(TestCase):
         # Ensure changes made in the updated version do not exist in the rolled-back version
         with self.assertRaises(ValueError):
             rolled_back_version.get_node(self.node2.id + 1)  # Assuming no additional nodes exist
+
+class BulkSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Bulk Tree")
+
+    def _build_chain(self, tree, size):
+        nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=tree, data={"index": i}) for i in range(size)]
+        )
+        TreeEdge.objects.bulk_create([
+            TreeEdge(incoming_node=parent, outgoing_node=child, data={"relation": "child"})
+            for parent, child in zip(nodes, nodes[1:])
+        ])
+        return nodes
+
+    def test_snapshot_query_count_is_independent_of_tree_size(self):
+        small_tree = Tree.objects.create(name="Small Tree")
+        self._build_chain(small_tree, 3)
+        self._build_chain(self.tree, 100)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            small_tree.create_tag(name="small")
+        with CaptureQueriesContext(connection) as large_queries:
+            self.tree.create_tag(name="large")
+
+        self.assertEqual(len(small_queries), len(large_queries))
+        version = self.tree.get_by_tag("large")
+        self.assertEqual(version.node_versions.count(), 100)
+        self.assertEqual(version.edge_versions.count(), 99)
+
+    def test_branch_copies_version_data(self):
+        small_tree = Tree.objects.create(name="Small Tree")
+        self._build_chain(small_tree, 2)
+        small_tree.create_tag(name="small-base")
+        nodes = self._build_chain(self.tree, 10)
+        self.tree.create_tag(name="base")
+
+        with CaptureQueriesContext(connection) as small_queries:
+            small_tree.create_new_tree_version_from_tag("small-base")
+        with CaptureQueriesContext(connection) as queries:
+            branch = self.tree.create_new_tree_version_from_tag("base")
+        self.assertEqual(len(small_queries), len(queries))
+
+        self.assertEqual(branch.node_versions.count(), 10)
+        self.assertEqual(branch.edge_versions.count(), 9)
+        self.assertEqual(branch.get_node(nodes[3].id).data, {"index": 3})
+
+        # Tagging the branch keeps its own copies instead of duplicating them
+        self.tree.create_tag(name="branch", version=branch)
+        self.assertEqual(branch.node_versions.count(), 10)
+        self.assertEqual(branch.edge_versions.count(), 9)
+
+class DeltaVersionTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Delta Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        self.leaf = TreeNode.objects.create(tree=self.tree, data={"name": "leaf"})
+        self.root_edge = TreeEdge.objects.create(
+            incoming_node=self.root, outgoing_node=self.child, data={"relation": "child"}
+        )
+        self.leaf_edge = TreeEdge.objects.create(
+            incoming_node=self.child, outgoing_node=self.leaf, data={"relation": "child"}
+        )
+        self.tree.create_tag(name="base")
+        self.base = self.tree.get_by_tag("base")
+
+    def test_delta_branch_stores_nothing_and_reads_through_parent(self):
+        branch = self.tree.create_new_tree_version_from_tag("base", delta=True)
+        self.assertTrue(branch.is_delta)
+        self.assertEqual(branch.node_versions.count(), 0)
+        self.assertEqual(branch.edge_versions.count(), 0)
+
+        self.assertEqual(branch.get_node(self.child.id).data, {"name": "child"})
+        self.assertEqual([nv.node_id for nv in branch.get_root_nodes()], [self.root.id])
+        self.assertEqual([nv.node_id for nv in branch.get_child_nodes(self.root.id)], [self.child.id])
+        path = branch.find_path(self.root.id, self.leaf.id)
+        self.assertEqual([node_id for node_id, _ in path], [self.root.id, self.child.id, self.leaf.id])
+
+    def test_delta_branch_stores_only_changes(self):
+        branch = self.tree.create_new_tree_version_from_tag("base", delta=True)
+        branch.add_existing_node(self.child, data={"name": "changed"})
+        new_node = branch.add_node(data={"name": "new"})
+        branch.add_edge(self.root.id, new_node.node_id, data={"relation": "child"})
+        branch.remove_node(self.leaf.id)
+
+        # Changed node, new node, tombstone for the leaf; new edge, tombstone for the leaf edge
+        self.assertEqual(branch.node_versions.count(), 3)
+        self.assertEqual(branch.edge_versions.count(), 2)
+
+        self.assertEqual(branch.get_node(self.child.id).data, {"name": "changed"})
+        with self.assertRaises(ValueError):
+            branch.get_node(self.leaf.id)
+        self.assertEqual(branch.get_child_nodes(self.child.id).count(), 0)
+        self.assertEqual(
+            sorted(nv.node_id for nv in branch.get_child_nodes(self.root.id)),
+            [self.child.id, new_node.node_id],
+        )
+
+        # The parent version is untouched
+        self.assertEqual(self.base.get_node(self.child.id).data, {"name": "child"})
+        self.assertEqual(self.base.get_node(self.leaf.id).data, {"name": "leaf"})
+
+    def test_nested_delta_and_full_branches_resolve_the_chain(self):
+        branch = self.tree.create_new_tree_version_from_tag("base", delta=True)
+        branch.add_existing_node(self.root, data={"name": "root-v2"})
+        branch.remove_edge(self.leaf_edge.id)
+        self.tree.create_tag(name="v2", version=branch)
+
+        nested = self.tree.create_new_tree_version_from_tag("v2", delta=True)
+        self.assertEqual(nested.version_chain(), [nested.id, branch.id, self.base.id])
+        self.assertEqual(nested.get_node(self.root.id).data, {"name": "root-v2"})
+        self.assertEqual(
+            sorted(nv.node_id for nv in nested.get_root_nodes()),
+            [self.root.id, self.leaf.id],
+        )
+
+        # A full branch of a delta version materializes the resolved state
+        full = self.tree.create_new_tree_version_from_tag("v2")
+        self.assertFalse(full.is_delta)
+        self.assertEqual(full.node_versions.count(), 3)
+        self.assertEqual(full.edge_versions.count(), 1)
+        self.assertEqual(full.get_node(self.root.id).data, {"name": "root-v2"})
+
+class AdjacencyIndexTestCase(TestCase):
+    def _build_tree(self, name, size):
+        tree = Tree.objects.create(name=name)
+        nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=tree, data={"index": i}) for i in range(size)]
+        )
+        # Binary tree: node i is the parent of nodes 2i+1 and 2i+2
+        TreeEdge.objects.bulk_create([
+            TreeEdge(incoming_node=nodes[(i - 1) // 2], outgoing_node=nodes[i], data={"index": i})
+            for i in range(1, size)
+        ])
+        tree.create_tag(name=name)
+        return tree.get_by_tag(name), nodes
+
+    def test_index_structure(self):
+        version, nodes = self._build_tree("index", 7)
+        index = version.adjacency_index()
+        self.assertEqual(len(index), 7)
+        self.assertEqual(index.get_roots(), [nodes[0].id])
+        self.assertEqual(index.get_children(nodes[1].id), [nodes[3].id, nodes[4].id])
+        self.assertEqual(index.get_parents(nodes[6].id), [nodes[2].id])
+        self.assertIs(version.adjacency_index(), index)
+
+        # Mutations rebuild the index on next use
+        new_node = version.add_node(data={"index": 7})
+        version.add_edge(nodes[6].id, new_node.node_id, data={})
+        self.assertEqual(version.adjacency_index().get_children(nodes[6].id), [new_node.node_id])
+
+    def test_traversal_query_count_is_independent_of_tree_size(self):
+        small, small_nodes = self._build_tree("small", 7)
+        large, large_nodes = self._build_tree("large", 127)
+
+        def run(version, nodes):
+            with CaptureQueriesContext(connection) as queries:
+                at_depth = version.get_nodes_at_depth(2)
+                path = version.find_path(nodes[0].id, nodes[6].id)
+            return queries, at_depth, path
+
+        small_queries, small_at_depth, small_path = run(small, small_nodes)
+        large_queries, large_at_depth, large_path = run(large, large_nodes)
+        self.assertEqual(len(small_queries), len(large_queries))
+
+        self.assertEqual([nv.node_id for nv in large_at_depth], [n.id for n in large_nodes[3:7]])
+        self.assertEqual(
+            [node_id for node_id, _ in large_path],
+            [large_nodes[0].id, large_nodes[2].id, large_nodes[6].id],
+        )
+        self.assertEqual(large_path[0][1].data, {"index": 2})
+        self.assertIsNone(large_path[-1][1])
+
+class RecursiveQueryTestCase(TestCase):
+    def setUp(self):
+        # 0 -> 1 -> 3 -> 5
+        #   -> 2 -> 4
+        self.tree = Tree.objects.create(name="Recursive Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(6)]
+        )
+        for parent, child in [(0, 1), (0, 2), (1, 3), (2, 4), (3, 5)]:
+            TreeEdge.objects.create(
+                incoming_node=self.nodes[parent], outgoing_node=self.nodes[child], data={}
+            )
+        self.tree.create_tag(name="recursive")
+        self.version = self.tree.get_by_tag("recursive")
+
+    def ids(self, *indexes):
+        return sorted(self.nodes[i].id for i in indexes)
+
+    def test_descendants_and_ancestors(self):
+        with self.assertNumQueries(1):
+            descendants = sorted(nv.node_id for nv in self.version.get_descendants(self.nodes[1].id))
+        self.assertEqual(descendants, self.ids(3, 5))
+        self.assertEqual(
+            sorted(nv.node_id for nv in self.version.get_descendants(self.nodes[0].id, max_depth=2)),
+            self.ids(1, 2, 3, 4),
+        )
+        with self.assertNumQueries(1):
+            ancestors = sorted(nv.node_id for nv in self.version.get_ancestors(self.nodes[5].id))
+        self.assertEqual(ancestors, self.ids(0, 1, 3))
+        self.assertEqual(
+            sorted(nv.node_id for nv in self.version.get_ancestors(self.nodes[5].id, max_depth=1)),
+            self.ids(3),
+        )
+        self.assertEqual(self.version.get_descendants(self.nodes[5].id).count(), 0)
+
+    def test_depth_and_path_queries_run_in_the_database(self):
+        with self.assertNumQueries(1):
+            at_depth = self.version.get_nodes_at_depth(2)
+        self.assertEqual([nv.node_id for nv in at_depth], self.ids(3, 4))
+
+        with self.assertNumQueries(2):
+            path = self.version.find_path(self.nodes[0].id, self.nodes[5].id)
+        self.assertEqual([node_id for node_id, _ in path], [self.nodes[i].id for i in (0, 1, 3, 5)])
+        self.assertEqual(
+            [edge_version.edge.outgoing_node_id for _, edge_version in path[:-1]],
+            [self.nodes[i].id for i in (1, 3, 5)],
+        )
+        self.assertIsNone(self.version.find_path(self.nodes[1].id, self.nodes[4].id))
+        self.assertEqual(self.version.find_path(self.nodes[2].id, self.nodes[2].id), [(self.nodes[2].id, None)])
+
+        # The in-memory index gives the same answers once it is loaded
+        self.version.adjacency_index()
+        self.assertEqual([nv.node_id for nv in self.version.get_nodes_at_depth(2)], self.ids(3, 4))
+        self.assertEqual(
+            [node_id for node_id, _ in self.version.find_path(self.nodes[0].id, self.nodes[5].id)],
+            [self.nodes[i].id for i in (0, 1, 3, 5)],
+        )
+
+    def test_database_and_index_agree_on_shared_descendants(self):
+        # A diamond 0 -> 1 -> 3, 0 -> 2 -> 3 with a second edge 1 -> 3: node 3
+        # is reached through several shortest paths
+        extra = TreeEdge.objects.create(incoming_node=self.nodes[1], outgoing_node=self.nodes[3], data={})
+        TreeEdge.objects.create(incoming_node=self.nodes[2], outgoing_node=self.nodes[3], data={})
+        self.tree.create_tag(name="diamond")
+
+        def answers(version):
+            return (
+                [nv.node_id for nv in version.get_nodes_at_depth(2)],
+                [(node_id, edge.id if edge else None) for node_id, edge in version.find_path(
+                    self.nodes[0].id, self.nodes[5].id
+                )],
+            )
+
+        version = self.tree.get_by_tag("diamond")
+        with self.assertNumQueries(3):
+            in_database = answers(version)
+        version.adjacency_index()
+        self.assertEqual(answers(version), in_database)
+        self.assertEqual(answers(version.materialize()), in_database)
+
+        self.assertEqual(in_database[0], self.ids(3, 4))
+        path = in_database[1]
+        self.assertEqual([node_id for node_id, _ in path], [self.nodes[i].id for i in (0, 1, 3, 5)])
+        # Of the parallel edges 1 -> 3 the older one is taken
+        self.assertLess(path[1][1], TreeEdgeVersion.objects.get(edge=extra, version=version).id)
+
+    def test_recursive_queries_resolve_delta_versions(self):
+        branch = self.tree.create_new_tree_version_from_tag("recursive", delta=True)
+        branch.remove_node(self.nodes[3].id)
+        self.assertEqual(
+            sorted(nv.node_id for nv in branch.get_descendants(self.nodes[0].id)),
+            self.ids(1, 2, 4),
+        )
+        self.assertIsNone(branch.find_path(self.nodes[0].id, self.nodes[5].id))
+        self.assertEqual([nv.node_id for nv in branch.get_nodes_at_depth(2)], self.ids(4))
+
+class ClosureTableTestCase(TestCase):
+    def setUp(self):
+        # 0 -> 1 -> 2, 0 -> 3
+        self.tree = Tree.objects.create(name="Closure Tree", maintain_closure=True)
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(4)]
+        )
+        for parent, child in [(0, 1), (1, 2), (0, 3)]:
+            TreeEdge.objects.create(
+                incoming_node=self.nodes[parent], outgoing_node=self.nodes[child], data={}
+            )
+        self.tree.create_tag(name="closure")
+        self.version = self.tree.get_by_tag("closure")
+
+    def test_closure_is_built_when_tagging(self):
+        self.assertTrue(self.version.has_closure)
+        # 4 self pairs + (0,1) (0,2) (0,3) (1,2)
+        self.assertEqual(self.version.closure_rows.count(), 8)
+        self.assertEqual(
+            self.version.closure_rows.get(ancestor=self.nodes[0], descendant=self.nodes[2]).depth, 2
+        )
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.version.is_ancestor(self.nodes[0].id, self.nodes[2].id))
+        self.assertFalse(self.version.is_ancestor(self.nodes[3].id, self.nodes[2].id))
+        self.assertFalse(self.version.is_ancestor(self.nodes[2].id, self.nodes[2].id))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.version.subtree_size(self.nodes[0].id), 4)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.version.node_depth(self.nodes[2].id), 2)
+        # Missing nodes raise like they do without the closure table
+        with self.assertRaises(ValueError):
+            self.version.subtree_size(-1)
+        with self.assertRaises(ValueError):
+            self.version.node_depth(-1)
+
+    def test_closure_is_maintained_on_branches(self):
+        branch = self.tree.create_new_tree_version_from_tag("closure")
+        self.assertTrue(branch.has_closure)
+        self.assertEqual(branch.closure_rows.count(), 8)
+
+        new_node = branch.add_node(data={"index": 4})
+        branch.add_edge(self.nodes[2].id, new_node.node_id, data={})
+        self.assertTrue(branch.is_ancestor(self.nodes[0].id, new_node.node_id))
+        self.assertEqual(branch.node_depth(new_node.node_id), 3)
+        self.assertEqual(branch.subtree_size(self.nodes[1].id), 3)
+        # The tagged version is unaffected
+        self.assertEqual(self.version.subtree_size(self.nodes[1].id), 2)
+
+        # Removing an edge drops the closure; queries fall back to recursive SQL
+        branch.remove_edge(TreeEdge.objects.get(outgoing_node=self.nodes[1]).id)
+        self.assertFalse(branch.has_closure)
+        self.assertFalse(TreeClosure.objects.filter(version=branch).exists())
+        self.assertFalse(branch.is_ancestor(self.nodes[0].id, new_node.node_id))
+        self.assertEqual(branch.subtree_size(self.nodes[1].id), 3)
+        self.assertEqual(branch.node_depth(new_node.node_id), 2)
+
+        # Tagging rebuilds it
+        self.tree.create_tag(name="closure-branch", version=branch)
+        self.assertTrue(branch.has_closure)
+        self.assertEqual(branch.node_depth(new_node.node_id), 2)
+
+    def test_edges_to_missing_nodes_join_the_closure_with_them(self):
+        branch = self.tree.create_new_tree_version_from_tag("closure")
+        later = TreeNode.objects.create(tree=self.tree, data={"index": 4})
+        leaf = TreeNode.objects.create(tree=self.tree, data={"index": 5})
+        branch.add_edge(self.nodes[3].id, later.id, data={})
+        branch.add_existing_node(leaf, data={"index": 5})
+        branch.add_edge(later.id, leaf.id, data={})
+        self.assertFalse(branch.is_ancestor(self.nodes[0].id, leaf.id))
+
+        # Both edges come alive with the node
+        branch.add_existing_node(later, data={"index": 4})
+        self.assertTrue(branch.has_closure)
+        self.assertTrue(branch.is_ancestor(self.nodes[0].id, later.id))
+        self.assertTrue(branch.is_ancestor(self.nodes[3].id, leaf.id))
+        self.assertEqual(branch.node_depth(leaf.id), 3)
+        self.assertEqual(branch.subtree_size(self.nodes[3].id), 3)
+        rows = set(branch.closure_rows.values_list("ancestor_id", "descendant_id", "depth"))
+        branch.build_closure()
+        self.assertEqual(rows, set(branch.closure_rows.values_list("ancestor_id", "descendant_id", "depth")))
+
+    def test_fallback_without_closure(self):
+        tree = Tree.objects.create(name="No Closure Tree")
+        root = TreeNode.objects.create(tree=tree, data={})
+        child = TreeNode.objects.create(tree=tree, data={})
+        TreeEdge.objects.create(incoming_node=root, outgoing_node=child, data={})
+        tree.create_tag(name="no-closure")
+        version = tree.get_by_tag("no-closure")
+        self.assertFalse(version.has_closure)
+        self.assertTrue(version.is_ancestor(root.id, child.id))
+        self.assertEqual(version.subtree_size(root.id), 2)
+        self.assertEqual(version.node_depth(child.id), 1)
+
+    def test_node_depth_agrees_with_the_closure_on_a_dag(self):
+        # r -> a -> c, r -> b -> c, a -> d -> c: c is 2 below r but has 4 ancestors
+        tree = Tree.objects.create(name="Diamond Tree", maintain_closure=True)
+        nodes = {name: TreeNode.objects.create(tree=tree, data={"name": name}) for name in "rabcd"}
+        for parent, child in [("r", "a"), ("r", "b"), ("a", "c"), ("b", "c"), ("a", "d"), ("d", "c")]:
+            TreeEdge.objects.create(incoming_node=nodes[parent], outgoing_node=nodes[child], data={})
+        tree.create_tag(name="diamond")
+        version = tree.get_by_tag("diamond")
+        self.assertTrue(version.has_closure)
+        depths = {name: version.node_depth(node.id) for name, node in nodes.items()}
+
+        graph = version.to_csr()
+        version._drop_closure()
+        self.assertEqual({name: version.node_depth(node.id) for name, node in nodes.items()}, depths)
+        self.assertEqual(depths, {name: graph.depths()[graph.index_of(node.id)] for name, node in nodes.items()})
+        self.assertEqual(depths["c"], 2)
+        with self.assertRaises(ValueError):
+            version.node_depth(-1)
+
+class VersionCacheTestCase(TransactionTestCase):
+    # Entries are only cached outside of transactions, so these tests cannot
+    # run inside TestCase's per-test transaction
+
+    def setUp(self):
+        version_cache.clear()
+        self.tree = Tree.objects.create(name="Cached Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={"relation": "child"})
+        self.tree.create_tag(name="cached")
+
+    def tearDown(self):
+        version_cache.clear()
+
+    @override_settings(TREE_VERSION_CACHE={'BACKEND': 'default'})
+    def test_tag_lookups_and_materialized_versions_are_cached(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        version = Tree.get_by_tag("cached")
+        materialized = version.materialize()
+
+        with self.assertNumQueries(0):
+            version = Tree.get_by_tag("cached")
+            self.assertEqual(version.tag.name, "cached")
+            self.assertEqual(self.tree.restore_from_tag("cached").id, version.id)
+            materialized = version.materialize()
+            self.assertEqual([nv.node_id for nv in materialized.get_root_nodes()], [self.root.id])
+            self.assertEqual(materialized.get_node(self.child.id).data, {"name": "child"})
+            self.assertEqual([nv.node_id for nv in materialized.get_child_nodes(self.root.id)], [self.child.id])
+            self.assertEqual([nv.node_id for nv in materialized.get_nodes_at_depth(1)], [self.child.id])
+            path = materialized.find_path(self.root.id, self.child.id)
+            self.assertEqual([node_id for node_id, _ in path], [self.root.id, self.child.id])
+            self.assertEqual(path[0][1].data, {"relation": "child"})
+            with self.assertRaises(ValueError):
+                materialized.get_node(-1)
+
+        other_tree = Tree.objects.create(name="Other Tree")
+        with self.assertRaises(ValueError):
+            other_tree.restore_from_tag("cached")
+
+    def test_local_entries_are_checked_against_the_database(self):
+        version = Tree.get_by_tag("cached")
+        version.materialize()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(version.materialize().nodes), 2)
+
+        # Changes made by another process do not bump this process's
+        # counters, only the versions' rows
+        with mock.patch.object(version_cache, '_invalidate'):
+            Tree.get_by_tag("cached").add_node(data={"name": "elsewhere"})
+        self.assertEqual(len(Tree.get_by_tag("cached").materialize().nodes), 3)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.object(version_cache, '_invalidate'):
+            path = Tree.get_by_tag("cached").archive(directory=directory.name)
+        version = Tree.get_by_tag("cached")
+        self.assertEqual(version.archive_path, path)
+        self.assertEqual(len(version.materialize().nodes), 3)
+
+        with mock.patch.object(version_cache, '_invalidate'):
+            Tag.objects.filter(name="cached").delete()
+        with self.assertRaises(ValueError):
+            Tree.get_by_tag("cached")
+
+    @override_settings(TREE_VERSION_CACHE={'BACKEND': 'default'})
+    def test_versions_archived_after_their_tag_lookup_was_cached(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        Tree.get_by_tag("cached")
+        # An invalidation that did not reach the cache leaves the lookup
+        # without the archive path
+        with mock.patch.object(version_cache, '_invalidate'):
+            path = Tree.get_by_tag("cached").archive(directory=directory.name)
+
+        stub = Tree.get_by_tag("cached")
+        self.assertIsNone(stub.archive_path)
+        self.assertEqual(stub.materialize().get_node(self.child.id).data, {"name": "child"})
+        self.assertEqual(stub.archive_path, path)
+
+        stub = Tree.get_by_tag("cached")
+        self.assertEqual(stub.get_node(self.child.id).data, {"name": "child"})
+        self.assertIsNone(TreeVersion.objects.get(pk=stub.pk).archive_path)
+
+    def test_changes_invalidate_cached_entries(self):
+        version = Tree.get_by_tag("cached")
+        version.materialize()
+
+        new_node = version.add_node(data={"name": "new"})
+        self.assertIn(new_node.node_id, Tree.get_by_tag("cached").materialize().nodes)
+
+        Tree.get_by_tag("cached").delete()
+        with self.assertRaises(ValueError):
+            Tree.get_by_tag("cached")
+
+    def test_delta_versions_are_invalidated_through_their_parent(self):
+        branch = self.tree.create_new_tree_version_from_tag("cached", delta=True)
+        self.tree.create_tag(name="cached-delta", version=branch)
+        Tree.get_by_tag("cached-delta").materialize()
+
+        Tree.get_by_tag("cached").add_existing_node(self.child, data={"name": "changed"})
+        materialized = Tree.get_by_tag("cached-delta").materialize()
+        self.assertEqual(materialized.get_node(self.child.id).data, {"name": "changed"})
+
+    def test_cache_is_bounded_by_size(self):
+        version = Tree.get_by_tag("cached")
+        version.materialize()
+        entry_size = version_cache.size
+        with override_settings(TREE_VERSION_CACHE={'MAX_BYTES': entry_size}):
+            self.tree.create_tag(name="cached-2")
+            Tree.get_by_tag("cached-2").materialize()
+            self.assertLessEqual(version_cache.size, entry_size)
+
+        with override_settings(TREE_VERSION_CACHE={'MAX_BYTES': 0}):
+            version_cache.clear()
+            Tree.get_by_tag("cached")
+            self.assertEqual(len(version_cache), 0)
+
+    @override_settings(TREE_VERSION_CACHE={'BACKEND': 'default'})
+    def test_indexed_paths_are_cached(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        version = Tree.get_by_tag("cached")
+        version.add_node(data={"name": "warm"})
+
+        # BEGIN, the payload, the node, its version, the stats, the revision
+        # and COMMIT: the payload is stored once and no indexed paths are read
+        with self.assertNumQueries(7):
+            node_version = version.add_node(data={"name": "new"})
+        self.assertEqual(node_version.payload_id, node_version.node.payload_id)
+
+        # Indexing a path invalidates the list, so later payloads are indexed
+        self.tree.index_path("name")
+        indexed = version.add_node(data={"name": "indexed"})
+        self.assertEqual([row.node_id for row in version.find_nodes({"name": "indexed"})], [indexed.node_id])
+
+        # Without the shared backend another process's change to the indexed
+        # paths would go unseen, so the list is read every time
+        with override_settings(TREE_VERSION_CACHE={}):
+            with CaptureQueriesContext(connection) as queries:
+                version.add_node(data={"name": "local"})
+            self.assertTrue(any('tree_manager_indexedpath' in query['sql'] for query in queries.captured_queries))
+            with mock.patch.object(version_cache, '_invalidate'):
+                self.tree.index_path("role")
+            local = version.add_node(data={"role": "local-indexed"})
+            self.assertEqual(
+                [row.node_id for row in version.find_nodes({"role": "local-indexed"})], [local.node_id]
+            )
+
+    @override_settings(TREE_VERSION_CACHE={'BACKEND': 'default'})
+    def test_shared_backend(self):
+        cache.clear()
+        Tree.get_by_tag("cached").materialize()
+
+        # Another worker starts with an empty local cache but finds the
+        # entries in the shared backend
+        version_cache.clear()
+        with self.assertNumQueries(0):
+            materialized = Tree.get_by_tag("cached").materialize()
+        self.assertEqual(len(materialized.nodes), 2)
+
+        # Invalidation is visible through the shared revisions
+        Tree.get_by_tag("cached").add_node(data={"name": "new"})
+        version_cache.clear()
+        self.assertEqual(len(Tree.get_by_tag("cached").materialize().nodes), 3)
+        cache.clear()
+
+class NDJSONExportImportTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Exported Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child", "tags": ["a", "b"]})
+        TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={"relation": "child"})
+        self.tree.create_tag(name="export-v1", description="Exported version")
+
+    def test_round_trip(self):
+        version = self.tree.get_by_tag("export-v1")
+        stream = io.StringIO()
+        export_version(version, stream, chunk_size=1)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])["tag"], "export-v1")
+        self.assertEqual(lines, [line.rstrip("\n") for line in iter_version_ndjson(version)])
+
+        tag = import_version(io.StringIO(stream.getvalue()), tree_name="Imported Tree", tag_name="import-v1", batch_size=1)
+        self.assertEqual(tag.tree.name, "Imported Tree")
+        self.assertEqual(tag.description, "Exported version")
+        imported = Tree.get_by_tag("import-v1")
+        self.assertNotEqual(imported.tree_id, self.tree.id)
+        roots = imported.get_root_nodes()
+        self.assertEqual([nv.data for nv in roots], [{"name": "root"}])
+        children = imported.get_child_nodes(roots[0].node_id)
+        self.assertEqual([nv.data for nv in children], [{"name": "child", "tags": ["a", "b"]}])
+        self.assertEqual(imported.get_node_edges(roots[0].node_id)[0].data, {"relation": "child"})
+
+    def test_invalid_stream_leaves_nothing_behind(self):
+        lines = [
+            json.dumps({"type": "version", "tree": "Broken", "tag": "broken"}),
+            json.dumps({"type": "node", "id": 1, "data": {}}),
+            json.dumps({"type": "edge", "id": 1, "source": 1, "target": 2, "data": {}}),
+        ]
+        with self.assertRaisesMessage(ValueError, "unknown nodes: [2]"):
+            import_version(lines)
+        self.assertFalse(Tree.objects.filter(name="Broken").exists())
+
+    def test_management_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "export.ndjson")
+            call_command("export_version", "export-v1", output=path)
+            out = io.StringIO()
+            call_command("import_version", path, tag="import-cmd", stdout=out)
+        self.assertIn("import-cmd", out.getvalue())
+        self.assertEqual(Tree.get_by_tag("import-cmd").node_versions.count(), 2)
+
+class ReadAPITestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="API Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(5)]
+        )
+        for child in range(1, 5):
+            TreeEdge.objects.create(incoming_node=self.nodes[0], outgoing_node=self.nodes[child], data={"index": child})
+        self.tree.create_tag(name="api-v1")
+        self.version = self.tree.get_by_tag("api-v1")
+
+    def test_keyset_pagination(self):
+        response = self.client.get(f"/api/versions/{self.version.id}/nodes/", {"limit": 2})
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        self.assertEqual([node["id"] for node in page["results"]], [n.id for n in self.nodes[:2]])
+
+        ids = [node["id"] for node in page["results"]]
+        while page["next"]:
+            page = self.client.get(page["next"]).json()
+            ids.extend(node["id"] for node in page["results"])
+        self.assertEqual(ids, [n.id for n in self.nodes])
+
+        children = self.client.get(
+            f"/api/tags/api-v1/nodes/{self.nodes[0].id}/children/", {"after": self.nodes[2].id}
+        ).json()
+        self.assertEqual([node["id"] for node in children["results"]], [n.id for n in self.nodes[3:]])
+        self.assertIsNone(children["next"])
+
+        self.assertEqual(self.client.get("/api/tags/api-v1/nodes/", {"limit": "x"}).status_code, 400)
+
+    def test_read_endpoints(self):
+        roots = self.client.get("/api/tags/api-v1/roots/").json()
+        self.assertEqual(roots["results"], [{"id": self.nodes[0].id, "data": {"index": 0}}])
+
+        node = self.client.get(f"/api/tags/api-v1/nodes/{self.nodes[3].id}/").json()
+        self.assertEqual(node["data"], {"index": 3})
+        self.assertEqual(self.client.get("/api/tags/api-v1/nodes/0/").status_code, 404)
+
+        parents = self.client.get(f"/api/tags/api-v1/nodes/{self.nodes[3].id}/parents/").json()
+        self.assertEqual([n["id"] for n in parents["results"]], [self.nodes[0].id])
+
+        edges = self.client.get("/api/tags/api-v1/edges/").json()
+        self.assertEqual(len(edges["results"]), 4)
+        self.assertEqual(edges["results"][0]["source"], self.nodes[0].id)
+
+        path = self.client.get("/api/tags/api-v1/path/", {"start": self.nodes[0].id, "end": self.nodes[4].id}).json()
+        self.assertEqual([step["node"] for step in path["path"]], [self.nodes[0].id, self.nodes[4].id])
+        self.assertEqual(
+            self.client.get("/api/tags/api-v1/path/", {"start": self.nodes[4].id, "end": self.nodes[0].id}).status_code,
+            404,
+        )
+        self.assertEqual(self.client.get("/api/tags/missing/nodes/").status_code, 404)
+
+    async def test_streaming_dump(self):
+        response = await self.async_client.get(f"/api/versions/{self.version.id}/dump/")
+        self.assertTrue(response.streaming)
+        lines = b"".join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual(len(lines), 1 + 5 + 4)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+    def test_streaming_dump_under_wsgi(self):
+        # WSGI servers get a sync iterator, so Django streams it instead of
+        # buffering an async one
+        response = self.client.get(f"/api/versions/{self.version.id}/dump/")
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.is_async)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1 + 5 + 4)
+
+    def test_etags_and_cache_headers(self):
+        url = f"/api/versions/{self.version.id}/nodes/"
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertEqual(self.client.get("/api/tags/api-v1/nodes/")["Cache-Control"], "public, max-age=60")
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified["ETag"], etag)
+
+        # Changing a tagged version changes its ETag
+        self.version.add_node(data={"index": 5})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        # Untagged versions are not cacheable and carry no validator
+        branch = self.tree.create_new_tree_version_from_tag("api-v1")
+        response = self.client.get(f"/api/versions/{branch.id}/nodes/")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertFalse(response.has_header("ETag"))
+
+class AsyncReadTestCase(TestCase):
+    def setUp(self):
+        # 0 -> 1 -> 3, 0 -> 2
+        self.tree = Tree.objects.create(name="Async Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(4)]
+        )
+        for parent, child in [(0, 1), (0, 2), (1, 3)]:
+            TreeEdge.objects.create(incoming_node=self.nodes[parent], outgoing_node=self.nodes[child], data={})
+        self.tree.create_tag(name="async-v1")
+        branch = self.tree.create_new_tree_version_from_tag("async-v1", delta=True)
+        branch.add_existing_node(self.nodes[2], data={"index": 2, "changed": True})
+        self.tree.create_tag(name="async-delta", version=branch)
+
+    async def test_async_read_methods(self):
+        version = await Tree.aget_by_tag("async-delta")
+        node = await version.aget_node(self.nodes[2].id)
+        self.assertEqual(node.data, {"index": 2, "changed": True})
+        with self.assertRaises(ValueError):
+            await version.aget_node(0)
+
+        roots = await version.aget_root_nodes()
+        self.assertEqual([nv.node_id for nv in roots], [self.nodes[0].id])
+        children = await version.aget_child_nodes(self.nodes[0].id)
+        self.assertEqual(sorted(nv.node_id for nv in children), [self.nodes[1].id, self.nodes[2].id])
+        parents = await version.aget_parent_nodes(self.nodes[3].id)
+        self.assertEqual([nv.node_id for nv in parents], [self.nodes[1].id])
+        edges = await version.aget_node_edges(self.nodes[1].id)
+        self.assertEqual(len(edges), 2)
+
+        all_nodes = [nv.node_id async for nv in version.aiter_nodes(chunk_size=2)]
+        self.assertEqual(sorted(all_nodes), [n.id for n in self.nodes])
+
+        walked = [nv.node_id async for nv in version.atraverse(self.nodes[0].id)]
+        self.assertEqual(walked[0], self.nodes[0].id)
+        self.assertEqual(sorted(walked[1:3]), [self.nodes[1].id, self.nodes[2].id])
+        self.assertEqual(walked[3], self.nodes[3].id)
+        shallow = [nv.node_id async for nv in version.atraverse(self.nodes[0].id, max_depth=1)]
+        self.assertEqual(len(shallow), 3)
+
+    async def test_async_views(self):
+        response = await self.async_client.get(f"/api/tags/async-delta/nodes/{self.nodes[2].id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"], {"index": 2, "changed": True})
+
+        response = await self.async_client.get(f"/api/tags/async-delta/nodes/{self.nodes[0].id}/children/")
+        self.assertEqual(len(response.json()["results"]), 2)
+        etag = response["ETag"]
+        response = await self.async_client.get(
+            f"/api/tags/async-delta/nodes/{self.nodes[0].id}/children/", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # The dump streams from an async generator and reads through the delta chain
+        response = await self.async_client.get("/api/tags/async-delta/dump/")
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(lines[0]["tag"], "async-delta")
+        nodes = {line["id"]: line["data"] for line in lines if line["type"] == "node"}
+        self.assertEqual(nodes[self.nodes[2].id], {"index": 2, "changed": True})
+        self.assertEqual(len(nodes), 4)
+
+class VersionDiffTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Diff Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(4)]
+        )
+        self.edges = [
+            TreeEdge.objects.create(incoming_node=self.nodes[0], outgoing_node=self.nodes[i], data={"index": i})
+            for i in range(1, 4)
+        ]
+        self.tree.create_tag(name="release-v1.0")
+        self.base = self.tree.get_by_tag("release-v1.0")
+
+    def _diff(self, old, new):
+        # Data are dicts, so key the changes for comparison
+        return {(change.kind, change.op, change.id): (change.old, change.new) for change in old.diff(new)}
+
+    def _change_branch(self, branch):
+        branch.add_existing_node(self.nodes[1], data={"index": 1, "changed": True})
+        new_node = branch.add_node(data={"index": 4})
+        new_edge = branch.add_edge(self.nodes[0].id, new_node.node_id, data={"index": 4})
+        branch.remove_node(self.nodes[3].id)
+        return new_node, new_edge
+
+    def _expected(self, new_node, new_edge):
+        return {
+            ("node", "added", new_node.node_id): (None, {"index": 4}),
+            ("node", "removed", self.nodes[3].id): ({"index": 3}, None),
+            ("node", "changed", self.nodes[1].id): ({"index": 1}, {"index": 1, "changed": True}),
+            ("edge", "added", new_edge.edge_id): (None, {"index": 4}),
+            ("edge", "removed", self.edges[2].id): ({"index": 3}, None),
+        }
+
+    def test_diff_between_full_versions(self):
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        new_node, new_edge = self._change_branch(branch)
+
+        self.assertEqual(self._diff(self.base, branch), self._expected(new_node, new_edge))
+        self.assertEqual(list(self.base.diff(self.base)), [])
+
+        # The reverse diff swaps added and removed
+        reverse = {change.op for change in branch.diff(self.base) if change.kind == "node"}
+        self.assertEqual(reverse, {"added", "removed", "changed"})
+
+    def test_diff_between_delta_versions_only_looks_at_touched_rows(self):
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        new_node, new_edge = self._change_branch(branch)
+        self.assertEqual(self._diff(self.base, branch), self._expected(new_node, new_edge))
+
+        sibling = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        sibling.add_existing_node(self.nodes[2], data={"index": 2, "sibling": True})
+        changes = self._diff(branch, sibling)
+        self.assertEqual(changes[("node", "changed", self.nodes[2].id)], ({"index": 2}, {"index": 2, "sibling": True}))
+        self.assertEqual(changes[("node", "added", self.nodes[3].id)], (None, {"index": 3}))
+        self.assertEqual(changes[("node", "changed", self.nodes[1].id)], ({"index": 1, "changed": True}, {"index": 1}))
+        self.assertEqual(len(changes), 6)
+
+
+class VersionMergeTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Merge Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(4)]
+        )
+        self.edges = [
+            TreeEdge.objects.create(incoming_node=self.nodes[0], outgoing_node=self.nodes[i], data={"index": i})
+            for i in range(1, 4)
+        ]
+        self.tree.create_tag(name="release-v1.0")
+        self.base = self.tree.get_by_tag("release-v1.0")
+
+    def test_merge_base_is_the_nearest_common_ancestor(self):
+        ours = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        self.tree.create_tag(name="feature-v1.1", version=ours)
+        theirs = self.tree.create_new_tree_version_from_tag("feature-v1.1", delta=True)
+        self.assertEqual(ours.merge_base(theirs), ours)
+        self.assertEqual(theirs.merge_base(self.base), self.base)
+
+        other_tree = Tree.objects.create(name="Other Tree")
+        other_tree.create_tag(name="other-v1.0")
+        with self.assertRaises(ValueError):
+            ours.merge_base(other_tree.get_by_tag("other-v1.0"))
+
+    def test_merge_applies_non_conflicting_changes(self):
+        ours = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        ours.add_existing_node(self.nodes[1], data={"index": 1, "ours": True})
+        theirs = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        theirs.add_existing_node(self.nodes[2], data={"index": 2, "theirs": True})
+        new_node = theirs.add_node(data={"index": 4})
+        new_edge = theirs.add_edge(self.nodes[1].id, new_node.node_id, data={"index": 4})
+        theirs.remove_edge(self.edges[2].id)
+
+        result = ours.merge(theirs)
+        self.assertEqual(result.conflicts, [])
+        self.assertEqual(len(result.applied), 4)
+
+        ours = TreeVersion.objects.get(pk=ours.pk)
+        self.assertEqual(ours.get_node(self.nodes[1].id).data, {"index": 1, "ours": True})
+        self.assertEqual(ours.get_node(self.nodes[2].id).data, {"index": 2, "theirs": True})
+        self.assertEqual(ours.get_node(new_node.node_id).data, {"index": 4})
+        self.assertEqual(
+            {node.node_id for node in ours.get_child_nodes(self.nodes[1].id)}, {new_node.node_id}
+        )
+        self.assertFalse(ours.effective_edge_versions().filter(edge_id=self.edges[2].id).exists())
+        self.assertTrue(ours.effective_edge_versions().filter(edge_id=new_edge.edge_id).exists())
+        # Merging again finds nothing left to apply
+        self.assertEqual(ours.merge(theirs), ([], []))
+
+    def test_merge_reports_conflicts(self):
+        ours = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        theirs = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+
+        # Both sides change the same node differently
+        ours.add_existing_node(self.nodes[1], data={"index": 1, "ours": True})
+        theirs.add_existing_node(self.nodes[1], data={"index": 1, "theirs": True})
+        # Identical changes on both sides are not conflicts
+        ours.add_existing_node(self.nodes[2], data={"index": 2, "both": True})
+        theirs.add_existing_node(self.nodes[2], data={"index": 2, "both": True})
+        # They add an edge below a node we removed
+        ours.remove_node(self.nodes[3].id)
+        new_node = theirs.add_node(data={"index": 4})
+        new_edge = theirs.add_edge(self.nodes[3].id, new_node.node_id, data={})
+
+        result = ours.merge(theirs)
+        conflicts = {(c.ours.kind, c.ours.id, c.theirs.kind, c.theirs.id) for c in result.conflicts}
+        self.assertEqual(conflicts, {
+            ("node", self.nodes[1].id, "node", self.nodes[1].id),
+            ("node", self.nodes[3].id, "edge", new_edge.edge_id),
+        })
+        self.assertEqual([(c.kind, c.id) for c in result.applied], [("node", new_node.node_id)])
+
+        ours = TreeVersion.objects.get(pk=ours.pk)
+        self.assertEqual(ours.get_node(self.nodes[1].id).data, {"index": 1, "ours": True})
+        self.assertEqual(ours.get_node(new_node.node_id).data, {"index": 4})
+        self.assertFalse(ours.effective_edge_versions().filter(edge_id=new_edge.edge_id).exists())
+
+    def test_conflicting_node_removal_keeps_its_edges(self):
+        ours = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        theirs = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        # We edit a node they removed (and its edge with it); their removal
+        # of an unrelated edge still applies
+        ours.add_existing_node(self.nodes[1], data={"index": 1, "ours": True})
+        theirs.remove_node(self.nodes[1].id)
+        theirs.remove_edge(self.edges[1].id)
+
+        result = ours.merge(theirs)
+        conflicts = {(c.ours.kind, c.ours.id, c.theirs.kind, c.theirs.id) for c in result.conflicts}
+        self.assertEqual(conflicts, {("node", self.nodes[1].id, "node", self.nodes[1].id)})
+        self.assertEqual([(c.kind, c.id) for c in result.applied], [("edge", self.edges[1].id)])
+
+        ours = TreeVersion.objects.get(pk=ours.pk)
+        self.assertEqual(ours.get_node(self.nodes[1].id).data, {"index": 1, "ours": True})
+        self.assertEqual(
+            {node.node_id for node in ours.get_child_nodes(self.nodes[0].id)}, {self.nodes[1].id, self.nodes[3].id}
+        )
+
+
+class PayloadBlobTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Payload Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root", "level": 0})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"level": 1, "name": "child"})
+        self.edge = TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={"relation": "child"})
+        self.tree.create_tag(name="release-v1.0")
+
+    def test_equal_payloads_are_stored_once(self):
+        blobs = PayloadBlob.objects.count()
+        TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"level": 0, "name": "root"}) for _ in range(3)]
+        )
+        # Key order does not change the hash
+        self.assertEqual(PayloadBlob.objects.count(), blobs)
+        self.assertEqual(payload_hash({"a": 1, "b": 2}), payload_hash({"b": 2, "a": 1}))
+
+        self.tree.create_new_tree_version_from_tag("release-v1.0")
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        self.tree.create_tag(name="release-v1.1", version=branch)
+        self.assertEqual(PayloadBlob.objects.count(), blobs)
+        self.assertEqual(
+            set(TreeNodeVersion.objects.filter(node=self.root).values_list("payload_id", flat=True)),
+            {self.root.payload_id},
+        )
+        self.assertEqual(branch.get_node(self.child.id).data, {"name": "child", "level": 1})
+
+    def test_rewriting_the_same_payload_is_not_a_change(self):
+        base = self.tree.get_by_tag("release-v1.0")
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        branch.add_existing_node(self.child, data={"name": "child", "level": 1})
+        branch.add_existing_edge(self.edge, data={"relation": "parent"})
+        self.assertEqual(
+            [(change.kind, change.op, change.id) for change in base.diff(branch)],
+            [("edge", "changed", self.edge.id)],
+        )
+
+
+class EdgeEndpointTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Endpoint Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        self.edge = TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={})
+        self.tree.create_tag(name="release-v1.0")
+
+    def test_endpoints_are_copied_to_edge_versions(self):
+        version = self.tree.get_by_tag("release-v1.0")
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        leaf = branch.add_node(data={"name": "leaf"})
+        branch.add_edge(self.child.id, leaf.node_id, data={})
+        for edge_version in TreeEdgeVersion.objects.all():
+            self.assertEqual(
+                (edge_version.source_node_id, edge_version.target_node_id),
+                (edge_version.edge.incoming_node_id, edge_version.edge.outgoing_node_id),
+            )
+
+        # Child and parent lookups no longer join the edge table
+        with CaptureQueriesContext(connection) as queries:
+            children = list(version.get_child_nodes(self.root.id))
+            parents = list(version.get_parent_nodes(self.child.id))
+        self.assertEqual([node.node_id for node in children], [self.child.id])
+        self.assertEqual([node.node_id for node in parents], [self.root.id])
+        self.assertFalse(any('"tree_manager_treeedge"' in query["sql"] for query in queries))
+
+    def test_nodes_and_edges_appear_once_per_version(self):
+        version = self.tree.get_by_tag("release-v1.0")
+        # Re-adding an existing node or edge replaces the version's row
+        version.add_existing_node(self.child, data={"name": "child-v2"})
+        version.add_existing_edge(self.edge, data={"relation": "child"})
+        self.assertEqual(version.node_versions.filter(node=self.child).count(), 1)
+        self.assertEqual(version.get_node(self.child.id).data, {"name": "child-v2"})
+        self.assertEqual(version.edge_versions.get(edge=self.edge).data, {"relation": "child"})
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            TreeNodeVersion.objects.create(node=self.child, version=version, data={})
+
+
+class BenchmarkCommandTestCase(TestCase):
+    def test_build_tree_respects_fan_out_and_depth(self):
+        _, levels = build_tree("bench-shape", 30, fan_out=2)
+        self.assertEqual([len(level) for level in levels], [1, 2, 4, 8, 15])
+        tree, levels = build_tree("bench-shallow", 30, fan_out=2, depth=2)
+        self.assertEqual([len(level) for level in levels], [1, 2, 27])
+        tree.create_tag(name="bench-shallow")
+        version = tree.get_by_tag("bench-shallow")
+        self.assertEqual(len(version.get_nodes_at_depth(2)), 27)
+
+    def test_benchmark_writes_a_json_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "report.json")
+            call_command("benchmark", sizes=[30], repeat=1, versions=2, delta=True, output=path, stderr=io.StringIO())
+            with open(path) as stream:
+                report = json.load(stream)
+
+        self.assertEqual(report["parameters"]["sizes"], [30])
+        self.assertEqual(
+            [result["operation"] for result in report["results"]],
+            [
+                "create_tag",
+                "create_new_tree_version_from_tag",
+                "create_new_tree_version_from_tag[delta]",
+                "add_edge",
+                "get_root_nodes",
+                "get_nodes_at_depth",
+                "find_path",
+                "traverse_tree",
+            ],
+        )
+        for result in report["results"]:
+            self.assertGreater(result["queries"], 0)
+            self.assertGreaterEqual(result["seconds"], 0)
+            self.assertGreater(result["peak_memory_bytes"], 0)
+        # The synthetic trees are rolled back
+        self.assertFalse(Tree.objects.filter(name__startswith="benchmark-").exists())
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Instrumented Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={})
+        self.tree.create_tag(name="release-v1.0")
+
+    def test_record_operations_measures_model_calls(self):
+        version = TreeVersion.objects.get(tag__name="release-v1.0")
+        with record_operations() as recorded:
+            version.get_node(self.child.id)
+            version.find_path(self.root.id, self.child.id)
+        self.assertEqual([stats.name for stats in recorded], ["TreeVersion.get_node", "TreeVersion.find_path"])
+        get_node = recorded[0]
+        self.assertEqual(get_node.queries, 1)
+        self.assertEqual(get_node.rows, 1)
+        self.assertGreater(get_node.sql_time, 0)
+        self.assertGreaterEqual(get_node.wall_time, get_node.sql_time)
+        self.assertEqual(set(get_node.as_dict()), {"name", "queries", "sql_time", "rows", "python_time", "wall_time"})
+
+        # Nothing is measured outside of a recording block
+        with CaptureQueriesContext(connection) as queries:
+            version.get_node(self.child.id)
+        self.assertEqual(len(queries), 1)
+
+    def test_fetches_count_as_sql_time(self):
+        # Rows are read after execute() returns, so fetching them is timed too
+        class SlowCursor:
+            def fetchall(self):
+                time.sleep(0.02)
+                return [(1,), (2,)]
+
+            def __iter__(self):
+                time.sleep(0.02)
+                yield (3,)
+
+        with instrument("fetch") as stats:
+            cursor = instrumentation._RowCountingCursor(SlowCursor())
+            cursor.fetchall()
+            list(cursor)
+        self.assertEqual(stats.rows, 3)
+        self.assertEqual(stats.queries, 0)
+        self.assertGreaterEqual(stats.sql_time, 0.04)
+
+    def test_signal_receives_every_operation(self):
+        received = []
+
+        def receiver(sender, stats, **kwargs):
+            received.append((sender, stats.name, stats.queries))
+
+        operation_finished.connect(receiver)
+        try:
+            self.tree.create_new_tree_version_from_tag("release-v1.0")
+        finally:
+            operation_finished.disconnect(receiver)
+        self.assertEqual(len(received), 1)
+        sender, name, queries = received[0]
+        self.assertEqual((sender, name), (Tree, "Tree.create_new_tree_version_from_tag"))
+        self.assertGreater(queries, 0)
+
+    def test_server_timing_header(self):
+        middleware = [*settings.MIDDLEWARE, "tree_manager.instrumentation.ServerTimingMiddleware"]
+        with override_settings(MIDDLEWARE=middleware):
+            response = self.client.get(f"/api/tags/release-v1.0/path/?start={self.root.id}&end={self.child.id}")
+            async_response = self.client.get(f"/api/tags/release-v1.0/nodes/{self.child.id}/")
+        self.assertEqual(response.status_code, 200)
+        timing = response.headers["Server-Timing"]
+        self.assertTrue(timing.startswith("db;dur="))
+        self.assertIn("app;dur=", timing)
+        self.assertIn('TreeVersion.find_path;dur=', timing)
+        self.assertIn('TreeVersion.aget_node;dur=', async_response.headers["Server-Timing"])
+
+
+class GarbageCollectionTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="GC Tree")
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        TreeEdge.objects.create(incoming_node=self.root, outgoing_node=self.child, data={})
+        self.tree.create_tag(name="release-v1.0")
+
+    def _age(self, *querysets):
+        old = timezone.now() - timedelta(days=30)
+        for queryset in querysets:
+            queryset.update(created_at=old)
+
+    def test_collects_abandoned_branches_and_their_rows(self):
+        abandoned = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        leaf = abandoned.add_node(data={"name": "abandoned leaf"})
+        abandoned.add_edge(self.child.id, leaf.node_id, data={})
+        recent = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        self._age(TreeVersion.objects.filter(pk=abandoned.pk), TreeNode.objects.all(), TreeEdge.objects.all())
+
+        dry_run = collect_garbage(dry_run=True)
+        self.assertEqual((dry_run["versions"], dry_run["node_versions"]), (1, 3))
+        self.assertTrue(TreeVersion.objects.filter(pk=abandoned.pk).exists())
+
+        counts = collect_garbage(batch_size=2)
+        self.assertEqual(
+            {key: counts[key] for key in ("versions", "node_versions", "edge_versions", "nodes", "edges")},
+            {"versions": 1, "node_versions": 3, "edge_versions": 2, "nodes": 1, "edges": 1},
+        )
+        self.assertFalse(TreeVersion.objects.filter(pk=abandoned.pk).exists())
+        self.assertFalse(TreeNode.objects.filter(pk=leaf.node_id).exists())
+        # Recent branches and everything tagged stay
+        self.assertTrue(TreeVersion.objects.filter(pk=recent.pk).exists())
+        self.assertEqual(
+            {node.node_id for node in self.tree.get_by_tag("release-v1.0").effective_node_versions()},
+            {self.root.id, self.child.id},
+        )
+
+    def test_versions_tagged_during_collection_keep_their_rows(self):
+        abandoned = self.tree.create_new_tree_version_from_tag("release-v1.0")
+        abandoned.add_node(data={"name": "late leaf"})
+        self._age(TreeVersion.objects.filter(pk=abandoned.pk))
+        delete_in_batches = garbage._delete_in_batches
+
+        def tag_first(queryset, batch_size, dry_run):
+            # The version is tagged after it was found to be garbage
+            if not Tag.objects.filter(name="late").exists():
+                self.tree.create_tag(name="late", version=abandoned)
+            return delete_in_batches(queryset, batch_size, dry_run)
+
+        with mock.patch.object(garbage, "_delete_in_batches", side_effect=tag_first):
+            counts = collect_garbage(batch_size=1)
+        self.assertEqual((counts["versions"], counts["node_versions"], counts["edge_versions"]), (0, 0, 0))
+        self.assertEqual(len(self.tree.get_by_tag("late").effective_node_versions()), 3)
+
+    def test_keeps_ancestors_of_kept_versions(self):
+        branch = self.tree.create_new_tree_version_from_tag("release-v1.0", delta=True)
+        branch.add_existing_node(self.child, data={"name": "child-v2"})
+        self.tree.create_tag(name="release-v1.1", version=branch)
+        # The base loses its tag, but the delta version still reads through it
+        base = self.tree.get_by_tag("release-v1.0")
+        base.tag.delete()
+        self._age(TreeVersion.objects.all(), TreeNode.objects.all(), TreeEdge.objects.all())
+
+        counts = collect_garbage()
+        self.assertEqual(counts["versions"], 0)
+        self.assertEqual(counts["nodes"], 0)
+        branch = self.tree.get_by_tag("release-v1.1")
+        self.assertEqual(branch.get_node(self.root.id).data, {"name": "root"})
+
+    def test_command_collects_unreferenced_payloads(self):
+        TreeNode.objects.create(tree=self.tree, data={"name": "never tagged"})
+        self._age(TreeNode.objects.all(), TreeEdge.objects.all())
+        out = io.StringIO()
+        call_command("collect_garbage", "--payloads", stdout=out)
+        self.assertIn("Deleted 1 nodes.", out.getvalue())
+        self.assertIn("Deleted 1 payloads.", out.getvalue())
+        self.assertFalse(PayloadBlob.objects.filter(hash=payload_hash({"name": "never tagged"})).exists())
+
+
+class AsOfTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="As Of Tree")
+        self.node = TreeNode.objects.create(tree=self.tree, data={"name": "v1"})
+        self.start = timezone.now() - timedelta(days=1)
+        self.v1 = self.tree.create_tag(name="as-of-v1")
+        self.branch = self.tree.create_new_tree_version_from_tag("as-of-v1")
+        self.branch.add_existing_node(self.node, data={"name": "v2"})
+        self.v2 = self.tree.create_tag(name="as-of-v2", version=self.branch)
+        # Spread the history out: v1 tagged at +1h, branch created at +2h, tagged at +3h
+        Tag.objects.filter(pk=self.v1.pk).update(created_at=self.start + timedelta(hours=1))
+        TreeVersion.objects.filter(pk=self.v1.version_id).update(created_at=self.start + timedelta(hours=1))
+        TreeVersion.objects.filter(pk=self.branch.pk).update(created_at=self.start + timedelta(hours=2))
+        Tag.objects.filter(pk=self.v2.pk).update(created_at=self.start + timedelta(hours=3))
+
+    def test_picks_the_latest_tag_at_the_timestamp(self):
+        version = self.tree.as_of(self.start + timedelta(hours=2, minutes=30))
+        self.assertEqual(version.id, self.v1.version_id)
+        self.assertEqual(version.get_node(self.node.id).data, {"name": "v1"})
+
+        version = self.tree.as_of(self.start + timedelta(hours=3))
+        self.assertEqual(version.id, self.branch.id)
+        self.assertEqual(version.get_node(self.node.id).data, {"name": "v2"})
+
+    def test_untagged_versions_count_when_asked(self):
+        version = self.tree.as_of(self.start + timedelta(hours=2, minutes=30), tagged=False)
+        self.assertEqual(version.id, self.branch.id)
+
+    def test_no_version_yet(self):
+        with self.assertRaises(ValueError):
+            self.tree.as_of(self.start)
+
+
+class IndexedPathTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Indexed Tree")
+        self.on = TreeNode.objects.create(tree=self.tree, data={"feature_flag": True, "settings": {"theme": "dark"}})
+        self.off = TreeNode.objects.create(tree=self.tree, data={"feature_flag": False, "settings": {"theme": "dark"}})
+        self.text = TreeNode.objects.create(tree=self.tree, data={"feature_flag": "true"})
+        self.tree.create_tag(name="indexed-v1")
+        # Declared after the payloads exist, so they are backfilled
+        self.tree.index_path("feature_flag")
+        self.tree.index_path("settings.theme")
+
+    def test_find_nodes(self):
+        version = self.tree.get_by_tag("indexed-v1")
+        self.assertEqual([row.node_id for row in version.find_nodes({"feature_flag": True})], [self.on.id])
+        self.assertEqual([row.node_id for row in version.find_nodes({"feature_flag": "true"})], [self.text.id])
+        self.assertEqual(
+            {row.node_id for row in version.find_nodes({"settings.theme": "dark"})}, {self.on.id, self.off.id}
+        )
+        self.assertEqual(
+            [row.node_id for row in version.find_nodes({"settings.theme": "dark", "feature_flag": False})],
+            [self.off.id],
+        )
+
+    def test_new_payloads_and_delta_versions(self):
+        branch = self.tree.create_new_tree_version_from_tag("indexed-v1", delta=True)
+        branch.add_existing_node(self.off, data={"feature_flag": True, "settings": {"theme": "light"}})
+        branch.remove_node(self.on.id)
+        self.assertEqual([row.node_id for row in branch.find_nodes({"feature_flag": True})], [self.off.id])
+        self.assertEqual([row.node_id for row in branch.find_nodes({"settings.theme": "light"})], [self.off.id])
+
+        versions = self.tree.find_versions({"settings.theme": "light"})
+        self.assertEqual(list(versions), [branch])
+        self.assertEqual(self.tree.find_versions({"feature_flag": True}).count(), 2)
+
+    def test_unindexed_path(self):
+        version = self.tree.get_by_tag("indexed-v1")
+        with self.assertRaises(ValueError):
+            list(version.find_nodes({"colour": "red"}))
+        with self.assertRaises(ValueError):
+            self.tree.find_versions({})
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Search Tree")
+        self.web = TreeNode.objects.create(tree=self.tree, data={"hostname": "web-01.example.com", "role": "web"})
+        self.db = TreeNode.objects.create(
+            tree=self.tree, data={"hostname": "db-01.example.com", "settings": {"max_connections": 200}}
+        )
+        self.proxy = TreeNode.objects.create(tree=self.tree, data={"hostname": "proxy", "upstream": ["web", "web", "web"]})
+        self.tree.create_tag(name="search-v1")
+        self.version = self.tree.get_by_tag("search-v1")
+
+    def _search(self, query, limit=20):
+        return [node_version.node_id for node_version in self.version.search(query, limit)]
+
+    def _assert_searches(self):
+        self.assertEqual(self._search("web-01.example.com"), [self.web.id])
+        self.assertEqual(self._search("MAX_CONNECTIONS"), [self.db.id])
+        self.assertEqual(set(self._search("example")), {self.web.id, self.db.id})
+        self.assertEqual(len(self._search("example", limit=1)), 1)
+        self.assertEqual(self._search("example nowhere"), [])
+        self.assertEqual(self._search('" OR *'), [])
+        # Only this version's node versions are returned
+        branch = self.tree.create_new_tree_version_from_tag("search-v1")
+        branch.remove_node(self.web.id)
+        self.assertEqual([row.node_id for row in branch.search("web-01")], [])
+
+    def test_search(self):
+        self.assertEqual(SearchDocument.objects.count(), 3)
+        self._assert_searches()
+
+    def test_command_backfills_the_index(self):
+        # As if the version had been tagged before the index existed
+        search.unindex(SearchDocument.objects.all())
+        self.assertEqual(self._search("web-01.example.com"), [])
+
+        out = io.StringIO()
+        call_command("index_search", stdout=out)
+        self.assertIn("Indexed 1 version(s)", out.getvalue())
+        self.assertEqual(SearchDocument.objects.count(), 3)
+        self._assert_searches()
+        # Indexed payloads are skipped on later runs
+        call_command("index_search", "search-v1", stdout=io.StringIO())
+        self.assertEqual(SearchDocument.objects.count(), 3)
+
+    def test_token_fallback(self):
+        with mock.patch("tree_manager.search.has_fts", return_value=False):
+            SearchDocument.objects.all().delete()
+            self.tree.create_tag(name="search-v2")
+            self.version = self.tree.get_by_tag("search-v2")
+            self.assertTrue(SearchToken.objects.exists())
+            self._assert_searches()
+            # Repeated words rank higher
+            self.assertEqual(self._search("web")[0], self.proxy.id)
+
+
+class BulkMutationTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Bulk Tree", maintain_closure=True)
+        self.root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        self.tree.create_tag(name="bulk-v1")
+        self.version = self.tree.create_new_tree_version_from_tag("bulk-v1")
+
+    def test_add_nodes_and_edges(self):
+        nodes = self.version.add_nodes({"index": i} for i in range(20))
+        self.assertEqual([node_version.data for node_version in nodes], [{"index": i} for i in range(20)])
+        with CaptureQueriesContext(connection) as queries:
+            edges = self.version.add_edges(
+                [(self.root.id, node_version.node_id, {"index": i}) for i, node_version in enumerate(nodes)],
+                batch_size=8,
+            )
+        # Batches of 8 rows, not one round trip per edge
+        self.assertLessEqual(len(queries), 20)
+        self.assertEqual([edge_version.target_node_id for edge_version in edges], [row.node_id for row in nodes])
+        self.assertEqual(
+            {node_version.node_id for node_version in self.version.get_child_nodes(self.root.id)},
+            {node_version.node_id for node_version in nodes},
+        )
+        self.assertTrue(self.version.is_ancestor(self.root.id, nodes[-1].node_id))
+        self.assertEqual(self.version.subtree_size(self.root.id), 21)
+
+    def test_invalid_node_ids_are_all_reported(self):
+        other = TreeNode.objects.create(tree=Tree.objects.create(name="Other Tree"), data={})
+        with self.assertRaisesMessage(ValueError, f"Nodes {other.id}, 999998, 999999 do not exist in this tree."):
+            self.version.add_edges([
+                (self.root.id, 999999, {}),
+                (999998, self.root.id, {}),
+                (self.root.id, other.id, {}),
+            ])
+        self.assertFalse(TreeEdge.objects.exists())
+
+
+class AtomicTagCreationTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Atomic Tree")
+        TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+
+    def test_failed_snapshot_leaves_no_tag(self):
+        with mock.patch.object(Tree, "_snapshot_current_state", side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                self.tree.create_tag(name="atomic-v1")
+        self.assertFalse(Tag.objects.filter(name="atomic-v1").exists())
+        self.assertFalse(self.tree.versions.exists())
+
+    def test_version_tagged_elsewhere(self):
+        self.tree.create_tag(name="atomic-v1")
+        branch = self.tree.create_new_tree_version_from_tag("atomic-v1")
+        # Another writer's instance of the same version gets the tag first
+        self.tree.create_tag(name="atomic-v2", version=TreeVersion.objects.get(pk=branch.pk))
+        with self.assertRaises(ValueError):
+            self.tree.create_tag(name="atomic-v3", version=branch)
+        self.assertFalse(Tag.objects.filter(name="atomic-v3").exists())
+
+
+class StressWritersCommandTestCase(TransactionTestCase):
+    def test_concurrent_writers(self):
+        # The test database is a file (see settings), which the command
+        # switches to WAL mode, so the writers queue for the write lock like
+        # they would in production
+        out = io.StringIO()
+        call_command("stress_writers", writers=4, operations=3, nodes=10, stdout=out)
+        self.assertIn("SQLite journal mode: wal", out.getvalue())
+        self.assertIn("4 writers, 12 tagged branches", out.getvalue())
+        self.assertIn("0 failed", out.getvalue())
+        self.assertFalse(Tree.objects.exists())
+
+
+class IterNodesTestCase(TestCase):
+    def setUp(self):
+        # Binary tree: node i is the parent of nodes 2i+1 and 2i+2
+        self.tree = Tree.objects.create(name="Iter Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(15)]
+        )
+        TreeEdge.objects.bulk_create([
+            TreeEdge(incoming_node=self.nodes[(i - 1) // 2], outgoing_node=self.nodes[i], data={})
+            for i in range(1, 15)
+        ])
+        self.tree.create_tag(name="iter")
+        self.version = self.tree.get_by_tag("iter")
+
+    def walk(self, order, start=0, **kwargs):
+        return [
+            node_version.data["index"]
+            for node_version in self.version.iter_nodes(self.nodes[start].id, order=order, **kwargs)
+        ]
+
+    def test_orders(self):
+        self.assertEqual(self.walk("pre", max_depth=2), [0, 1, 3, 4, 2, 5, 6])
+        self.assertEqual(self.walk("post", max_depth=2), [3, 4, 1, 5, 6, 2, 0])
+        self.assertEqual(self.walk("bfs"), list(range(15)))
+        self.assertEqual(self.walk("pre", start=2), [2, 5, 11, 12, 6, 13, 14])
+        self.assertEqual(self.walk("post", start=6), [13, 14, 6])
+
+    def test_predicate_prunes_subtrees(self):
+        def skip_odd(node_version):
+            return node_version.data["index"] % 2 == 0 or node_version.data["index"] == 1
+
+        self.assertEqual(self.walk("pre", predicate=skip_odd), [0, 1, 4, 10, 2, 6, 14])
+        self.assertEqual(self.walk("bfs", predicate=lambda node_version: False), [])
+
+    def test_query_count_follows_depth(self):
+        # One lookup of the start node, then two queries per level
+        with self.assertNumQueries(1 + 2 * 4):
+            walk = self.version.iter_nodes(self.nodes[0].id, order="bfs")
+            self.assertEqual(next(walk).data["index"], 0)
+            self.assertEqual(len(list(walk)), 14)
+        with self.assertNumQueries(1 + 2 * 2):
+            self.walk("pre", max_depth=2)
+
+    def test_adjacency_index_gives_the_same_walks(self):
+        # Node 3 is also a child of node 2, and is visited below node 1,
+        # which reaches it first breadth-first
+        branch = self.tree.create_new_tree_version_from_tag("iter")
+        branch.add_edge(self.nodes[2].id, self.nodes[3].id, data={})
+
+        def walks(version):
+            return [
+                [nv.data["index"] for nv in version.iter_nodes(self.nodes[0].id, order=order, **kwargs)]
+                for order in ("pre", "post", "bfs")
+                for kwargs in ({}, {"max_depth": 2}, {"predicate": lambda nv: nv.data["index"] != 4})
+            ]
+
+        in_database = walks(branch)
+        branch.adjacency_index()
+        # Only the start node and the node versions of each level are queried
+        with self.assertNumQueries(1 + 3):
+            self.assertEqual(len(list(branch.iter_nodes(self.nodes[0].id, order="bfs"))), 15)
+        self.assertEqual(walks(branch), in_database)
+        self.assertEqual(in_database[0][:4], [0, 1, 3, 7])
+        self.assertEqual(in_database[6], list(range(15)))
+
+    def test_traverse_tree_prints_pre_order(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.version.traverse_tree(self.nodes[1].id)
+        self.assertEqual(
+            [int(line.split()[1]) for line in out.getvalue().splitlines()],
+            [self.nodes[i].id for i in (1, 3, 7, 8, 4, 9, 10)],
+        )
+        with self.assertRaises(ValueError):
+            list(self.version.iter_nodes(self.nodes[0].id, order="sideways"))
+
+
+class CSRGraphTestCase(TestCase):
+    def setUp(self):
+        # 0 -> 1 -> 3 -> 5
+        #   -> 2 -> 4
+        #        -> 3 (second path to 3)
+        self.tree = Tree.objects.create(name="CSR Tree")
+        self.nodes = TreeNode.objects.bulk_create(
+            [TreeNode(tree=self.tree, data={"index": i}) for i in range(6)]
+        )
+        for parent, child in [(0, 1), (0, 2), (1, 3), (2, 4), (3, 5), (2, 3)]:
+            TreeEdge.objects.create(
+                incoming_node=self.nodes[parent], outgoing_node=self.nodes[child], data={}
+            )
+        self.tree.create_tag(name="csr")
+        self.graph = self.tree.get_by_tag("csr").to_csr()
+
+    def test_structure(self):
+        ids = [node.id for node in self.nodes]
+        self.assertEqual(list(self.graph.node_ids), ids)
+        self.assertEqual(sorted(self.graph.children(ids[2])), [ids[3], ids[4]])
+        self.assertEqual(self.graph.roots(), [ids[0]])
+        self.assertEqual(sorted(self.graph.leaves()), [ids[4], ids[5]])
+        self.assertEqual(self.graph.fan_out_histogram(), {0: 2, 1: 2, 2: 2})
+        with self.assertRaises(ValueError):
+            self.graph.children(999999)
+
+    def test_depths_and_subtree_sizes(self):
+        self.assertEqual(list(self.graph.depths()), [0, 1, 1, 2, 2, 3])
+        self.assertEqual(self.graph.depth_histogram(), [1, 2, 2, 1])
+        # Node 3 is counted once, below node 1 which reaches it first
+        self.assertEqual(list(self.graph.subtree_sizes()), [6, 3, 2, 2, 1, 1])
+        self.assertEqual(self.graph.subtree_size(self.nodes[3].id), 2)
+
+    def test_delta_version(self):
+        branch = self.tree.create_new_tree_version_from_tag("csr", delta=True)
+        branch.remove_node(self.nodes[4].id)
+        graph = branch.to_csr()
+        self.assertEqual(len(graph), 5)
+        self.assertEqual(graph.leaves(), [self.nodes[5].id])
+        self.assertEqual(graph.fan_out_histogram(), {0: 1, 1: 3, 2: 1})
+
+
+class TreeVersionStatsTestCase(TestCase):
+    def setUp(self):
+        self.tree = Tree.objects.create(name="Stats Tree")
+        root = TreeNode.objects.create(tree=self.tree, data={"name": "root"})
+        child = TreeNode.objects.create(tree=self.tree, data={"name": "child"})
+        TreeEdge.objects.create(incoming_node=root, outgoing_node=child, data={})
+        self.root = root
+        self.tree.create_tag(name="stats-v1")
+
+    def assertStatsCurrent(self, version):
+        stats = TreeVersionStats.objects.get(version=version)
+        counts = (stats.node_count, stats.edge_count, stats.root_count)
+        fresh = version.refresh_stats()
+        self.assertEqual(counts, (fresh.node_count, fresh.edge_count, fresh.root_count))
+
+    def test_tagging_fills_stats(self):
+        stats = self.tree.get_by_tag("stats-v1").stats
+        self.assertEqual((stats.node_count, stats.edge_count, stats.root_count, stats.max_depth), (2, 1, 1, 1))
+
+    def test_mutations_keep_stats_current(self):
+        for delta in (False, True):
+            branch = self.tree.create_new_tree_version_from_tag("stats-v1", delta=delta)
+            self.assertEqual(branch.stats.max_depth, 1)
+            node = branch.add_node({"name": "new"})
+            self.assertStatsCurrent(branch)
+            # Hanging a root below a node of a tree keeps max_depth known
+            edge = branch.add_edge(self.root.id, node.node_id, {})
+            self.assertEqual(TreeVersionStats.objects.get(version=branch).max_depth, 1)
+            self.assertStatsCurrent(branch)
+            nodes = branch.add_nodes([{"index": i} for i in range(3)])
+            branch.add_edges([(node.node_id, row.node_id, {}) for row in nodes] + [(nodes[0].node_id, nodes[1].node_id, {})])
+            self.assertStatsCurrent(branch)
+            branch.remove_edge(edge.edge_id)
+            self.assertStatsCurrent(branch)
+            branch.add_existing_edge(edge.edge, {"restored": True})
+            branch.add_existing_edge(edge.edge, {"restored": True})
+            self.assertStatsCurrent(branch)
+            branch.remove_node(node.node_id)
+            self.assertStatsCurrent(branch)
+            branch.add_existing_node(node.node, {"name": "back"})
+            self.assertStatsCurrent(branch)
+            # nodes[0] -> nodes[1] is all that is left below a root
+            self.assertEqual(branch.stats.max_depth, 1)
+
+    def test_random_mutations_match_recount(self):
+        rng = random.Random(0)
+        for delta, closure in ((False, False), (True, False), (False, True)):
+            branch = self.tree.create_new_tree_version_from_tag("stats-v1", delta=delta)
+            if closure:
+                branch.build_closure()
+            for step in range(60):
+                if step % 5 == 0:
+                    branch.refresh_stats()
+                node_ids = list(branch.effective_node_versions().values_list("node_id", flat=True))
+                edge_ids = list(branch.effective_edge_versions().values_list("edge_id", flat=True))
+                op = rng.choice(["add_node", "add_edge", "remove_edge", "remove_node", "existing_edge", "existing_node"])
+                if op == "add_node" or not node_ids:
+                    branch.add_node({})
+                elif op == "add_edge":
+                    branch.add_edge(rng.choice(node_ids), rng.choice(node_ids), {})
+                elif op == "remove_edge" and edge_ids:
+                    branch.remove_edge(rng.choice(edge_ids))
+                elif op == "remove_node":
+                    branch.remove_node(rng.choice(node_ids))
+                elif op == "existing_edge" and TreeEdge.objects.exists():
+                    branch.add_existing_edge(rng.choice(list(TreeEdge.objects.all())), {})
+                elif op == "existing_node":
+                    branch.add_existing_node(rng.choice(list(self.tree.nodes.all())), {})
+                stats = TreeVersionStats.objects.get(version=branch)
+                graph = branch.to_csr()
+                self.assertEqual(
+                    (stats.node_count, stats.edge_count, stats.root_count),
+                    (len(graph), len(graph.targets), len(graph.roots())),
+                    op,
+                )
+                if stats.max_depth is not None:
+                    self.assertEqual(stats.max_depth, max(max(graph.depths(), default=0), 0), op)
+
+    def test_refresh_stats_command_backfills(self):
+        TreeVersionStats.objects.all().delete()
+        out = io.StringIO()
+        call_command("refresh_stats", stdout=out)
+        self.assertIn("1 version(s)", out.getvalue())
+        self.assertEqual(self.tree.get_by_tag("stats-v1").stats.node_count, 2)
+
+    def test_list_versions_in_one_query(self):
+        self.tree.create_new_tree_version_from_tag("stats-v1", delta=True)
+        self.tree.create_tag(name="stats-v2")
+        with self.assertNumQueries(1):
+            listing = [
+                (version.tag.name if hasattr(version, "tag") else None, version.stats.node_count)
+                for version in self.tree.list_versions()
+            ]
+        self.assertEqual(listing, [("stats-v1", 2), (None, 2), ("stats-v2", 2)])
+
+    def test_max_depth_follows_edges_onto_roots(self):
+        # a -> b and a separate c -> d: hanging c below b gives a -> b -> c -> d
+        tree = Tree.objects.create(name="Forest Tree", maintain_closure=True)
+        nodes = {name: TreeNode.objects.create(tree=tree, data={"name": name}) for name in "abcd"}
+        for parent, child in [("a", "b"), ("c", "d")]:
+            TreeEdge.objects.create(incoming_node=nodes[parent], outgoing_node=nodes[child], data={})
+        tree.create_tag(name="forest-v1")
+        for closure in (True, False):
+            branch = tree.create_new_tree_version_from_tag("forest-v1")
+            if not closure:
+                branch._drop_closure()
+            branch.add_edge(nodes["b"].id, nodes["c"].id, {})
+            self.assertEqual(branch.has_closure, closure)
+            self.assertEqual(TreeVersionStats.objects.get(version=branch).max_depth, 3)
+            # An edge from below the root it points to closes a cycle
+            branch.add_edge(nodes["d"].id, nodes["a"].id, {})
+            self.assertIsNone(TreeVersionStats.objects.get(version=branch).max_depth)
+
+    def test_list_versions_recounts_unknown_depths(self):
+        branch = self.tree.create_new_tree_version_from_tag("stats-v1")
+        # A second parent for the child leaves the depths to a recount
+        node = branch.add_node({"name": "second parent"})
+        branch.add_edge(node.node_id, TreeEdge.objects.get(incoming_node=self.root).outgoing_node_id, {})
+        self.assertIsNone(TreeVersionStats.objects.get(version=branch).max_depth)
+        depths = {version.id: version.stats.max_depth for version in self.tree.list_versions()}
+        self.assertEqual(depths[branch.id], 1)
+        self.assertEqual(TreeVersionStats.objects.get(version=branch).max_depth, 1)
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        # root -> a -> c
+        #      -> b
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.tree = Tree.objects.create(name="Archive Tree", maintain_closure=True)
+        self.nodes = {
+            name: TreeNode.objects.create(tree=self.tree, data={"name": name}) for name in ("root", "a", "b", "c")
+        }
+        for parent, child in [("root", "a"), ("root", "b"), ("a", "c")]:
+            TreeEdge.objects.create(incoming_node=self.nodes[parent], outgoing_node=self.nodes[child], data={})
+        self.tree.create_tag(name="archive-v1")
+        self.version = self.tree.get_by_tag("archive-v1")
+        self.node_version_ids = set(self.version.node_versions.values_list("id", flat=True))
+
+    def test_reads_are_served_from_the_archive(self):
+        path = self.version.archive(directory=self.directory.name, block_size=2)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(TreeNodeVersion.objects.filter(version=self.version).exists())
+        self.assertFalse(TreeClosure.objects.filter(version=self.version).exists())
+
+        version = Tree.get_by_tag("archive-v1")
+        self.assertEqual(version.archive_path, path)
+        self.assertEqual(version.stats.node_count, 4)
+        archived = version.materialize()
+        with self.assertNumQueries(0):
+            self.assertEqual(archived.get_node(self.nodes["c"].id).data, {"name": "c"})
+            self.assertEqual(
+                sorted(node.data["name"] for node in archived.get_child_nodes(self.nodes["root"].id)), ["a", "b"]
+            )
+            self.assertEqual([node.node_id for node in archived.get_root_nodes()], [self.nodes["root"].id])
+            path_nodes = [node_id for node_id, _ in archived.find_path(self.nodes["root"].id, self.nodes["c"].id)]
+            self.assertEqual(path_nodes, [self.nodes[name].id for name in ("root", "a", "c")])
+        with self.assertRaises(ValueError):
+            archived.get_node(999999)
+
+    def test_row_reads_rehydrate(self):
+        path = self.version.archive(directory=self.directory.name)
+        # Garbage collection drops the nodes and payloads only the archive
+        # still uses
+        collect_garbage(retention=timedelta(0), payloads=True)
+        self.assertFalse(TreeNode.objects.filter(tree=self.tree).exists())
+        self.assertFalse(PayloadBlob.objects.filter(hash=payload_hash({"name": "a"})).exists())
+
+        version = self.tree.restore_from_tag("archive-v1")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(version.get_node(self.nodes["a"].id).data, {"name": "a"})
+        self.assertIsNone(TreeVersion.objects.get(pk=version.pk).archive_path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(set(version.node_versions.values_list("id", flat=True)), self.node_version_ids)
+        self.assertEqual(TreeNode.objects.filter(tree=self.tree).count(), 4)
+        self.assertTrue(version.is_ancestor(self.nodes["root"].id, self.nodes["c"].id))
+        self.assertEqual([node.data for node in version.search("a")], [{"name": "a"}])
+
+    def test_delta_branch_round_trip(self):
+        branch = self.tree.create_new_tree_version_from_tag("archive-v1", delta=True)
+        added = branch.add_node({"name": "d"})
+        branch.add_edge(self.nodes["b"].id, added.node_id, {})
+        self.tree.create_tag(name="archive-v2", version=branch)
+        expected = sorted(node.data["name"] for node in branch.effective_node_versions())
+
+        version = Tree.get_by_tag("archive-v2")
+        version.archive(directory=self.directory.name)
+        self.assertEqual(sorted(node.data["name"] for node in version.materialize().get_root_nodes()), ["root"])
+        with self.captureOnCommitCallbacks(execute=True):
+            version.rehydrate()
+        self.assertEqual(sorted(node.data["name"] for node in version.effective_node_versions()), expected)
+        # The branch's own row keeps its id; the base version is untouched
+        self.assertEqual(version.get_node(added.node_id).id, added.id)
+        self.assertEqual(
+            set(self.version.node_versions.values_list("id", flat=True)), self.node_version_ids
+        )
+        self.assertEqual(
+            [node.node_id for node in version.get_child_nodes(self.nodes["b"].id)], [added.node_id]
+        )
+
+    def test_branching_rehydrates_the_base(self):
+        self.version.archive(directory=self.directory.name)
+        branch = self.tree.create_new_tree_version_from_tag("archive-v1", delta=True)
+        self.assertEqual(branch.effective_node_versions().count(), 4)
+        self.assertIsNone(Tree.get_by_tag("archive-v1").archive_path)
+        with self.assertRaisesMessage(ValueError, "Delta versions read through this version"):
+            Tree.get_by_tag("archive-v1").archive(directory=self.directory.name)
+        with self.assertRaisesMessage(ValueError, "Only tagged versions can be archived."):
+            branch.archive(directory=self.directory.name)
+
+    def test_management_command(self):
+        out = io.StringIO()
+        call_command("archive_version", "archive-v1", directory=self.directory.name, stdout=out)
+        self.assertIn("Archived archive-v1", out.getvalue())
+        self.assertTrue(Tree.get_by_tag("archive-v1").archive_path)
+        call_command("archive_version", "archive-v1", rehydrate=True, stdout=out)
+        self.assertIsNone(Tree.get_by_tag("archive-v1").archive_path)
+        self.assertEqual(Tree.get_by_tag("archive-v1").node_versions.count(), 4)
@@ -0,0 +1,26 @@
+from django.urls import path
+
+from . import views
+
+app_name = 'tree_manager'
+
+# Every read endpoint is available for a version id and for a tag name
+version_patterns = [
+    ('', views.version_detail, 'detail'),
+    ('nodes/', views.node_list, 'nodes'),
+    ('nodes/<int:node_id>/', views.node_detail, 'node'),
+    ('nodes/<int:node_id>/children/', views.child_list, 'children'),
+    ('nodes/<int:node_id>/parents/', views.parent_list, 'parents'),
+    ('edges/', views.edge_list, 'edges'),
+    ('roots/', views.root_list, 'roots'),
+    ('path/', views.path_detail, 'path'),
+    ('dump/', views.version_dump, 'dump'),
+]
+
+urlpatterns = [
+    path(f'versions/<int:version_id>/{route}', view, name=f'version-{name}')
+    for route, view, name in version_patterns
+] + [
+    path(f'tags/<str:tag_name>/{route}', view, name=f'tag-{name}')
+    for route, view, name in version_patterns
+]
@@ -1,3 +1,227 @@
-from django.shortcuts import render
+import asyncio
+import hashlib
+from functools import wraps
 
-# Create your views here.
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import urlencode
+from django.views.decorators.http import require_GET
+
+from .models import Tree, TreeVersion
+from .serialization import aiter_version_ndjson, iter_version_ndjson
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Tag names can be deleted and reused, so responses addressed by tag name
+# are only cached briefly. A version itself can still be edited (which bumps
+# its revision), so responses addressed by version id are revalidated
+# against the revision-based ETag on every use.
+DEFAULT_TAG_MAX_AGE = 60
+
+
+def _resolve_version(tag_name=None, version_id=None):
+    if tag_name is not None:
+        try:
+            return Tree.get_by_tag(tag_name)
+        except ValueError as e:
+            raise Http404(str(e))
+    try:
+        return TreeVersion.objects.select_related('tag').get(pk=version_id)
+    except TreeVersion.DoesNotExist:
+        raise Http404(f"Version {version_id} does not exist.")
+
+
+async def _aresolve_version(tag_name=None, version_id=None):
+    if tag_name is not None:
+        try:
+            return await Tree.aget_by_tag(tag_name)
+        except ValueError as e:
+            raise Http404(str(e))
+    try:
+        return await TreeVersion.objects.select_related('tag').aget(pk=version_id)
+    except TreeVersion.DoesNotExist:
+        raise Http404(f"Version {version_id} does not exist.")
+
+
+def _etag(request, chain_revisions):
+    # Strong validator for the exact representation: the versions the
+    # content is read from, their revisions and the requested URL
+    fingerprint = repr((chain_revisions, request.get_full_path()))
+    return '"%s"' % hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def _set_cache_headers(response, etag, tag_name):
+    if etag is None:
+        response.headers['Cache-Control'] = 'no-cache'
+    elif response.status_code in (200, 304):
+        response.headers['ETag'] = etag
+        if tag_name is not None:
+            max_age = getattr(settings, 'TREE_API_TAG_MAX_AGE', DEFAULT_TAG_MAX_AGE)
+            response.headers['Cache-Control'] = f'public, max-age={max_age}'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def version_view(view):
+    # Resolve the version addressed by the URL (by tag name or by id) and
+    # handle conditional GETs and caching headers for tagged versions.
+    # Async views get an async wrapper so they never block a worker thread.
+    if asyncio.iscoroutinefunction(view):
+        @require_GET
+        @wraps(view)
+        async def async_wrapper(request, tag_name=None, version_id=None, **kwargs):
+            version = await _aresolve_version(tag_name=tag_name, version_id=version_id)
+            etag = None
+            response = None
+            if hasattr(version, 'tag'):
+                etag = _etag(request, await version.achain_revisions())
+                response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = await view(request, version, **kwargs)
+            return _set_cache_headers(response, etag, tag_name)
+
+        return async_wrapper
+
+    @require_GET
+    @wraps(view)
+    def wrapper(request, tag_name=None, version_id=None, **kwargs):
+        version = _resolve_version(tag_name=tag_name, version_id=version_id)
+        etag = None
+        response = None
+        if hasattr(version, 'tag'):
+            etag = _etag(request, version.chain_revisions())
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = view(request, version, **kwargs)
+        return _set_cache_headers(response, etag, tag_name)
+
+    return wrapper
+
+
+def _node_json(node_version):
+    return {'id': node_version.node_id, 'data': node_version.data}
+
+
+def _edge_json(edge_version):
+    return {
+        'id': edge_version.edge_id,
+        'source': edge_version.source_node_id,
+        'target': edge_version.target_node_id,
+        'data': edge_version.data,
+    }
+
+
+async def _page(request, queryset, key, serialize):
+    # Keyset pagination: ?after=<last key of the previous page>&limit=N.
+    # Unlike OFFSET, every page is a single index range scan.
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = request.GET.get('after')
+        after = int(after) if after is not None else None
+    except ValueError:
+        return JsonResponse({'error': "'limit' and 'after' must be integers."}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': "'limit' must be positive."}, status=400)
+
+    if after is not None:
+        queryset = queryset.filter(**{f'{key}__gt': after})
+    rows = [row async for row in queryset.order_by(key)[:limit + 1]]
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = request.GET.copy()
+        params['after'] = getattr(rows[-1], key)
+        params['limit'] = limit
+        next_url = f'{request.path}?{urlencode(sorted(params.items()))}'
+    return JsonResponse({'results': [serialize(row) for row in rows], 'next': next_url})
+
+
+@version_view
+def version_detail(request, version):
+    tag = getattr(version, 'tag', None)
+    return JsonResponse({
+        'id': version.id,
+        'tree': version.tree_id,
+        'parent_version': version.parent_version_id,
+        'tag': tag.name if tag else None,
+        'created_at': version.created_at.isoformat(),
+        'nodes': reverse('tree_manager:version-nodes', args=[version.id]),
+        'edges': reverse('tree_manager:version-edges', args=[version.id]),
+        'roots': reverse('tree_manager:version-roots', args=[version.id]),
+        'dump': reverse('tree_manager:version-dump', args=[version.id]),
+    })
+
+
+# The listing and node views are async: under ASGI a slow client does not
+# hold a thread while its queries run. The querysets are built by the sync
+# model methods once the version chain is resolved, which does no I/O.
+
+@version_view
+async def node_list(request, version):
+    await version.aversion_chain()
+    return await _page(request, version.effective_node_versions(), 'node_id', _node_json)
+
+
+@version_view
+async def edge_list(request, version):
+    await version.aversion_chain()
+    return await _page(request, version.effective_edge_versions(), 'edge_id', _edge_json)
+
+
+@version_view
+async def root_list(request, version):
+    await version.aversion_chain()
+    return await _page(request, version.get_root_nodes(), 'node_id', _node_json)
+
+
+@version_view
+async def node_detail(request, version, node_id):
+    try:
+        return JsonResponse(_node_json(await version.aget_node(node_id)))
+    except ValueError as e:
+        raise Http404(str(e))
+
+
+@version_view
+async def child_list(request, version, node_id):
+    await version.aversion_chain()
+    return await _page(request, version.get_child_nodes(node_id), 'node_id', _node_json)
+
+
+@version_view
+async def parent_list(request, version, node_id):
+    await version.aversion_chain()
+    return await _page(request, version.get_parent_nodes(node_id), 'node_id', _node_json)
+
+
+@version_view
+def path_detail(request, version):
+    try:
+        start, end = int(request.GET['start']), int(request.GET['end'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "Integer 'start' and 'end' parameters are required."}, status=400)
+    path = version.find_path(start, end)
+    if path is None:
+        raise Http404(f"No path from node {start} to node {end}.")
+    return JsonResponse({
+        'path': [
+            {'node': node_id, 'edge': edge_version.edge_id if edge_version else None}
+            for node_id, edge_version in path
+        ],
+    })
+
+
+@version_view
+async def version_dump(request, version):
+    # The whole version as newline-delimited JSON, streamed as it is read.
+    # Each server streams its own kind of iterator; given the other kind,
+    # Django buffers the whole dump in memory first.
+    if isinstance(request, ASGIRequest):
+        content = aiter_version_ndjson(version)
+    else:
+        content = iter_version_ndjson(version)
+    return StreamingHttpResponse(content, content_type='application/x-ndjson')
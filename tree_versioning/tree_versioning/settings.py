@@ -79,6 +79,23 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts, so concurrent
+            # writers queue up (for up to `timeout` seconds) instead of failing
+            # to upgrade a read lock half-way through
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+            # WAL would also let readers proceed while a writer holds the
+            # lock, but switching to it rewrites the database file, so it is
+            # left to stress_writers (or to 'init_command': 'PRAGMA
+            # journal_mode=WAL;' in a deployment's own settings)
+        },
+        # Tests run against a file too: an in-memory database uses
+        # shared-cache table locks, which fail at once instead of waiting,
+        # so concurrent writers could not be tested on it
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 